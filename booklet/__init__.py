@@ -1,8 +1,8 @@
-from booklet.main import open, VariableLengthValue, FixedLengthValue
+from booklet.main import open, VariableLengthValue, FixedLengthValue, ShardedBooklet, AsyncBooklet, LazyValue
 from booklet.utils import make_timestamp_int
 from booklet import serializers, utils
 
 available_serializers = list(serializers.serial_dict.keys())
 
-__all__ = ["open", "available_serializers", 'VariableLengthValue', 'FixedLengthValue', 'make_timestamp_int']
+__all__ = ["open", "available_serializers", 'VariableLengthValue', 'FixedLengthValue', 'ShardedBooklet', 'AsyncBooklet', 'LazyValue', 'make_timestamp_int']
 __version__ = '0.7.6'
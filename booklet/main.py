@@ -4,10 +4,13 @@
 
 """
 import io
+import asyncio
+import concurrent.futures
 # import mmap
 import pathlib
 # import inspect
 from collections.abc import MutableMapping
+from contextlib import contextmanager
 from typing import Union
 # from threading import Lock
 import portalocker
@@ -15,8 +18,9 @@ import portalocker
 # from collections import Counter, defaultdict, deque
 import orjson
 # import datetime
-# import time
+import time
 import weakref
+from itertools import islice
 # from multiprocessing import Manager, shared_memory
 
 # try:
@@ -81,20 +85,139 @@ class Booklet(MutableMapping):
         if self.writable:
             self.sync()
             with self._thread_lock:
-                _ = utils.write_data_blocks(self._file,  utils.metadata_key_bytes, utils.encode_metadata(data), self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size, timestamp, self._ts_bytes_len)
-                if self._buffer_index:
-                    utils.flush_data_buffer(self._file, self._buffer_data, self._file.seek(0, 2))
-                _ = utils.update_index(self._file, self._buffer_index, self._buffer_index_set, self._n_buckets)
-                self._file.flush()
+                self._write_reserved_block(utils.metadata_key_bytes, utils.encode_metadata(data), timestamp)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def _write_reserved_block(self, key_bytes, value_bytes, timestamp=None):
+        """
+        Write the data block of a reserved key (e.g. the metadata) straight to the file. The reserved keys are not counted as items. The _thread_lock must be held by the caller and the buffers must be empty.
+        """
+        key_hash = utils.hash_key(key_bytes)
+        if self._key_width:
+            # Without saved key lengths, the key must be cut to the key width. The reserved data blocks are found by their key hash.
+            key_bytes = key_bytes[:self._key_width]
+
+        self._acquire_write_lock()
+        try:
+            _ = utils.write_data_blocks(self._file, key_bytes, value_bytes, self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size, timestamp, self._ts_bytes_len, key_hash, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+            if self._buffer_index:
+                utils.flush_data_buffer(self._file, self._buffer_data, self._file.seek(0, 2))
+            _ = utils.update_index(self._file, self._buffer_index, self._buffer_index_set, self._n_buckets)
+            self._file.flush()
+        finally:
+            self._release_write_lock()
+
+    def _set_compression(self, compression, level=None, threads=0, zstd_dict=None):
+        """
+        Save the compression parameters in the header (and the zstd dictionary in the file) and use them for all of the values that are written from now on. The _thread_lock must be held by the caller and the buffers must be empty.
+        """
+        codec = utils.make_codec(compression, level, threads, zstd_dict)
+        if zstd_dict is not None:
+            self._write_reserved_block(utils.zstd_dict_key_bytes, zstd_dict)
+
+        compression_bytes = utils.make_compression_bytes(compression, level, threads)
+        self._acquire_write_lock()
+        try:
+            self._file.seek(utils.compression_pos)
+            self._file.write(compression_bytes)
+        finally:
+            self._release_write_lock()
+
+        self._compression = compression
+        self._compression_level = utils.bytes_to_int(compression_bytes[1:2], True)
+        self._compression_threads = threads
+        self._zstd_dict = zstd_dict
+        self._codec = codec
+
+    def _init_compression(self, compression, compression_level, compression_threads, zstd_dict):
+        """
+        Change the compression parameters of the file if they were passed and differ from the saved ones. The values of a file can only be compressed one way, so the compression and dictionary can only be changed on an empty file. The level and threads only affect writes, so they can be changed at any time.
+        """
+        if zstd_dict is not None:
+            if compression not in (None, 'zstd'):
+                raise ValueError('A zstd_dict can only be used with the zstd compression.')
+            code = utils.compressions['zstd_dict']
+            zstd_dict = bytes(zstd_dict)
+        elif (compression is not None) and not ((compression == 'zstd') and (self._zstd_dict is not None)):
+            code = utils.get_compression_code(compression)
+            zstd_dict = None
         else:
+            code = self._compression
+            zstd_dict = self._zstd_dict
+
+        if (code != self._compression) or (zstd_dict != self._zstd_dict):
+            if (not self.writable) or len(self):
+                raise ValueError('The compression and zstd_dict can only be assigned to a new or empty file. Use train_zstd_dict for a file with values.')
+        elif not self.writable:
+            return
+        elif ((compression_level is None) or (compression_level == self._compression_level)) and ((compression_threads is None) or (compression_threads == self._compression_threads)):
+            return
+
+        if (compression_level is None) and (utils.codecs.get(code) is utils.codecs.get(self._compression)):
+            compression_level = self._compression_level
+        if compression_threads is None:
+            compression_threads = self._compression_threads
+
+        with self._thread_lock:
+            self._set_compression(code, compression_level, compression_threads, zstd_dict)
+
+    def train_zstd_dict(self, dict_size: int=2**16, max_samples: int=utils.zstd_dict_max_samples):
+        """
+        Train a zstd dictionary from (up to max_samples of) the values in the file, save it in the file, and compress all of the values with it. This is meant for files with many small and similar values that don't compress well individually. All of the values are rewritten and the file is pruned afterwards. Other processes that have the file open must reopen it. Returns the number of bytes of the dictionary.
+        """
+        if not self.writable:
             raise ValueError('File is open for read only.')
+        if self._blobs is not None:
+            raise ValueError('A zstd dictionary can not be trained for a file with deduplicated values.')
+
+        self.sync()
+
+        samples = [self._decompress(value) for value in islice(self._iter_data_blocks(False, True, False), max_samples)]
+        zstd_dict = utils.train_zstd_dict(samples, dict_size)
+
+        with self._thread_lock:
+            start, end = self._read_committed(self._data_block_range)
+            # Keep the old codec for the existing values
+            old_codec = self._codec
+            level = None
+            if utils.codecs.get(self._compression) is utils.codecs[utils.compressions['zstd_dict']]:
+                level = self._compression_level
+
+            self._set_compression(utils.compressions['zstd_dict'], level, self._compression_threads, zstd_dict)
+
+            for key, ts_int, value in utils.iter_keys_value_from_start_end_pos(self._file, start, end, True, True, True, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width):
+                if old_codec is not None:
+                    value = old_codec.decompress(value)
+                self._write_data_block(key, self._compress(value), ts_int)
+
+            self._flush_buffers()
+            self._acquire_write_lock()
+            try:
+                self._prune_file()
+            finally:
+                self._release_write_lock()
+
+        return len(zstd_dict)
+
+    def _compress(self, value: bytes):
+        if self._codec is not None:
+            value = self._codec.compress(value)
+
+        return value
+
+    def _decompress(self, value: bytes):
+        if self._codec is not None:
+            value = self._codec.decompress(value)
+
+        return value
 
     def get_metadata(self, include_timestamp=False):
         """
         Get the metadata. Optionally include the timestamp in the output.
         Will return None if no metadata has been assigned.
         """
-        output = utils.get_value_ts(self._file, utils.metadata_key_hash, self._n_buckets, True, include_timestamp, self._ts_bytes_len)
+        output = self._read_committed(lambda: utils.get_value_ts(self._file, utils.metadata_key_hash, self._n_buckets, True, include_timestamp, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
 
         if output:
             value, ts_int = output
@@ -130,51 +253,98 @@ class Booklet(MutableMapping):
         except Exception as error:
             raise error
 
-        return value
+        return self._compress(value)
 
     def _post_value(self, value: bytes):
 
         ## Serialize from bytes
-        value = self._value_serializer.loads(value)
+        value = self._value_serializer.loads(self._decompress(self._deref_value(value)))
+
+        return value
+
+    def _open_blobs(self, flag):
+        """
+        Open the blobs file of a file with deduplicated values. It's a booklet next to the file (with a .blobs suffix) of the values by their value hashes.
+        """
+        return VariableLengthValue(utils.get_index_path(self._file_path, utils.blobs_suffix), flag, n_buckets=self._n_buckets, buffer_size=self._write_buffer_size, init_timestamps=False, lock_mode=self._lock_mode, n_bytes_key=1, n_bytes_value=self._n_bytes_value)
+
+    def _add_blob(self, value: bytes):
+        """
+        Add a value to the blobs file if it isn't already there. Returns the value hash, which is saved as the value of the item.
+        """
+        value_hash = utils.hash_value(value)
+        if value_hash not in self._blobs:
+            self._blobs.set(value_hash, value)
+
+        return value_hash
+
+    def _deref_value(self, value: bytes):
+        """
+        Get the value bytes of a saved value. In a file with deduplicated values, the saved value is the value hash of the value in the blobs file.
+        """
+        if self._blobs is not None:
+            value_hash = bytes(value)
+            value = self._blobs.get(value_hash)
+            if value is None:
+                raise ValueError('The value {} is missing from the blobs file.'.format(value_hash.hex()))
 
         return value
 
-    def keys(self):
+    def keys(self, key_filter=None, since=None):
+        """
+        Return an iterator of the keys. See items for the key_filter and since parameters.
+        """
         if self._buffer_index_set:
             self.sync()
 
-        for key in utils.iter_keys_values(self._file, self._n_buckets, True, False, False, self._ts_bytes_len):
+        for key in self._iter_data_blocks(True, False, False, key_filter, None, since):
             yield self._post_key(key)
 
-    def items(self):
+    def items(self, key_filter=None, raw_value_filter=None, since=None, lazy=False):
+        """
+        Return an iterator of (key, value). The filters are applied while the file is read and before anything is deserialized. key_filter is a function that is called with the serialized key bytes and returns False to skip the item (the value of a skipped item isn't read). raw_value_filter is the same, but it's called with the serialized value bytes. since skips the items with timestamps older than it (it requires init_timestamps). If lazy is True, the values are LazyValue objects that only read and deserialize the value when its value attribute is first accessed.
+        """
         if self._buffer_index_set:
             self.sync()
 
-        for key, value in utils.iter_keys_values(self._file, self._n_buckets, True, True, False, self._ts_bytes_len):
-            yield self._post_key(key), self._post_value(value)
+        if lazy:
+            for key, (value_pos, value_len) in self._iter_data_blocks(True, True, False, key_filter, raw_value_filter, since, True):
+                yield self._post_key(key), LazyValue(self, value_pos, value_len)
+        else:
+            for key, value in self._iter_data_blocks(True, True, False, key_filter, raw_value_filter, since):
+                yield self._post_key(key), self._post_value(value)
 
-    def values(self):
+    def values(self, raw_value_filter=None, since=None):
+        """
+        Return an iterator of the values. See items for the raw_value_filter and since parameters.
+        """
         if self._buffer_index_set:
             self.sync()
 
-        for value in utils.iter_keys_values(self._file, self._n_buckets, False, True, False, self._ts_bytes_len):
+        for value in self._iter_data_blocks(False, True, False, None, raw_value_filter, since):
             yield self._post_value(value)
 
-    def timestamps(self, include_value=False, decode_value=True):
+    def timestamps(self, include_value=False, decode_value=True, lazy=False):
         """
-        Return an iterator for timestamps for all keys. Optionally add values to the iterator.
+        Return an iterator for timestamps for all keys. Optionally add values to the iterator. If lazy is True, the values are LazyValue objects (see items).
         """
         if self._init_timestamps:
             if self._buffer_index_set:
                 self.sync()
 
+            data_iter = self._iter_data_blocks(True, include_value, True, value_pos=include_value and lazy)
+
             if include_value:
-                for key, ts_int, value in utils.iter_keys_values(self._file, self._n_buckets, True, True, True, self._ts_bytes_len):
-                    if decode_value:
+                for key, ts_int, value in data_iter:
+                    if lazy:
+                        value = LazyValue(self, value[0], value[1], decode_value)
+                    elif decode_value:
                         value = self._post_value(value)
+                    else:
+                        value = self._deref_value(value)
                     yield self._post_key(key), ts_int, value
             else:
-                for key, ts_int in utils.iter_keys_values(self._file, self._n_buckets, True, False, True, self._ts_bytes_len):
+                for key, ts_int in data_iter:
                     yield self._post_key(key), ts_int
         else:
             raise ValueError('timestamps were not initialized with this file.')
@@ -192,31 +362,359 @@ class Booklet(MutableMapping):
 
         # return int(len1 - self._n_deletes)
 
-        return self._n_keys
+        return self._read_committed(lambda: self._n_keys)
 
     def __contains__(self, key):
-        bytes_key = self._pre_key(key)
-        key_hash = utils.hash_key(bytes_key)
+        return self._contains_key(self._pre_key(key))
+
+    def _contains_key(self, key_bytes):
+        """
+        Check if the serialized key exists.
+        """
+        key_hash = utils.hash_key(key_bytes)
 
         if key_hash in self._buffer_index_set:
             return True
 
-        return utils.contains_key(self._file, key_hash, self._n_buckets)
+        if self._ttl:
+            min_timestamp = utils.get_min_timestamp(self._ttl)
+            return bool(self._read_committed(lambda: utils.get_value_ts(self._file, key_hash, self._n_buckets, False, True, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)))
+        else:
+            return self._read_committed(lambda: utils.contains_key(self._file, key_hash, self._n_buckets))
 
     def get(self, key, default=None):
-        key_bytes = self._pre_key(key)
+        value = self._get_saved_value(self._pre_key(key))
+
+        if value:
+            return self._post_value(value)
+        else:
+            return default
+
+    def _get_saved_value(self, key_bytes):
+        """
+        Get the saved value bytes of the serialized key. Returns a false value if the key doesn't exist.
+        """
         key_hash = utils.hash_key(key_bytes)
 
         if key_hash in self._buffer_index_set:
             self.sync()
 
-        value = utils.get_value(self._file, key_hash, self._n_buckets, self._ts_bytes_len)
+        min_timestamp = utils.get_min_timestamp(self._ttl)
 
-        if value:
-            return self._post_value(value)
-        else:
+        return self._read_committed(lambda: utils.get_value(self._file, key_hash, self._n_buckets, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+
+    def get_view(self, key, default=None):
+        """
+        Get a value like get, but the value is deserialized from a read-only view of a memory map of the file rather than a copy of the bytes. With the numpy serializers (and bytes, which returns a memoryview), the returned value is a read-only view into the file, so large arrays load without being copied. Other serializers and compressed values get a copy of the bytes as usual. Like numpy memmap arrays, the views must not be used after the file has been pruned or cleared (by any process). The memory map stays open until the file is closed and all of the views have been garbage collected.
+        """
+        value_pos = self._get_value_pos(key)
+        if not value_pos:
+            return default
+
+        value_pos, value_len = value_pos
+        with self._thread_lock:
+            if (self._file_map is None) or (len(self._file_map) < value_pos + value_len):
+                # The file has grown since it was mapped
+                self._file_map = utils.map_file(self._file)
+            value = memoryview(self._file_map)[value_pos:value_pos + value_len]
+
+        if self._blobs is not None:
+            value_hash = bytes(value)
+            value = self._blobs.get_view(value_hash)
+            if value is None:
+                raise ValueError('The value {} is missing from the blobs file.'.format(value_hash.hex()))
+
+        if (self._codec is not None) or not getattr(self._value_serializer, 'view', False):
+            value = bytes(value)
+
+        return self._value_serializer.loads(self._decompress(value))
+
+    def get_range(self, key, start=0, length=None, default=None):
+        """
+        Read part of the raw value of a key: length bytes (or up to the end of the value if None) from the start position within the value. Only those bytes are read from the file, so this is cheap for slices of very large values. The bytes are the serialized value (and compressed if the file has compression), so it's meant for serializers with fixed-width elements (e.g. numpy_int4 or bytes). Returns the default if the key doesn't exist.
+        """
+        if self._blobs is not None:
+            value_hash = self._get_value_hash(key)
+            if value_hash is None:
+                return default
+            return self._blobs.get_range(value_hash, start, length, default)
+
+        key_hash = utils.hash_key(self._pre_key(key))
+
+        if key_hash in self._buffer_index_set:
+            self.sync()
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+
+        def read_func():
+            value_pos = utils.get_value_pos(self._file, key_hash, self._n_buckets, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+            if not value_pos:
+                return None
+            value_pos, value_len = value_pos
+            range_start = min(max(start, 0), value_len)
+            range_len = value_len - range_start if length is None else min(max(length, 0), value_len - range_start)
+            return utils.read_bytes(self._file, value_pos + range_start, range_len)
+
+        value = self._read_committed(read_func)
+        if value is None:
             return default
 
+        return value
+
+    def open_value(self, key):
+        """
+        Open the raw value of a key as a read-only file-like object (see get_range for what the raw value is). Seeks and reads happen within the value in the file, so parts of very large values can be read without reading the whole value. Like a LazyValue, it must be used before the booklet is closed, and a prune or clear of the file invalidates it. Raises a KeyError if the key doesn't exist.
+        """
+        if self._blobs is not None:
+            value_hash = self._get_value_hash(key)
+            if value_hash is None:
+                raise KeyError(key)
+            return self._blobs.open_value(value_hash)
+
+        value_pos = self._get_value_pos(key)
+        if not value_pos:
+            raise KeyError(key)
+
+        return ValueReader(self, *value_pos)
+
+    def _get_value_pos(self, key):
+        """
+        The position and length of the value of the key in the file, or False if it doesn't exist.
+        """
+        key_hash = utils.hash_key(self._pre_key(key))
+
+        if key_hash in self._buffer_index_set:
+            self.sync()
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+
+        return self._read_committed(lambda: utils.get_value_pos(self._file, key_hash, self._n_buckets, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+
+    def _get_value_hash(self, key):
+        """
+        The value hash of the key in a file with deduplicated values, or None if it doesn't exist.
+        """
+        value_hash = self._get_saved_value(self._pre_key(key))
+
+        if value_hash:
+            return value_hash
+
+    def _unmap_file(self):
+        """
+        Drop the memory map of get_view. It must be remapped after the file has been pruned or cleared.
+        """
+        utils.unmap_file(self._file_map)
+        self._file_map = None
+
+    def changes_since(self, token=None):
+        """
+        Return the items that have been written since the token was created. The file is append-only between prunes, so the token is the position of the end of the data blocks at the previous call (None returns all items). Items that have since been overwritten or deleted are skipped (deletes are not reported). Returns a tuple of an iterator of (key, value) and the token for the next call. Tokens are invalidated by a prune or a clear.
+        """
+        if self._buffer_index_set:
+            self.sync()
+
+        start, end = self._read_committed(self._data_block_range)
+        if token is not None:
+            if (token < start) or (token > end):
+                raise ValueError('The token is not valid for this file. The file might have been pruned or cleared since the token was created.')
+            start = token
+
+        data_iter = utils.iter_keys_value_from_start_end_pos(self._file, start, end, True, True, False, self._ts_bytes_len, utils.get_min_timestamp(self._ttl), self._exclude_namespaces(), n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+        return ((self._post_key(key), self._post_value(value)) for key, value in data_iter), end
+
+    def items_since(self, timestamp, include_timestamp=False):
+        """
+        Return an iterator of (key, value) for the items with timestamps >= timestamp (or (key, timestamp, value) with include_timestamp). If the file has a timestamp index (see the ts_index parameter of the open function), then only the matching items are read and they are returned in timestamp order. Otherwise all of the data blocks are read and the items are returned in file order.
+        """
+        for key, ts_int, value in self._iter_since(timestamp, True):
+            if include_timestamp:
+                yield self._post_key(key), ts_int, self._post_value(value)
+            else:
+                yield self._post_key(key), self._post_value(value)
+
+    def keys_since(self, timestamp):
+        """
+        Return an iterator of the keys with timestamps >= timestamp. See items_since for details.
+        """
+        for key, ts_int, value in self._iter_since(timestamp, False):
+            yield self._post_key(key)
+
+    def _iter_since(self, timestamp, include_value):
+        """
+        Iterate over the (key, timestamp, value) of the items with timestamps >= timestamp. The value is None if include_value is False.
+        """
+        if not self._init_timestamps:
+            raise ValueError('timestamps were not initialized with this file.')
+
+        if self._buffer_index_set or self._ts_index_entries:
+            self.sync()
+
+        min_timestamp = utils.make_timestamp_int(timestamp)
+        if self._ttl:
+            min_timestamp = max(min_timestamp, utils.get_min_timestamp(self._ttl))
+
+        if (self._ts_index_path is not None) and self._ts_index_path.exists():
+            def read_func():
+                with io.open(self._ts_index_path, 'rb') as ts_file:
+                    return utils.search_ts_index(ts_file, min_timestamp)
+
+            entries = self._read_committed(read_func)
+            yielded = set()
+            for ts_int, data_block_pos in entries:
+                if data_block_pos in yielded:
+                    continue
+                data_block = self._read_committed(lambda: utils.read_live_data_block(self._file, data_block_pos, include_value, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+                # The timestamp might have been changed by set_timestamp
+                if (data_block is not None) and (data_block[1] == ts_int):
+                    yielded.add(data_block_pos)
+                    yield data_block
+        else:
+            for key, ts_int, value in self._iter_data_blocks(True, True, True):
+                if ts_int >= min_timestamp:
+                    yield key, ts_int, value
+
+    def range(self, lower=None, upper=None, include_value=True):
+        """
+        Return an iterator of (key, value) (or keys if include_value is False) for the keys with lower <= key < upper, in key order. None means no bound, so range() iterates over all of the items in key order. The keys are ordered by their serialized bytes, except for the int key serializers, which are ordered by their values. If the file has a key index (see the key_index parameter of the open function), then only the matching items are read. Otherwise all of the keys are read and sorted in memory.
+        """
+        lower_key = None if lower is None else self._order_key(self._pre_key(lower))
+        upper_key = None if upper is None else self._order_key(self._pre_key(upper))
+
+        return self._iter_key_range(lower_key, upper_key, None, include_value)
+
+    def prefix(self, prefix, include_value=True):
+        """
+        Return an iterator of (key, value) (or keys if include_value is False) for the keys that start with the prefix, in key order. The prefix is serialized with the key serializer, so it's meant for str and bytes keys. See range for details.
+        """
+        return self._iter_key_range(None, None, self._order_key(self._pre_key(prefix)), include_value)
+
+    def _iter_key_range(self, lower_key, upper_key, prefix_key, include_value):
+        """
+        Iterate over the items whose ordered keys are within the bounds.
+        """
+        if self._buffer_index_set:
+            self.sync()
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+
+        def in_range(order_key):
+            if (lower_key is not None) and (order_key < lower_key):
+                return False
+            if (upper_key is not None) and (order_key >= upper_key):
+                return False
+            if (prefix_key is not None) and (not order_key.startswith(prefix_key)):
+                return False
+            return True
+
+        if (self._key_index_path is not None) and self._key_index_path.exists():
+            def read_func():
+                with io.open(self._key_index_path, 'rb') as key_file:
+                    return utils.search_key_index(key_file, lower_key, upper_key, prefix_key)
+
+            for _, data_block_pos in self._read_committed(read_func):
+                data_block = self._read_committed(lambda: utils.read_live_data_block(self._file, data_block_pos, include_value, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+                if data_block is not None:
+                    key, ts_int, value = data_block
+                    if (min_timestamp is not None) and (ts_int < min_timestamp):
+                        continue
+                    if include_value:
+                        yield self._post_key(key), self._post_value(value)
+                    else:
+                        yield self._post_key(key)
+        else:
+            keys = sorted((self._order_key(self._pre_key(key)), key) for key in self.keys())
+            for order_key, key in keys:
+                if in_range(order_key):
+                    if include_value:
+                        value = self.get(key)
+                        if value is not None:
+                            yield key, value
+                    else:
+                        yield key
+
+    def index(self, name):
+        """
+        Return the value index with the name (see the indexes parameter of the open function). The index can be queried with get (returns the keys) or items (returns the key/value pairs) for an index value.
+        """
+        if (self._file_path is None) or (not utils.get_value_index_path(self._file_path, name).exists()):
+            raise KeyError(name)
+
+        return ValueIndex(self, name)
+
+    def namespace(self, name, key_serializer=None, value_serializer=None):
+        """
+        Return the namespace with the name. A namespace is a separate mapping in the same file with its own serializers and keys, so related datasets can share the file, the file lock, and the write buffer (and are synced together). The serializers are saved in the file when the namespace is created (which requires the file to be open for writing), so they only need to be passed the first time (unless they are custom serializers). The items of the namespaces are not items of the booklet, but len() of the booklet counts them. The timestamp, key, and value indexes and files created with n_bytes_key=0 don't support namespaces.
+        """
+        if isinstance(self, FixedLengthValue):
+            raise TypeError('Namespaces can only be used in a VariableLengthValue file.')
+        if not name.isidentifier():
+            raise ValueError('The namespace names must be valid identifiers.')
+        if self._key_width:
+            raise ValueError('Namespaces can not be used in a file without key lengths (n_bytes_key=0).')
+
+        if name in self._namespaces:
+            key_code, value_code = self._namespaces[name]
+        elif not self.writable:
+            raise KeyError(name)
+        elif (self._ts_index_path.exists() or self._key_index_path.exists() or any(utils.iter_value_index_names(self._file_path))):
+            raise ValueError('Namespaces can not be used in a file with timestamp, key, or value indexes.')
+        else:
+            key_code = utils.get_serializer_code(key_serializer, 'key')
+            value_code = utils.get_serializer_code(value_serializer, 'value')
+            self.sync()
+            with self._thread_lock:
+                namespaces = dict(self._namespaces)
+                namespaces[name] = [key_code, value_code]
+                self._write_reserved_block(utils.namespaces_key_bytes, utils.encode_metadata(namespaces))
+                self._namespaces = namespaces
+
+        return Namespace(self, name, utils.get_saved_serializer(key_code, key_serializer, 'key'), utils.get_saved_serializer(value_code, value_serializer, 'value'))
+
+    def _iter_value_index(self, name, index_value, include_value):
+        """
+        Iterate over the (key, value) of the items whose index value is index_value. The value is None if include_value is False.
+        """
+        if self._buffer_index_set:
+            self.sync()
+
+        index_value = utils.encode_index_value(index_value)
+        if index_value is None:
+            return
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+
+        def read_func():
+            with io.open(utils.get_value_index_path(self._file_path, name), 'rb') as value_index_file:
+                return utils.search_key_index(value_index_file, index_value, index_value + b'\x00')
+
+        for _, data_block_pos in self._read_committed(read_func):
+            data_block = self._read_committed(lambda: utils.read_live_data_block(self._file, data_block_pos, include_value, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+            if data_block is not None:
+                key, ts_int, value = data_block
+                if (min_timestamp is not None) and (ts_int < min_timestamp):
+                    continue
+                if include_value:
+                    value = self._post_value(value)
+                yield self._post_key(key), value
+
+    def get_many(self, keys, default=None):
+        """
+        Return an iterator of (key, value) for the requested keys. The default is returned as the value for keys that do not exist.
+        """
+        if self._buffer_index_set:
+            self.sync()
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+        for key in keys:
+            key_hash = utils.hash_key(self._pre_key(key))
+            value = self._read_committed(lambda: utils.get_value(self._file, key_hash, self._n_buckets, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+
+            if value:
+                yield key, self._post_value(value)
+            else:
+                yield key, default
+
     def get_timestamp(self, key, include_value=False, decode_value=True, default=None):
         """
         Get a timestamp associated with a key. Optionally include the value.
@@ -228,7 +726,8 @@ class Booklet(MutableMapping):
             if key_hash in self._buffer_index_set:
                 self.sync()
 
-            output = utils.get_value_ts(self._file, key_hash, self._n_buckets, include_value, True, self._ts_bytes_len)
+            min_timestamp = utils.get_min_timestamp(self._ttl)
+            output = self._read_committed(lambda: utils.get_value_ts(self._file, key_hash, self._n_buckets, include_value, True, self._ts_bytes_len, min_timestamp, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
 
             if output:
                 value, ts_int = output
@@ -236,6 +735,8 @@ class Booklet(MutableMapping):
                 if include_value:
                     if decode_value:
                         value = self._post_value(value)
+                    else:
+                        value = self._deref_value(value)
 
                     return ts_int, value
                 else:
@@ -254,10 +755,20 @@ class Booklet(MutableMapping):
                 key_bytes = self._pre_key(key)
                 key_hash = utils.hash_key(key_bytes)
 
+                ts_int = utils.make_timestamp_int(timestamp)
+
                 with self._thread_lock:
-                    success = utils.set_timestamp(self._file, key_hash, self._n_buckets, timestamp)
+                    self._acquire_write_lock()
+                    try:
+                        data_block_pos = utils.set_timestamp(self._file, key_hash, self._n_buckets, ts_int, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+                    finally:
+                        self._release_write_lock()
 
-                if not success:
+                    if data_block_pos and self._ts_index:
+                        # The new entry is written with the next flush
+                        self._ts_index_entries.append((ts_int, data_block_pos))
+
+                if not data_block_pos:
                     raise KeyError(key)
             else:
                 raise ValueError('File is open for read only.')
@@ -271,20 +782,53 @@ class Booklet(MutableMapping):
         The timestamp must be either None, an int of the number of microseconds in POSIX UTC time, an ISO 8601 datetime string with timezone, or a datetime object with timezone. None will create a timestamp of now.
         """
         if self.writable:
+            index_values = None
             if encode_value:
+                index_values = self._extract_index_values(value)
                 value = self._pre_value(value)
             with self._thread_lock:
-                n_extra_keys = utils.write_data_blocks(self._file,  self._pre_key(key), value, self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size, timestamp, self._ts_bytes_len)
-                self._n_keys += n_extra_keys
+                self._write_data_block(self._pre_key(key), value, timestamp, index_values=index_values)
         else:
             raise ValueError('File is open for read only.')
 
 
+    def open_writer(self, key, size=None, timestamp=None):
+        """
+        Open a write-only file-like object that streams a value straight to the end of the file instead of through the write buffer, so values that are larger than memory can be written in chunks. The bytes written are the raw (serialized) value, so it's meant for the bytes serializer or for values that are serialized in chunks. If the size of the value is known, pass it and the writer checks that exactly that many bytes were written. The value is added when the writer is closed. If an exception is raised within its with block (or abort is called), the value is discarded. Other writes to the booklet wait until the writer is closed, so it should always be used as a context manager. Files with compression or value indexes are not supported.
+        """
+        if not self.writable:
+            raise ValueError('File is open for read only.')
+        if self._codec is not None:
+            raise ValueError('Values can not be streamed to a file with compression.')
+        if self._value_indexes:
+            raise ValueError('Values can not be streamed to a file with value indexes.')
+        if self._blobs is not None:
+            raise ValueError('Values can not be streamed to a file with deduplicated values.')
+
+        return ValueWriter(self, self._pre_key(key), size, timestamp)
+
+    def _link_data_block(self, key_hash, key_bytes, data_block_pos, ts_int):
+        """
+        Add a data block that has been written straight to the file (by a ValueWriter) to the index. The _thread_lock must be held by the caller and the buffers must be empty.
+        """
+        self._acquire_write_lock()
+        try:
+            self._n_keys += utils.update_index(self._file, bytearray(key_hash + utils.int_to_bytes(data_block_pos, utils.n_bytes_file)), {key_hash}, self._n_buckets)
+            self._file.seek(self._n_keys_pos)
+            self._file.write(utils.int_to_bytes(self._n_keys, 4))
+            if self._ts_index:
+                self._ts_index_entries.append((ts_int, data_block_pos))
+            if self._key_index:
+                self._key_index_entries.append((self._order_key(key_bytes), data_block_pos))
+            self._flush_indexes()
+        finally:
+            self._release_write_lock()
+
     # def get_data(self, key, decode_value=True, default=None):
     #     """
 
     #     """
-    #     output = utils.get_value_ts(self._file, self._pre_key(key), self._n_buckets, True, True, self._ts_bytes_len)
+    #     output = utils.get_value_ts(self._file, self._pre_key(key), self._n_buckets, True, True, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
 
     #     if output:
     #         value, ts_int = output
@@ -299,44 +843,132 @@ class Booklet(MutableMapping):
     #         return default
 
 
-    def update(self, key_value_dict):
+    def update(self, key_value_dict, workers=None):
         """
-
+        Set many key/value pairs. The keys and values are serialized (and hashed) in chunks outside of the thread lock, so other threads can write while the serialization happens. The workers parameter is the number of threads to serialize with (None serializes in the calling thread). More than one worker is mainly useful for the compressed serializers, since zstd releases the GIL.
         """
         if self.writable:
-            with self._thread_lock:
-                for key, value in key_value_dict.items():
-                    n_extra_keys = utils.write_data_blocks(self._file, self._pre_key(key), self._pre_value(value), self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size, None, self._ts_bytes_len)
-                    self._n_keys += n_extra_keys
+            for chunk in self._iter_encoded_chunks(key_value_dict, workers):
+                with self._thread_lock:
+                    for key_hash, key_bytes, value_bytes, index_values in chunk:
+                        self._write_data_block(key_bytes, value_bytes, key_hash=key_hash, index_values=index_values)
 
         else:
             raise ValueError('File is open for read only.')
 
+    def _encode_item(self, item):
+        """
+        Serialize a key/value pair, hash the key, and extract the value index values.
+        """
+        key, value = item
+        key_bytes = self._pre_key(key)
+
+        return utils.hash_key(key_bytes), key_bytes, self._pre_value(value), self._extract_index_values(value)
+
+    def _extract_index_values(self, value):
+        """
+        Run the value index extractors on a value. Returns a dict of the encoded index values by index name, or None if there are no value indexes.
+        """
+        if self._value_indexes:
+            return {name: utils.encode_index_value(extract(value)) for name, extract in self._value_indexes.items()}
+
+    def _iter_encoded_chunks(self, key_value_dict, workers=None):
+        """
+        Iterate over lists of encoded items (from _encode_item) of encode_chunk_size length. With workers, the items are encoded in a thread pool.
+        """
+        items = iter(key_value_dict.items())
+        if workers:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                while True:
+                    chunk = utils.take(items, utils.encode_chunk_size)
+                    if not chunk:
+                        break
+                    yield list(executor.map(self._encode_item, chunk))
+        else:
+            while True:
+                chunk = utils.take(items, utils.encode_chunk_size)
+                if not chunk:
+                    break
+                yield [self._encode_item(item) for item in chunk]
+
 
     def prune(self, timestamp=None, reindex=False):
         """
-        Prunes the old keys and associated values. Returns the number of removed items. The method can also prune remove keys/values older than the timestamp. The user can also reindex the booklet file. False does no reindexing, True increases the n_buckets to a preassigned value, or an int of the n_buckets. True can only be used if the default n_buckets were used at original initialisation.
+        Prunes the old keys and associated values. Returns the number of removed items. The method can also prune remove keys/values older than the timestamp. If the file has a ttl and no timestamp is passed, then the expired items are removed. The user can also reindex the booklet file. False does no reindexing, True increases the n_buckets to a preassigned value, or an int of the n_buckets. True can only be used if the default n_buckets were used at original initialisation.
         """
         self.sync()
 
+        if (timestamp is None) and self._ttl:
+            timestamp = utils.get_min_timestamp(self._ttl)
+
         if self.writable:
 
             with self._thread_lock:
-                n_keys, removed_count, n_buckets = utils.prune_file(self._file, timestamp, reindex, self._n_buckets, self._n_bytes_file, self._n_bytes_key, self._n_bytes_value, self._write_buffer_size, self._ts_bytes_len, self._buffer_data, self._buffer_index, self._buffer_index_set)
-                self._n_keys = n_keys
-                self._file.seek(self._n_keys_pos)
-                self._file.write(utils.int_to_bytes(self._n_keys, 4))
-
-                if n_buckets != self._n_buckets:
-                    self._n_buckets = n_buckets
-                    self._file.seek(21)
-                    self._file.write(utils.int_to_bytes(n_buckets, 4))
-                    self._file.flush()
+                self._acquire_write_lock()
+                try:
+                    removed_count = self._prune_file(timestamp, reindex)
+                finally:
+                    self._release_write_lock()
 
             return removed_count
         else:
             raise ValueError('File is open for read only.')
 
+    def _prune_file(self, timestamp=None, reindex=False):
+        """
+        Prune the file and update the header. The _thread_lock and the write lock must be held by the caller.
+        """
+        n_keys, removed_count, n_buckets = utils.prune_file(self._file, timestamp, reindex, self._n_buckets, self._n_bytes_file, self._n_bytes_key, self._n_bytes_value, self._write_buffer_size, self._ts_bytes_len, self._buffer_data, self._buffer_index, self._buffer_index_set, self._key_width)
+        self._n_keys = n_keys
+        self._file.seek(self._n_keys_pos)
+        self._file.write(utils.int_to_bytes(self._n_keys, 4))
+
+        if n_buckets != self._n_buckets:
+            self._n_buckets = n_buckets
+            self._file.seek(21)
+            self._file.write(utils.int_to_bytes(n_buckets, 4))
+            self._file.flush()
+
+        # The data blocks have moved
+        self._unmap_file()
+        if self._ts_index:
+            self._ts_index_entries.clear()
+            utils.build_ts_index(self._ts_index_path, self._file, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        if self._key_index:
+            self._key_index_entries.clear()
+            utils.build_key_index(self._key_index_path, self._file, self._n_buckets, self._ts_bytes_len, self._order_key, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        for name, extract in self._value_indexes.items():
+            self._value_index_entries[name].clear()
+            utils.build_value_index(utils.get_value_index_path(self._file_path, name), self._file, self._n_buckets, self._ts_bytes_len, lambda value: extract(self._post_value(value)), n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        if self._blobs is not None:
+            self._prune_blobs()
+
+        return removed_count
+
+    def _prune_blobs(self):
+        """
+        Remove the values from the blobs file that no item refers to anymore and prune it. The _thread_lock and the write lock must be held by the caller.
+        """
+        value_hashes = set(utils.iter_keys_values(self._file, self._n_buckets, False, True, False, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width))
+        self._blobs.delete_many([value_hash for value_hash in self._blobs.keys() if value_hash not in value_hashes])
+        self._blobs.prune()
+
+    def _evict(self):
+        """
+        Remove the oldest items (by their timestamps) if the file has more than max_keys items or is larger than max_bytes. The file is reduced to the evict_fraction of the limits so that the eviction doesn't run on every sync.
+        """
+        with self._thread_lock:
+            self._acquire_write_lock()
+            try:
+                over_keys = (self._max_keys is not None) and (self._n_keys > self._max_keys)
+                over_bytes = (self._max_bytes is not None) and (self._file.seek(0, 2) > self._max_bytes)
+                if over_keys or over_bytes:
+                    timestamp = utils.get_eviction_timestamp(self._file, self._n_buckets, self._ts_bytes_len, self._max_keys, self._max_bytes, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+                    if timestamp is not None:
+                        self._prune_file(timestamp)
+            finally:
+                self._release_write_lock()
+
 
     def __getitem__(self, key):
         value = self.get(key)
@@ -355,21 +987,60 @@ class Booklet(MutableMapping):
         """
         Delete flags are written immediately as are the number of total deletes. This ensures that there are no sync issues. Deletes are generally rare, so this shouldn't impact most use cases.
         """
+        if not self._delete_key(self._pre_key(key)):
+            raise KeyError(key)
+
+    def _delete_key(self, key_bytes):
+        """
+        Delete the serialized key. Returns True if it existed.
+        """
         if self.writable:
             if self._buffer_index_set:
                 self.sync()
 
-            key_bytes = self._pre_key(key)
             key_hash = utils.hash_key(key_bytes)
 
             with self._thread_lock:
-                del_bool = utils.assign_delete_flag(self._file, key_hash, self._n_buckets)
-                if del_bool:
-                    self._n_keys -= 1
-                    self._file.seek(self._n_keys_pos)
-                    self._file.write(utils.int_to_bytes(self._n_keys, 4))
-                else:
-                    raise KeyError(key)
+                self._acquire_write_lock()
+                try:
+                    del_bool = utils.assign_delete_flag(self._file, key_hash, self._n_buckets)
+                    if del_bool:
+                        self._n_keys -= 1
+                        self._file.seek(self._n_keys_pos)
+                        self._file.write(utils.int_to_bytes(self._n_keys, 4))
+                finally:
+                    self._release_write_lock()
+
+            return del_bool
+        else:
+            raise ValueError('File is open for read only.')
+
+    def delete_many(self, keys):
+        """
+        Delete many keys at once. The keys are grouped by bucket so that each bucket chain is only walked once, and the n_keys in the header is only written once. The buffer is only synced if it contains any of the keys. Keys that don't exist are ignored. Returns the number of deleted keys.
+        """
+        return self._delete_key_hashes({utils.hash_key(self._pre_key(key)) for key in keys})
+
+    def _delete_key_hashes(self, key_hashes):
+        """
+        Delete the keys of the key hashes. Returns the number of deleted keys.
+        """
+        if self.writable:
+            if not key_hashes.isdisjoint(self._buffer_index_set):
+                self.sync()
+
+            with self._thread_lock:
+                self._acquire_write_lock()
+                try:
+                    n_deleted = utils.assign_delete_flags(self._file, key_hashes, self._n_buckets)
+                    if n_deleted:
+                        self._n_keys -= n_deleted
+                        self._file.seek(self._n_keys_pos)
+                        self._file.write(utils.int_to_bytes(self._n_keys, 4))
+                finally:
+                    self._release_write_lock()
+
+            return n_deleted
         else:
             raise ValueError('File is open for read only.')
 
@@ -382,18 +1053,68 @@ class Booklet(MutableMapping):
     def clear(self):
         if self.writable:
             with self._thread_lock:
-                utils.clear(self._file, self._n_buckets, self._n_keys_pos, self._write_buffer_size)
-                self._n_keys = 0
-                self._file.seek(self._n_keys_pos)
-                self._file.write(utils.int_to_bytes(self._n_keys, 4))
+                self._acquire_write_lock()
+                try:
+                    utils.clear(self._file, self._n_buckets, self._n_keys_pos, self._write_buffer_size)
+                    self._unmap_file()
+                    self._n_keys = 0
+                    self._file.seek(self._n_keys_pos)
+                    self._file.write(utils.int_to_bytes(self._n_keys, 4))
+                    if self._ts_index:
+                        self._ts_index_entries.clear()
+                        utils.write_index_file(self._ts_index_path, utils.make_ts_index_run([]))
+                    if self._key_index:
+                        self._key_index_entries.clear()
+                        utils.write_index_file(self._key_index_path, utils.make_key_index_run([]))
+                    for name, entries in self._value_index_entries.items():
+                        entries.clear()
+                        utils.write_index_file(utils.get_value_index_path(self._file_path, name), utils.make_key_index_run([]))
+                finally:
+                    self._release_write_lock()
+
+                if self._zstd_dict is not None:
+                    # The values that are written next still use the dictionary
+                    self._write_reserved_block(utils.zstd_dict_key_bytes, self._zstd_dict)
+
+                if self._namespaces:
+                    # The namespaces are kept, but their items are removed
+                    self._write_reserved_block(utils.namespaces_key_bytes, utils.encode_metadata(self._namespaces))
+
+            if self._blobs is not None:
+                self._blobs.clear()
         else:
             raise ValueError('File is open for read only.')
 
-    def close(self):
-        self.sync()
-        portalocker.lock(self._file, portalocker.LOCK_UN)
-        self._file.close()
+    def refresh(self):
+        """
+        Read the parts of the header that other processes can change (n_buckets, n_keys, and the committed data end and generation) without reopening the file. This is a single small read when the file is not being modified. Returns True if the file has changed since the header was last read.
+        """
+        if self.writable and (self._lock_mode == 'session'):
+            return False
+
+        if self._blobs is not None:
+            self._blobs.refresh()
+
+        old_state = (self._n_buckets, self._n_keys, self._data_end, self._generation)
+
+        if self._lock_mode == 'operation':
+            self._read_committed(lambda: None)
+        else:
+            self._read_header_state()
+            if (self._generation is not None) and (self._generation % 2):
+                # Wait for the writer to commit
+                self._read_committed(lambda: None)
+
+        return old_state != (self._n_buckets, self._n_keys, self._data_end, self._generation)
+
+    def close(self):
+        self.sync()
+        self._unmap_file()
+        portalocker.lock(self._file, portalocker.LOCK_UN)
+        self._file.close()
         self._finalizer.detach()
+        if self._blobs is not None:
+            self._blobs.close()
 
     # def __del__(self):
     #     self.close()
@@ -404,19 +1125,34 @@ class Booklet(MutableMapping):
         """
         Reopens the file on a previously initialized Booklet. The flag must be either 'r' or 'w'.
         """
+        utils.check_lock_mode(self._lock_mode, flag == 'w')
         self.close()
         if flag == 'w':
             self._file = io.open(self._file_path, 'r+b', buffering=0)
-            portalocker.lock(self._file, portalocker.LOCK_EX)
             self.writable = True
         elif flag == 'r':
             self._file = io.open(self._file_path, 'rb', buffering=0)
-            portalocker.lock(self._file, portalocker.LOCK_SH)
             self.writable = False
         else:
             raise ValueError("flag must be either 'r' or 'w'.")
 
-        self._finalizer = weakref.finalize(self, utils.close_files, self._file, utils.n_keys_crash, self._n_keys_pos, self.writable)
+        if self.writable:
+            portalocker.lock(self._file, portalocker.LOCK_EX)
+        elif self._lock_mode != 'none':
+            portalocker.lock(self._file, portalocker.LOCK_SH)
+
+        ## Other processes might have changed the file while it was closed
+        if (self._lock_mode != 'session') or (self._generation is not None):
+            self._read_header_state()
+        if self.writable and (self._generation is not None):
+            self._generation += self._generation % 2
+            self._data_end = utils.end_commit(self._file, self._generation)
+        utils.release_session_lock(self._file, self._lock_mode)
+
+        self._finalizer = weakref.finalize(self, utils.close_files, self._file, utils.n_keys_crash, self._n_keys_pos, self.writable and (self._lock_mode == 'session'))
+
+        if self._blobs is not None:
+            self._blobs = self._open_blobs(flag)
 
 
     def sync(self):
@@ -425,12 +1161,212 @@ class Booklet(MutableMapping):
         """
         if self.writable:
             with self._thread_lock:
+                self._flush_buffers()
+                self._file.flush()
+
+            if (self._max_keys is not None) or (self._max_bytes is not None):
+                self._evict()
+
+    def _write_data_block(self, key_bytes, value_bytes, timestamp=None, key_hash=None, index_values=None):
+        """
+        Append a data block to the write buffer. If the data block doesn't fit in the buffer, then the buffer is flushed first so that all writes to the file go through _flush_buffers. The index_values (from _extract_index_values) are kept in the same order as the data blocks in the buffer until they are flushed. In a file with deduplicated values, the value is added to the blobs file and the data block gets the value hash. The _thread_lock must be held by the caller.
+        """
+        if self._value_indexes and (index_values is None):
+            index_values = self._extract_index_values(self._value_serializer.loads(self._decompress(value_bytes)))
+
+        if self._blobs is not None:
+            value_bytes = self._add_blob(value_bytes)
+
+        if self._buffer_data:
+            data_block_len = utils.get_data_block_len(len(key_bytes), len(value_bytes), self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+            if (len(self._buffer_data) + data_block_len) > self._write_buffer_size:
+                self._flush_buffers()
+
+        n_extra_keys = utils.write_data_blocks(self._file, key_bytes, value_bytes, self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size, timestamp, self._ts_bytes_len, key_hash, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        self._n_keys += n_extra_keys
+
+        if self._value_indexes:
+            self._buffer_index_values.append(index_values)
+
+    def _flush_buffers(self):
+        """
+        Write the data buffer to the end of the file and update the index. The blobs are synced first so that the items in the file never refer to values that aren't in the blobs file yet. The _thread_lock must be held by the caller.
+        """
+        if self._blobs is not None:
+            self._blobs.sync()
+
+        if self._buffer_index or self._ts_index_entries:
+            self._acquire_write_lock()
+            try:
                 if self._buffer_index:
-                    utils.flush_data_buffer(self._file, self._buffer_data, self._file.seek(0, 2))
+                    write_pos = self._file.seek(0, 2)
+                    if self._lock_mode != 'session':
+                        # Other processes might have appended to the file since the data blocks were buffered
+                        utils.rebase_buffer_index(self._buffer_data, self._buffer_index, write_pos, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+                    if self._ts_index or self._key_index or self._value_indexes:
+                        buffer_entries = utils.get_buffer_entries(self._buffer_data, self._buffer_index, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+                        for data_block_pos, key, ts_int in buffer_entries:
+                            if self._ts_index:
+                                self._ts_index_entries.append((ts_int, data_block_pos))
+                            if self._key_index:
+                                self._key_index_entries.append((self._order_key(key), data_block_pos))
+                        if self._value_indexes:
+                            for (data_block_pos, _, _), index_values in zip(buffer_entries, self._buffer_index_values):
+                                for name, index_value in index_values.items():
+                                    if index_value is not None:
+                                        self._value_index_entries[name].append((index_value, data_block_pos))
+                            self._buffer_index_values.clear()
+                    utils.flush_data_buffer(self._file, self._buffer_data, write_pos)
                     self._sync_index()
                     self._file.seek(self._n_keys_pos)
                     self._file.write(utils.int_to_bytes(self._n_keys, 4))
-                self._file.flush()
+                self._flush_indexes()
+            finally:
+                self._release_write_lock()
+
+    def _flush_indexes(self):
+        """
+        Append the new entries to the timestamp, key, and value indexes as sorted runs. The runs are merged once there are too many of them. The _thread_lock and the write lock must be held by the caller.
+        """
+        if self._ts_index_entries:
+            n_runs = utils.append_index_run(self._ts_index_path, utils.make_ts_index_run(self._ts_index_entries), utils.read_ts_index_runs)
+            self._ts_index_entries.clear()
+            if n_runs > utils.index_max_runs:
+                utils.compact_ts_index(self._ts_index_path, self._file, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+        if self._key_index_entries:
+            n_runs = utils.append_index_run(self._key_index_path, utils.make_key_index_run(self._key_index_entries), utils.read_key_index_runs)
+            self._key_index_entries.clear()
+            if n_runs > utils.index_max_runs:
+                utils.compact_key_index(self._key_index_path, self._file, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+        for name, entries in self._value_index_entries.items():
+            if entries:
+                value_index_path = utils.get_value_index_path(self._file_path, name)
+                n_runs = utils.append_index_run(value_index_path, utils.make_key_index_run(entries), utils.read_key_index_runs)
+                entries.clear()
+                if n_runs > utils.index_max_runs:
+                    utils.compact_key_index(value_index_path, self._file, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+    def _acquire_write_lock(self):
+        """
+        Take the exclusive file lock before writing to the file. In the session lock mode the lock is held for the life of the handle. In the operation lock mode another process might have changed the file while the lock was released, so the header state is read again. An odd generation is then written so that readers without locks know that the file is being modified.
+        """
+        if self._lock_mode != 'session':
+            portalocker.lock(self._file, portalocker.LOCK_EX)
+            self._read_header_state()
+
+        if self._generation is not None:
+            self._generation += 1
+            utils.begin_commit(self._file, self._generation)
+
+    def _release_write_lock(self):
+        """
+        Commit the data end and an even generation, then release the exclusive file lock in the operation lock mode.
+        """
+        if self._generation is not None:
+            self._generation += 1
+            self._data_end = utils.end_commit(self._file, self._generation)
+
+        if self._lock_mode != 'session':
+            portalocker.lock(self._file, portalocker.LOCK_UN)
+
+    def _read_committed(self, read_func):
+        """
+        Run read_func on a consistent state of the file. The session lock mode runs it directly. The operation lock mode holds a shared file lock and reads the header state again beforehand. The none lock mode takes no locks; it reads the header state and retries read_func until the generation was even and unchanged over the whole read.
+        """
+        if self._lock_mode == 'session':
+            return read_func()
+        elif self._lock_mode == 'operation':
+            portalocker.lock(self._file, portalocker.LOCK_SH)
+            try:
+                self._read_header_state()
+                return read_func()
+            finally:
+                portalocker.lock(self._file, portalocker.LOCK_UN)
+
+        start = time.monotonic()
+        while True:
+            self._read_header_state()
+            generation = self._generation
+            if generation % 2 == 0:
+                try:
+                    output = read_func()
+                except Exception:
+                    # The writer may have changed the data blocks mid read
+                    if utils.read_generation(self._file) == generation:
+                        raise
+                else:
+                    if utils.read_generation(self._file) == generation:
+                        return output
+
+            if (time.monotonic() - start) > utils.commit_timeout:
+                raise TimeoutError('The file has been modified by a writer for longer than {} seconds. The writer might not have closed the file properly.'.format(utils.commit_timeout))
+
+            time.sleep(0)
+
+    def _data_block_range(self):
+        """
+        The start and end positions of the data blocks. In the none lock mode the end is the committed data end.
+        """
+        start = utils.sub_index_init_pos + (self._n_buckets * utils.n_bytes_file)
+        if self._lock_mode == 'none':
+            end = self._data_end
+        else:
+            end = self._file.seek(0, 2)
+
+        return start, end
+
+    def _iter_data_blocks(self, include_key, include_value, include_ts, key_filter=None, value_filter=None, since=None, value_pos=False, key_prefix=None):
+        """
+        Create the iterator of the data blocks. Iterators are not snapshots, so items changed while iterating might be skipped. If a key_prefix is passed, only the data blocks of the namespace with the key prefix are iterated over (and the key_filter is called without the prefix). Otherwise the data blocks of the namespaces are skipped.
+        """
+        if key_prefix is not None:
+            key_filter = utils.make_prefix_filter(key_prefix, key_filter)
+        else:
+            key_filter = self._exclude_namespaces(key_filter)
+
+        start, end = self._read_committed(self._data_block_range)
+
+        min_timestamp = utils.get_min_timestamp(self._ttl)
+        if since is not None:
+            if not self._init_timestamps:
+                raise ValueError('timestamps were not initialized with this file.')
+            since = utils.make_timestamp_int(since)
+            if (min_timestamp is None) or (since > min_timestamp):
+                min_timestamp = since
+
+        if (value_filter is not None) and (self._blobs is not None):
+            # The raw value filter is called with the value rather than the value hash
+            raw_value_filter = value_filter
+            value_filter = lambda value: raw_value_filter(self._deref_value(value))
+
+        return utils.iter_keys_value_from_start_end_pos(self._file, start, end, include_key, include_value, include_ts, self._ts_bytes_len, min_timestamp, key_filter, value_filter, value_pos, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+    def _exclude_namespaces(self, key_filter=None):
+        """
+        Wrap the key_filter so that the data blocks of the namespaces are skipped, since they are not items of the booklet. The key_filter is only wrapped if the file has namespaces, because a key_filter makes the iterators read the keys and values separately.
+        """
+        if not self._namespaces:
+            return key_filter
+
+        if key_filter is None:
+            return lambda key: not key.startswith(utils.namespace_key_prefix)
+        else:
+            return lambda key: (not key.startswith(utils.namespace_key_prefix)) and key_filter(key)
+
+    def _read_header_state(self):
+        """
+        Read the parameters in the header that can be changed by other processes.
+        """
+        n_buckets, n_keys, data_end, generation = utils.read_header_state(self._file)
+        self._n_buckets = n_buckets
+        if n_keys == utils.n_keys_crash:
+            n_keys = utils.count_keys(self._file, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        self._n_keys = n_keys
+        if self._generation is not None:
+            self._data_end = data_end
+            self._generation = generation
 
     def _sync_index(self):
         n_extra_keys = utils.update_index(self._file, self._buffer_index, self._buffer_index_set, self._n_buckets)
@@ -454,6 +1390,351 @@ class Booklet(MutableMapping):
 
 
 
+#######################################################
+### Lazy value
+
+_unloaded = object()
+
+
+class LazyValue:
+    """
+    A value returned by the iterators with lazy=True. It only holds the position and length of the value in the file. The value is read (and deserialized if decode_value is True) when the value attribute is first accessed. The value must be accessed before the booklet is closed, and a prune or clear of the file invalidates it.
+    """
+    __slots__ = ('_booklet', '_value_pos', 'value_len', '_decode_value', '_value')
+
+    def __init__(self, booklet, value_pos, value_len, decode_value=True):
+        self._booklet = booklet
+        self._value_pos = value_pos
+        self.value_len = value_len
+        self._decode_value = decode_value
+        self._value = _unloaded
+
+    @property
+    def value(self):
+        if self._value is _unloaded:
+            booklet = self._booklet
+            value = booklet._read_committed(lambda: utils.read_bytes(booklet._file, self._value_pos, self.value_len))
+            if self._decode_value:
+                value = booklet._post_value(value)
+            else:
+                value = booklet._deref_value(value)
+            self._value = value
+
+        return self._value
+
+    def __repr__(self):
+        if self._value is _unloaded:
+            return '<LazyValue of {} bytes>'.format(self.value_len)
+        else:
+            return '<LazyValue {!r}>'.format(self._value)
+
+
+class ValueReader(io.RawIOBase):
+    """
+    A read-only file-like object over the raw value of a key. Use the open_value method of the Booklet to get one.
+    """
+    def __init__(self, booklet, value_pos, value_len):
+        self._booklet = booklet
+        self._value_pos = value_pos
+        self.value_len = value_len
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.value_len + offset
+        else:
+            raise ValueError('Invalid whence ({}).'.format(whence))
+
+        if pos < 0:
+            raise ValueError('Negative seek position {}.'.format(pos))
+        self._pos = pos
+
+        return self._pos
+
+    def readinto(self, b):
+        n_bytes = min(len(b), max(self.value_len - self._pos, 0))
+        if n_bytes == 0:
+            return 0
+
+        booklet = self._booklet
+        pos = self._value_pos + self._pos
+        data = booklet._read_committed(lambda: utils.read_bytes(booklet._file, pos, n_bytes))
+        b[:len(data)] = data
+        self._pos += len(data)
+
+        return len(data)
+
+
+class ValueWriter(io.RawIOBase):
+    """
+    A write-only file-like object that streams a value to the end of the file. Use the open_writer method of the Booklet to get one. The booklet can't be written to by other threads until the writer is closed. In the operation lock mode, the file is exclusively locked until the writer is closed.
+    """
+    def __init__(self, booklet, key_bytes, size=None, timestamp=None):
+        self._max_size = 2**(8 * booklet._n_bytes_value) - 1
+        if (size is not None) and not (0 <= size <= self._max_size):
+            raise ValueError('The size must be between 0 and {}.'.format(self._max_size))
+
+        self._booklet = booklet
+        self._key_bytes = key_bytes
+        self._key_hash = utils.hash_key(key_bytes)
+        self._size = size
+        self._n_bytes = 0
+        self._ts_int = utils.make_timestamp_int(timestamp)
+
+        booklet._thread_lock.acquire()
+        try:
+            booklet._flush_buffers()
+            if booklet._lock_mode != 'session':
+                portalocker.lock(booklet._file, portalocker.LOCK_EX)
+            try:
+                self._data_block_pos = utils.write_data_block_head(booklet._file, self._key_hash, key_bytes, size or 0, self._ts_int, booklet._ts_bytes_len, n_bytes_key=booklet._n_bytes_key, n_bytes_value=booklet._n_bytes_value, key_width=booklet._key_width)
+            except BaseException:
+                if booklet._lock_mode != 'session':
+                    portalocker.lock(booklet._file, portalocker.LOCK_UN)
+                raise
+        except BaseException:
+            booklet._thread_lock.release()
+            raise
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('The writer is closed.')
+
+        n_bytes = len(memoryview(b).cast('B'))
+        if (self._size is not None) and (self._n_bytes + n_bytes > self._size):
+            raise ValueError('More than the size of {} bytes were written.'.format(self._size))
+        if self._n_bytes + n_bytes > self._max_size:
+            raise ValueError('The value is too large.')
+
+        self._booklet._file.seek(0, 2)
+        self._booklet._file.write(b)
+        self._n_bytes += n_bytes
+
+        return n_bytes
+
+    def _finish(self, live):
+        """
+        Write the final value length and add the data block to the booklet if live. Otherwise the data block is left as a deleted data block (removed on the next prune).
+        """
+        booklet = self._booklet
+        try:
+            utils.finish_data_block(booklet._file, self._data_block_pos, len(self._key_bytes), self._n_bytes, live, n_bytes_key=booklet._n_bytes_key, n_bytes_value=booklet._n_bytes_value, key_width=booklet._key_width)
+            if live:
+                booklet._link_data_block(self._key_hash, self._key_bytes, self._data_block_pos, self._ts_int)
+        finally:
+            if booklet._lock_mode != 'session':
+                portalocker.lock(booklet._file, portalocker.LOCK_UN)
+            booklet._thread_lock.release()
+
+    def close(self):
+        """
+        Finish the value and add it to the booklet.
+        """
+        if not self.closed:
+            try:
+                if (self._size is not None) and (self._n_bytes != self._size):
+                    self._finish(False)
+                    raise ValueError('Only {} of the size of {} bytes were written, so the value was discarded.'.format(self._n_bytes, self._size))
+                self._finish(True)
+            finally:
+                super().close()
+
+    def abort(self):
+        """
+        Discard the value.
+        """
+        if not self.closed:
+            try:
+                self._finish(False)
+            finally:
+                super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+#######################################################
+### Value index
+
+
+class ValueIndex:
+    """
+    A secondary index over the values of a Booklet. Use the index method of the Booklet to get one.
+    """
+    def __init__(self, booklet, name):
+        self._booklet = booklet
+        self.name = name
+
+    def get(self, index_value):
+        """
+        Return a list of the keys whose values have the index_value.
+        """
+        return [key for key, _ in self._booklet._iter_value_index(self.name, index_value, False)]
+
+    def items(self, index_value):
+        """
+        Return an iterator of (key, value) for the values that have the index_value.
+        """
+        return self._booklet._iter_value_index(self.name, index_value, True)
+
+
+class Namespace(MutableMapping):
+    """
+    A separate mapping with its own serializers and keys in the file of a Booklet. Use the namespace method of the Booklet to get one. It shares the file lock, the write buffer, the compression, and the ttl with the booklet, and it's synced and closed with the booklet.
+    """
+    def __init__(self, booklet, name, key_serializer, value_serializer):
+        self._booklet = booklet
+        self.name = name
+        self._key_serializer = key_serializer
+        self._value_serializer = value_serializer
+        self._key_prefix = utils.get_namespace_prefix(name)
+
+    @property
+    def writable(self):
+        return self._booklet.writable
+
+    def _pre_key(self, key) -> bytes:
+        return self._key_prefix + self._key_serializer.dumps(key)
+
+    def _post_key(self, key: bytes):
+        return self._key_serializer.loads(key[len(self._key_prefix):])
+
+    def _pre_value(self, value) -> bytes:
+        return self._booklet._compress(self._value_serializer.dumps(value))
+
+    def _post_value(self, value: bytes):
+        booklet = self._booklet
+        return self._value_serializer.loads(booklet._decompress(booklet._deref_value(value)))
+
+    def keys(self, key_filter=None, since=None):
+        """
+        Return an iterator of the keys. See the items method of the booklet for the key_filter and since parameters.
+        """
+        if self._booklet._buffer_index_set:
+            self._booklet.sync()
+
+        for key in self._booklet._iter_data_blocks(True, False, False, key_filter, None, since, key_prefix=self._key_prefix):
+            yield self._post_key(key)
+
+    def items(self, key_filter=None, raw_value_filter=None, since=None):
+        """
+        Return an iterator of (key, value). See the items method of the booklet for the parameters.
+        """
+        if self._booklet._buffer_index_set:
+            self._booklet.sync()
+
+        for key, value in self._booklet._iter_data_blocks(True, True, False, key_filter, raw_value_filter, since, key_prefix=self._key_prefix):
+            yield self._post_key(key), self._post_value(value)
+
+    def values(self, raw_value_filter=None, since=None):
+        """
+        Return an iterator of the values. See the items method of the booklet for the parameters.
+        """
+        for _, value in self.items(None, raw_value_filter, since):
+            yield value
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        """
+        The number of items is not saved for each namespace, so the keys are counted.
+        """
+        return sum(1 for _ in self._booklet._iter_data_blocks(True, False, False, key_prefix=self._key_prefix))
+
+    def __contains__(self, key):
+        return self._booklet._contains_key(self._pre_key(key))
+
+    def get(self, key, default=None):
+        value = self._booklet._get_saved_value(self._pre_key(key))
+
+        if value:
+            return self._post_value(value)
+        else:
+            return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+
+        if value is None:
+            raise KeyError(key)
+        else:
+            return value
+
+    def set(self, key, value, timestamp=None):
+        """
+        Set a key/value pair. Optionally assign a specific timestamp (see the set method of the booklet).
+        """
+        booklet = self._booklet
+        if booklet.writable:
+            value = self._pre_value(value)
+            with booklet._thread_lock:
+                booklet._write_data_block(self._pre_key(key), value, timestamp)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def update(self, key_value_dict):
+        """
+        Set many key/value pairs.
+        """
+        booklet = self._booklet
+        if booklet.writable:
+            items = iter(key_value_dict.items())
+            while True:
+                chunk = [(self._pre_key(key), self._pre_value(value)) for key, value in utils.take(items, utils.encode_chunk_size)]
+                if not chunk:
+                    break
+                with booklet._thread_lock:
+                    for key_bytes, value_bytes in chunk:
+                        booklet._write_data_block(key_bytes, value_bytes)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def __delitem__(self, key):
+        if not self._booklet._delete_key(self._pre_key(key)):
+            raise KeyError(key)
+
+    def delete_many(self, keys):
+        """
+        Delete many keys at once. Keys that don't exist are ignored. Returns the number of deleted keys.
+        """
+        return self._booklet._delete_key_hashes({utils.hash_key(self._pre_key(key)) for key in keys})
+
+    def clear(self):
+        """
+        Delete all of the items of the namespace.
+        """
+        self.delete_many(list(self.keys()))
+
+    def sync(self):
+        """
+        Sync the booklet (and so all of its namespaces) to disk.
+        """
+        self._booklet.sync()
+
+
 #######################################################
 ### Variable length value Booklet
 
@@ -484,6 +1765,51 @@ class VariableLengthValue(Booklet):
         The buffer memory size in bytes used for writing. Writes are first written to a block of memory, then once the buffer if filled up it writes to disk. This is to reduce the number of writes to disk and consequently the CPU write overhead.
         This is only used when the file is open for writing.
 
+    init_timestamps : bool
+        Should timestamps be initialized in the object? This cannot be changed later.
+
+    lock_mode : str
+        How the file locks are held. See the open function for details.
+
+    ttl : int, float, or None
+        The time to live of the items in seconds. See the open function for details.
+
+    max_keys : int or None
+        The maximum number of items. See the open function for details.
+
+    max_bytes : int or None
+        The maximum file size in bytes. See the open function for details.
+
+    ts_index : bool
+        Create a timestamp index for items_since and keys_since. See the open function for details.
+
+    key_index : bool
+        Create a key index for range and prefix. See the open function for details.
+
+    indexes : dict or None
+        Secondary indexes over the values as a dict of index name to extractor function. See the open function for details.
+
+    zstd_dict : bytes or None
+        A trained zstd dictionary to compress the values with. See the open function for details.
+
+    compression : str or None
+        Compress the serialized values with zstd or lz4. See the open function for details.
+
+    compression_level : int or None
+        The compression level. See the open function for details.
+
+    compression_threads : int or None
+        The number of threads to compress large values with zstd. See the open function for details.
+
+    n_bytes_key : int
+        The number of bytes of the key lengths. See the open function for details.
+
+    n_bytes_value : int
+        The number of bytes of the value lengths. See the open function for details.
+
+    dedup : bool
+        Store each distinct value only once. See the open function for details.
+
     Returns
     -------
     Booklet
@@ -507,11 +1833,17 @@ class VariableLengthValue(Booklet):
     +---------+-------------------------------------------+
 
     """
-    def __init__(self, file_path: Union[str, pathlib.Path], flag: str = "r", key_serializer: str = None, value_serializer: str = None, n_buckets: int=12007, buffer_size: int = 2**22, init_timestamps=True, init_bytes=None):
+    def __init__(self, file_path: Union[str, pathlib.Path], flag: str = "r", key_serializer: str = None, value_serializer: str = None, n_buckets: int=12007, buffer_size: int = 2**22, init_timestamps=True, init_bytes=None, lock_mode: str = 'session', ttl=None, max_keys: int=None, max_bytes: int=None, ts_index: bool=False, key_index: bool=False, indexes: dict=None, zstd_dict: bytes=None, compression: str=None, compression_level: int=None, compression_threads: int=None, n_bytes_key: int=2, n_bytes_value: int=4, dedup: bool=False):
         """
 
         """
-        utils.init_files_variable(self, file_path, flag, key_serializer, value_serializer, n_buckets, buffer_size, init_timestamps, init_bytes)
+        utils.init_files_variable(self, file_path, flag, key_serializer, value_serializer, n_buckets, buffer_size, init_timestamps, init_bytes, lock_mode, ttl, max_keys, max_bytes, ts_index, key_index, indexes, n_bytes_key, n_bytes_value, dedup)
+
+        try:
+            self._init_compression(compression, compression_level, compression_threads, zstd_dict)
+        except Exception:
+            self.close()
+            raise
 
 
 ### Alias
@@ -575,17 +1907,23 @@ class FixedLengthValue(Booklet):
         utils.init_files_fixed(self, file_path, flag, key_serializer, value_len, n_buckets, buffer_size, init_bytes)
 
 
-    def keys(self):
+    def keys(self, key_filter=None):
         for key in utils.iter_keys_values_fixed(self._file, self._n_buckets, True, False, self._value_len):
-            yield self._post_key(key)
+            if (key_filter is None) or key_filter(key):
+                yield self._post_key(key)
 
-    def items(self):
+    def items(self, key_filter=None, raw_value_filter=None):
+        """
+        Return an iterator of (key, value). The key_filter and raw_value_filter are functions that are called with the serialized key or value bytes and return False to skip the item before it's deserialized.
+        """
         for key, value in utils.iter_keys_values_fixed(self._file, self._n_buckets, True, True, self._value_len):
-            yield self._post_key(key), self._post_value(value)
+            if ((key_filter is None) or key_filter(key)) and ((raw_value_filter is None) or raw_value_filter(value)):
+                yield self._post_key(key), self._post_value(value)
 
-    def values(self):
+    def values(self, raw_value_filter=None):
         for value in utils.iter_keys_values_fixed(self._file, self._n_buckets, False, True, self._value_len):
-            yield self._post_value(value)
+            if (raw_value_filter is None) or raw_value_filter(value):
+                yield self._post_value(value)
 
     def get(self, key, default=None):
         key_bytes = self._pre_key(key)
@@ -601,18 +1939,41 @@ class FixedLengthValue(Booklet):
         else:
             return self._post_value(value)
 
+    def get_many(self, keys, default=None):
+        """
+        Return an iterator of (key, value) for the requested keys. The default is returned as the value for keys that do not exist.
+        """
+        if self._buffer_index:
+            self.sync()
+
+        for key in keys:
+            key_hash = utils.hash_key(self._pre_key(key))
+            value = utils.get_value_fixed(self._file, key_hash, self._n_buckets, self._value_len)
+
+            if value:
+                yield key, self._post_value(value)
+            else:
+                yield key, default
+
+    def changes_since(self, token=None):
+        """
+        Not available for fixed length values, since overwrites are written back to the same location in the file.
+        """
+        raise ValueError('changes_since is only available for variable length values.')
+
     # def __len__(self):
     #     return self._n_keys
 
-    def update(self, key_value_dict):
+    def update(self, key_value_dict, workers=None):
         """
-
+        Set many key/value pairs. See Booklet.update for details.
         """
         if self.writable:
-            with self._thread_lock:
-                for key, value in key_value_dict.items():
-                    n_extra_keys = utils.write_data_blocks_fixed(self._file, self._pre_key(key), self._pre_value(value), self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size)
-                    self._n_keys += n_extra_keys
+            for chunk in self._iter_encoded_chunks(key_value_dict, workers):
+                with self._thread_lock:
+                    for key_hash, key_bytes, value_bytes, _ in chunk:
+                        n_extra_keys = utils.write_data_blocks_fixed(self._file, key_bytes, value_bytes, self._n_buckets, self._buffer_data, self._buffer_index, self._buffer_index_set, self._write_buffer_size)
+                        self._n_keys += n_extra_keys
 
         else:
             raise ValueError('File is open for read only.')
@@ -657,12 +2018,435 @@ class FixedLengthValue(Booklet):
             raise ValueError('File is open for read only.')
 
 
+#######################################################
+### Sharded Booklet
+
+
+class ShardedBooklet(MutableMapping):
+    """
+    Open a directory of booklet shards for reading and writing. Keys are routed by their hash to one of n_shards VariableLengthValue files. Shards are only opened for writing (and exclusively locked) when they are first written to, so independent processes can write to different shards at the same time. Reads of shards that haven't been written to only hold a shared lock while the read is happening. Like the single file booklet, a read of a shard that another process has open for writing will wait until that process has closed it (unless lock_mode='none' is used for reading). The shard count and serializers are saved in a manifest file in the directory, so subsequent reads and writes only need the dir_path and flag (unless a custom serializer is passed).
+
+    Parameters
+    -----------
+    dir_path : str or pathlib.Path
+        It must be a path to a local directory. It will be created if it doesn't exist.
+
+    flag : str
+        Flag associated with how the shards are opened according to the dbm style. See the open function for details.
+
+    key_serializer : str, class, or None
+        The serializer to use to convert the input value to bytes. Run the booklet.available_serializers to determine the internal serializers that are available. None will require bytes as input. A custom serializer class can also be used.
+
+    value_serializer : str, class, or None
+        Similar to the key_serializer, except for the values.
+
+    n_shards : int
+        The number of shard files. This cannot be changed after creation.
+
+    n_buckets : int
+        The number of hash buckets per shard.
+
+    buffer_size : int
+        The buffer memory size in bytes used for writing per shard.
+
+    init_timestamps : bool
+        Should timestamps be initialized in the shards? This cannot be changed later.
+
+    lock_mode : str
+        How the shard file locks are held. See the open function for details.
+
+    ttl : int, float, or None
+        The time to live of the items in seconds. It is saved in each shard that is opened for writing. See the open function for details.
+
+    Returns
+    -------
+    ShardedBooklet
+    """
+    def __init__(self, dir_path: Union[str, pathlib.Path], flag: str = "r", key_serializer: str = None, value_serializer: str = None, n_shards: int=16, n_buckets: int=12007, buffer_size: int = 2**22, init_timestamps=True, lock_mode: str = 'session', ttl=None):
+        """
+
+        """
+        utils.init_shards(self, dir_path, flag, key_serializer, value_serializer, n_shards, n_buckets, buffer_size, init_timestamps, lock_mode, ttl)
+
+    def _open_shard_file(self, shard_index, flag):
+        """
+
+        """
+        shard_path = utils.get_shard_path(self._dir_path, shard_index)
+
+        return VariableLengthValue(shard_path, flag, self._key_serializer_input, self._value_serializer_input, self._n_buckets, self._write_buffer_size, self._init_timestamps, lock_mode=self._lock_mode, ttl=self._ttl)
+
+    def _get_write_shard(self, shard_index):
+        """
+        Get a shard open for writing. The shard is opened on the first write and stays open (and locked) until the ShardedBooklet is closed.
+        """
+        shard = self._shards.get(shard_index)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.get(shard_index)
+                if shard is None:
+                    shard = self._open_shard_file(shard_index, 'w')
+                    self._shards[shard_index] = shard
+
+        return shard
+
+    @contextmanager
+    def _read_shard(self, shard_index):
+        """
+        Get a shard for reading. If the ShardedBooklet is writable, then shards that haven't been written to are only opened for reading until the read has finished so that they aren't left locked.
+        """
+        shard = self._shards.get(shard_index)
+        if shard is not None:
+            yield shard
+        elif self.writable:
+            shard = self._open_shard_file(shard_index, 'r')
+            try:
+                yield shard
+            finally:
+                shard.close()
+        else:
+            with self._shards_lock:
+                shard = self._shards.get(shard_index)
+                if shard is None:
+                    shard = self._open_shard_file(shard_index, 'r')
+                    self._shards[shard_index] = shard
+            yield shard
+
+    @contextmanager
+    def _temp_write_shard(self, shard_index):
+        """
+        Get a shard for a write that covers the whole shard (e.g. prune or clear). Shards that haven't been written to are closed afterwards.
+        """
+        shard = self._shards.get(shard_index)
+        if shard is not None:
+            yield shard
+        else:
+            shard = self._open_shard_file(shard_index, 'w')
+            try:
+                yield shard
+            finally:
+                shard.close()
+
+    def shard_index(self, key):
+        """
+        Return the shard index that the key is assigned to. This can be used to partition the input data between processes.
+        """
+        key_hash = utils.hash_key(self._key_serializer.dumps(key))
+
+        return utils.get_shard_index(key_hash, self._n_shards)
+
+    @property
+    def n_shards(self):
+        return self._n_shards
+
+    def keys(self, key_filter=None, since=None):
+        for shard_index in range(self._n_shards):
+            with self._read_shard(shard_index) as shard:
+                yield from shard.keys(key_filter, since)
+
+    def items(self, key_filter=None, raw_value_filter=None, since=None):
+        """
+        Return an iterator of (key, value). See the items method of the Booklet for the filters.
+        """
+        for shard_index in range(self._n_shards):
+            with self._read_shard(shard_index) as shard:
+                yield from shard.items(key_filter, raw_value_filter, since)
+
+    def values(self, raw_value_filter=None, since=None):
+        for shard_index in range(self._n_shards):
+            with self._read_shard(shard_index) as shard:
+                yield from shard.values(raw_value_filter, since)
+
+    def timestamps(self, include_value=False, decode_value=True):
+        """
+        Return an iterator for timestamps for all keys. Optionally add values to the iterator.
+        """
+        for shard_index in range(self._n_shards):
+            with self._read_shard(shard_index) as shard:
+                yield from shard.timestamps(include_value, decode_value)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        n_keys = 0
+        for shard_index in range(self._n_shards):
+            with self._read_shard(shard_index) as shard:
+                n_keys += len(shard)
+
+        return n_keys
+
+    def __contains__(self, key):
+        with self._read_shard(self.shard_index(key)) as shard:
+            return key in shard
+
+    def get(self, key, default=None):
+        with self._read_shard(self.shard_index(key)) as shard:
+            return shard.get(key, default)
+
+    def get_many(self, keys, default=None):
+        """
+        Return an iterator of (key, value) for the requested keys. The keys are grouped by shard, so the output order is by shard rather than the input order. The default is returned as the value for keys that do not exist.
+        """
+        shard_keys = {}
+        for key in keys:
+            shard_index = self.shard_index(key)
+            if shard_index in shard_keys:
+                shard_keys[shard_index].append(key)
+            else:
+                shard_keys[shard_index] = [key]
+
+        for shard_index in sorted(shard_keys):
+            with self._read_shard(shard_index) as shard:
+                yield from shard.get_many(shard_keys[shard_index], default)
+
+    def get_timestamp(self, key, include_value=False, decode_value=True, default=None):
+        """
+        Get a timestamp associated with a key. Optionally include the value.
+        """
+        with self._read_shard(self.shard_index(key)) as shard:
+            return shard.get_timestamp(key, include_value, decode_value, default)
+
+    def set_timestamp(self, key, timestamp):
+        """
+        Set a timestamp for a specific key.
+        """
+        if self.writable:
+            self._get_write_shard(self.shard_index(key)).set_timestamp(key, timestamp)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def set(self, key, value, timestamp=None):
+        """
+        Set a key/value pair. Optionally assign a specific timestamp.
+        """
+        if self.writable:
+            self._get_write_shard(self.shard_index(key)).set(key, value, timestamp)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def update(self, key_value_dict, workers=None):
+        """
+        Set many key/value pairs. See Booklet.update for details.
+        """
+        if self.writable:
+            shard_dicts = {}
+            for key, value in key_value_dict.items():
+                shard_index = self.shard_index(key)
+                if shard_index in shard_dicts:
+                    shard_dicts[shard_index][key] = value
+                else:
+                    shard_dicts[shard_index] = {key: value}
+
+            for shard_index, shard_dict in shard_dicts.items():
+                self._get_write_shard(shard_index).update(shard_dict, workers)
+        else:
+            raise ValueError('File is open for read only.')
+
+    def prune(self, timestamp=None, reindex=False):
+        """
+        Prunes the old keys and associated values in all of the shards. Returns the number of removed items. See Booklet.prune for details.
+        """
+        if self.writable:
+            removed_count = 0
+            for shard_index in range(self._n_shards):
+                with self._temp_write_shard(shard_index) as shard:
+                    removed_count += shard.prune(timestamp, reindex)
+
+            return removed_count
+        else:
+            raise ValueError('File is open for read only.')
+
+    def __getitem__(self, key):
+        value = self.get(key)
+
+        if value is None:
+            raise KeyError(key)
+        else:
+            return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.writable:
+            del self._get_write_shard(self.shard_index(key))[key]
+        else:
+            raise ValueError('File is open for read only.')
+
+    def delete_many(self, keys):
+        """
+        Delete many keys at once. Returns the number of deleted keys. See Booklet.delete_many for details.
+        """
+        if self.writable:
+            shard_keys = {}
+            for key in keys:
+                shard_keys.setdefault(self.shard_index(key), []).append(key)
+
+            n_deleted = 0
+            for shard_index, keys1 in shard_keys.items():
+                n_deleted += self._get_write_shard(shard_index).delete_many(keys1)
+
+            return n_deleted
+        else:
+            raise ValueError('File is open for read only.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def clear(self):
+        if self.writable:
+            for shard_index in range(self._n_shards):
+                with self._temp_write_shard(shard_index) as shard:
+                    shard.clear()
+        else:
+            raise ValueError('File is open for read only.')
+
+    def refresh(self):
+        """
+        Refresh the header state of the shards that are open. Returns True if any of them have changed. See the refresh method of the single file booklet for details.
+        """
+        changed = False
+        for shard in list(self._shards.values()):
+            if shard.refresh():
+                changed = True
+
+        return changed
+
+    def sync(self):
+        """
+        Sync the data buffers of all open shards to disk.
+        """
+        for shard in list(self._shards.values()):
+            shard.sync()
+
+    def close(self):
+        """
+        Close all open shards and release their file locks.
+        """
+        with self._shards_lock:
+            for shard in self._shards.values():
+                shard.close()
+            self._shards.clear()
+
+
+#######################################################
+### Async Booklet
+
+
+class AsyncBooklet:
+    """
+    An asyncio front-end for an open booklet (VariableLengthValue, FixedLengthValue, or ShardedBooklet). The file reads, file writes, and the serialization all run in an executor so that they don't block the event loop. The executor has a single thread since the booklet reads are not thread safe. Writes still go through the thread lock of the booklet.
+
+    Parameters
+    -----------
+    booklet : Booklet or ShardedBooklet
+        An open booklet. It will be closed when the AsyncBooklet is closed.
+
+    batch_size : int
+        The number of items that the async iterators read in the executor per call.
+
+    Returns
+    -------
+    AsyncBooklet
+    """
+    def __init__(self, booklet, batch_size: int=1000):
+        """
+
+        """
+        self._booklet = booklet
+        self._batch_size = batch_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, func, *args):
+        """
+        Run the function in the executor.
+        """
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _iter_batches(self, data_iter):
+        """
+        Run the iterator in the executor in batches of batch_size.
+        """
+        while True:
+            batch = await self._run(utils.take, data_iter, self._batch_size)
+            for item in batch:
+                yield item
+
+            if len(batch) < self._batch_size:
+                break
+
+    @property
+    def writable(self):
+        return self._booklet.writable
+
+    async def get(self, key, default=None):
+        return await self._run(self._booklet.get, key, default)
+
+    async def get_range(self, key, start=0, length=None, default=None):
+        return await self._run(self._booklet.get_range, key, start, length, default)
+
+    async def get_many(self, keys, default=None):
+        """
+        Return a list of (key, value) for the requested keys. The default is returned as the value for keys that do not exist.
+        """
+        return await self._run(lambda: list(self._booklet.get_many(keys, default)))
+
+    async def contains(self, key):
+        return await self._run(self._booklet.__contains__, key)
+
+    async def set(self, key, value, timestamp=None):
+        """
+        Set a key/value pair. See the set method of the booklet for details.
+        """
+        await self._run(self._booklet.set, key, value, timestamp)
+
+    async def update(self, key_value_dict):
+        await self._run(self._booklet.update, key_value_dict)
+
+    async def delete(self, key):
+        await self._run(self._booklet.__delitem__, key)
+
+    def keys(self, **kwargs):
+        return self._iter_batches(self._booklet.keys(**kwargs))
+
+    def items(self, **kwargs):
+        """
+        The keyword arguments (e.g. the filters) are passed to the items method of the booklet.
+        """
+        return self._iter_batches(self._booklet.items(**kwargs))
+
+    def values(self, **kwargs):
+        return self._iter_batches(self._booklet.values(**kwargs))
+
+    async def sync(self):
+        await self._run(self._booklet.sync)
+
+    async def close(self):
+        """
+        Close the booklet and shutdown the executor.
+        """
+        await self._run(self._booklet.close)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
 #####################################################
 ### Default "open" should be the variable value class
 
 
 def open(
-    file_path: Union[str, pathlib.Path], flag: str = "r", key_serializer: str = None, value_serializer: str = None, n_buckets: int=12007, buffer_size: int = 2**22, init_timestamps=True, init_bytes=None):
+    file_path: Union[str, pathlib.Path], flag: str = "r", key_serializer: str = None, value_serializer: str = None, n_buckets: int=12007, buffer_size: int = 2**22, init_timestamps=True, init_bytes=None, lock_mode: str = 'session', ttl=None, max_keys: int=None, max_bytes: int=None, ts_index: bool=False, key_index: bool=False, indexes: dict=None, zstd_dict: bytes=None, compression: str=None, compression_level: int=None, compression_threads: int=None, n_bytes_key: int=2, n_bytes_value: int=4, dedup: bool=False):
     """
     Open a persistent dictionary for reading and writing. On creation of the file, the serializers will be written to the file. Any subsequent reads and writes do not need to be opened with any parameters other than file_path and flag.
 
@@ -691,6 +2475,48 @@ def open(
     init_timestamps : bool
         Should timestamps be initialized in the object? This cannot be changed later.
 
+    lock_mode : str
+        How the file locks are held. 'session' (default) holds an exclusive lock (writing) or a shared lock (reading) until the file is closed. 'operation' holds no lock between operations. It takes a shared lock for each read and an exclusive lock for each write to the file (e.g. a sync, delete, or prune), so multiple processes can have the same file open for writing. The header is read again every time a lock is acquired, so changes from other processes are seen, but len() is only as current as the last operation and writes still in the buffer are not visible to other processes until they are synced. Iterators only include the data blocks that existed when the iteration started. 'none' can only be used for reading and takes no locks at all, so it can read a file while another process has it open for writing (in any lock mode). Writers commit the end of the data blocks and a generation number to the header after every change to the file, and the reads are retried until they happen on a committed generation. Data that the writer hasn't synced yet is not visible. Iterators are not snapshots, so items changed by the writer during an iteration might be skipped, and a prune or clear during an iteration might produce invalid items.
+
+    ttl : int, float, or None
+        The time to live of the items in seconds. Items whose timestamp is older than the ttl are treated as missing by the get methods, containment checks, and iterators, and they are removed by a prune without a timestamp. It requires init_timestamps. The ttl is saved in the file when it's created or when it's passed with a writable flag; None uses the saved ttl and 0 removes it. Since the timestamp of an item can be assigned on a set, it can also be used to control the expiry of individual items. len() still counts the expired items until they are pruned.
+
+    max_keys : int or None
+        The maximum number of items in the file. This turns the file into a size-bounded cache. When the file is synced (or closed) and has more than max_keys items, the oldest items by their timestamps (i.e. the least recently written) are removed by a prune until 90% of max_keys is left. It requires init_timestamps and it isn't saved in the file.
+
+    max_bytes : int or None
+        The maximum size of the file in bytes. It works the same way as max_keys, but the data blocks of the oldest items are removed until the file is 90% of max_bytes. The file can be larger than max_bytes between syncs by up to the buffer_size.
+
+    ts_index : bool
+        Create a timestamp index so that items_since and keys_since only read the items that match rather than the whole file. The index is stored in a separate file next to the booklet file (with a .tsidx suffix) and it requires init_timestamps. Once the index exists, it is maintained by every writer on each sync, set_timestamp, prune, and clear (regardless of this parameter). Delete the index file to stop using it.
+
+    key_index : bool
+        Create a key index so that range and prefix only read the items that match rather than the whole file. It works the same way as the ts_index, but the index file has a .keyidx suffix and it doesn't require init_timestamps.
+
+    indexes : dict or None
+        Secondary indexes over the values as a dict of index name to extractor function. The extractor is called with the (deserialized) value on every write and returns the index value (None is not indexed). The index values must be serializable by orjson, and they are matched by equality of their orjson serialization (so 1 and 1.0 are different). The index for each name is stored in a separate file next to the booklet file (with a .<name>.validx suffix) and is queried with db.index(name).get(index_value). The indexes are maintained on sync, prune, and clear. Since the extractor functions can't be saved in the file, every writer of the file must pass the same indexes (a writer without them raises a ValueError). Remove the index file to stop using an index.
+
+    zstd_dict : bytes or None
+        A trained zstd dictionary (e.g. from zstandard.train_dictionary) to compress the serialized values with. This can make files of many small and similar values (like JSON documents) several times smaller, since values that are compressed individually barely compress. The dictionary is saved in the file, so it's only needed when the file is created (or is empty). To train a dictionary from the values of an existing file, use the train_zstd_dict method. The raw values passed to the raw_value_filter are compressed.
+
+    compression : str or None
+        Compress the serialized values with 'zstd' or 'lz4' (lz4 compresses less, but it's much faster). Unlike the *_zstd value serializers, the compression contexts are reused for every value and the level can be set. The compression, level, and threads are saved in the file, so they don't need to be passed when reopening the file. The compression can only be assigned when the file is created (or is empty). Passing a zstd_dict implies zstd.
+
+    compression_level : int or None
+        The compression level of zstd (-7 to 22, default 3) or lz4 (0 to 16, default 0 which is the fast mode). It only affects the values that are written from now on, so it can be changed when reopening the file for writing.
+
+    compression_threads : int or None
+        The number of threads that zstd uses to compress values of at least 1 MB (default 0, which doesn't use extra threads). It can be changed when reopening the file for writing.
+
+    n_bytes_key : int
+        The number of bytes (0 to 4) that the length of each key is saved with, which limits the size of the keys. The default of 2 allows keys of up to 64 KiB. With a fixed width key serializer (e.g. uint8), 0 doesn't save the key lengths at all. Together with a small n_bytes_value, this makes the files of many small items noticeably smaller. It's saved in the file when it's created.
+
+    n_bytes_value : int
+        The number of bytes (1 to 8) that the length of each value is saved with, which limits the size of the values. The default of 4 allows values of up to 4 GiB, and 8 allows any size of value (e.g. large model files or Arrow tables). Each extra byte adds a byte to every item in the file. It's saved in the file when it's created.
+
+    dedup : bool
+        Store each distinct value only once. The (serialized and compressed) values are saved in a separate booklet file next to the file (with a .blobs suffix) by a 32 byte blake2b hash of the value, and the items only save the hash. This makes files where many keys have the same large values (e.g. the same geometry or model weights) much smaller, at the cost of an extra lookup for every read and write. A prune (or an eviction) also removes the values that are no longer used by any item. get_range and open_value read the value in the blobs file, and open_writer and train_zstd_dict can't be used. It's saved in the file when it's created.
+
     Returns
     -------
     Booklet
@@ -714,4 +2540,4 @@ def open(
     +---------+-------------------------------------------+
 
     """
-    return VariableLengthValue(file_path, flag, key_serializer, value_serializer, n_buckets, buffer_size, init_timestamps, init_bytes)
+    return VariableLengthValue(file_path, flag, key_serializer, value_serializer, n_buckets, buffer_size, init_timestamps, init_bytes, lock_mode, ttl, max_keys, max_bytes, ts_index, key_index, indexes, zstd_dict, compression, compression_level, compression_threads, n_bytes_key, n_bytes_value, dedup)
@@ -9,55 +9,141 @@ import io
 import pickle
 import json
 import hashlib
+import importlib
+import importlib.util
+import threading
 
+
+class LazyModule:
+    """
+    A stand-in for an optional serializer backend. The module is imported on the first attribute access, so importing booklet doesn't import any of the backends.
+    """
+    __slots__ = ('_name', '_module')
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+orjson = LazyModule('orjson')
+zstd = LazyModule('zstandard')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+gpd = LazyModule('geopandas')
+pyarrow = LazyModule('pyarrow')
+shapely = LazyModule('shapely')
+msgpack = LazyModule('msgpack')
+lz4_block = LazyModule('lz4.block')
+
+## The backends that are installed (without importing them)
 imports = set()
-try:
-    import orjson
-    imports.add('orjson')
-except:
-    pass
-try:
-    import zstandard as zstd
-    imports.add('zstd')
-except:
-    pass
-try:
-    import numpy as np
-    imports.add('numpy')
-except:
-    pass
-try:
-    import pandas as pd
-    imports.add('pandas')
-except:
-    pass
-try:
-    import geopandas as gpd
-    imports.add('geopandas')
-except:
-    pass
-try:
-    import pyarrow
-    imports.add('pyarrow')
-except:
-    pass
-try:
-    import shapely
-    imports.add('shapely')
-except:
-    pass
-try:
-    import msgpack
-    imports.add('msgpack')
-except:
-    pass
-
-
-# try:
-#     import lz4
-#     imports['lz4'] = True
-# except:
-#     imports['lz4'] = False
+for name, module_name in (('orjson', 'orjson'), ('zstd', 'zstandard'), ('numpy', 'numpy'), ('pandas', 'pandas'), ('geopandas', 'geopandas'), ('pyarrow', 'pyarrow'), ('shapely', 'shapely'), ('msgpack', 'msgpack'), ('lz4', 'lz4')):
+    if importlib.util.find_spec(module_name) is not None:
+        imports.add(name)
+
+
+#######################################################
+### Compression codecs
+# The codecs compress the serialized values. The zstd contexts are expensive to create, so they are created once per thread and reused for every value.
+
+zstd_threads_min_len = 2**20 # Only values at least this long are compressed with multiple threads
+
+
+class ZstdCodec:
+    """
+    Reusable zstd compression with a level, an optional number of threads for large values, and an optional trained dictionary.
+    """
+    default_level = 3
+
+    def __init__(self, level=None, threads=0, dict_data=None):
+        if level is None:
+            level = self.default_level
+        self.level = level
+        self.threads = threads
+        self.dict_data = dict_data
+        self._local = threading.local()
+
+    def _contexts(self):
+        contexts = getattr(self._local, 'contexts', None)
+        if contexts is None:
+            if self.dict_data is None:
+                dict_data = None
+                compressor = zstd.ZstdCompressor(level=self.level)
+                decompressor = zstd.ZstdDecompressor()
+            else:
+                dict_data = zstd.ZstdCompressionDict(self.dict_data)
+                compressor = zstd.ZstdCompressor(level=self.level, dict_data=dict_data)
+                decompressor = zstd.ZstdDecompressor(dict_data=dict_data)
+            contexts = [compressor, decompressor, dict_data, None]
+            self._local.contexts = contexts
+
+        return contexts
+
+    def compress(self, obj):
+        contexts = self._contexts()
+        if self.threads and (len(obj) >= zstd_threads_min_len):
+            if contexts[3] is None:
+                contexts[3] = zstd.ZstdCompressor(level=self.level, dict_data=contexts[2], threads=self.threads)
+            return contexts[3].compress(obj)
+
+        return contexts[0].compress(obj)
+
+    def decompress(self, obj):
+        return self._contexts()[1].decompress(obj)
+
+
+class Lz4Codec:
+    """
+    lz4 block compression. It compresses less than zstd, but it's much faster. A level of 0 uses the fast mode and higher levels (up to 16) use the high compression mode.
+    """
+    default_level = 0
+
+    def __init__(self, level=None, threads=0, dict_data=None):
+        if level is None:
+            level = self.default_level
+        self.level = level
+        self.threads = threads
+        self.dict_data = dict_data
+
+    def compress(self, obj):
+        if self.level > 0:
+            return lz4_block.compress(obj, mode='high_compression', compression=self.level)
+        else:
+            return lz4_block.compress(obj)
+
+    def decompress(self, obj):
+        return lz4_block.decompress(obj)
+
+
+## Module level zstd codec of the *Zstd serializers
+zstd_codec = ZstdCodec(1)
+
+
+#######################################################
+### Key order
+# Key serializers can have an order function that converts the serialized key into bytes that sort in the same order as the keys. It's used by the key index.
+
+
+def unsigned_order(obj):
+    """
+    Little-endian unsigned ints sort correctly as big-endian bytes.
+    """
+    return obj[::-1]
+
+
+def signed_order(obj):
+    """
+    Little-endian signed ints sort correctly as big-endian bytes with the sign bit flipped.
+    """
+    b = bytearray(obj[::-1])
+    b[0] ^= 0x80
+    return bytes(b)
 
 
 #######################################################
@@ -88,6 +174,7 @@ class Str:
         return obj.decode()
 
 class Bytes:
+    view = True
     def dumps(obj):
         return obj
     def loads(obj):
@@ -95,117 +182,185 @@ class Bytes:
 
 class PickleZstd:
     def dumps(obj):
-        return zstd.compress(pickle.dumps(obj, 5), 1)
+        return zstd_codec.compress(pickle.dumps(obj, 5))
     def loads(obj):
-        return pickle.loads(zstd.decompress(obj))
+        return pickle.loads(zstd_codec.decompress(obj))
 
 class OrjsonZstd:
     def dumps(obj):
-        return zstd.compress(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_SERIALIZE_NUMPY), 1)
+        return zstd_codec.compress(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_SERIALIZE_NUMPY))
     def loads(obj):
-        return orjson.loads(zstd.decompress(obj))
+        return orjson.loads(zstd_codec.decompress(obj))
 
 class NumpyInt1:
+    view = True
     def dumps(obj):
         return obj.astype('i1').tobytes()
     def loads(obj):
         return np.frombuffer(obj, 'i1')
 
 class NumpyInt2:
+    view = True
     def dumps(obj):
         return obj.astype('i2').tobytes()
     def loads(obj):
         return np.frombuffer(obj, 'i2')
 
 class NumpyInt4:
+    view = True
     def dumps(obj):
         return obj.astype('i4').tobytes()
     def loads(obj):
         return np.frombuffer(obj, 'i4')
 
 class NumpyInt8:
+    view = True
     def dumps(obj):
         return obj.astype('i8').tobytes()
     def loads(obj):
         return np.frombuffer(obj, 'i8')
 
+class NumpyFloat4:
+    view = True
+    def dumps(obj):
+        return obj.astype('f4').tobytes()
+    def loads(obj):
+        return np.frombuffer(obj, 'f4')
+
+class NumpyFloat8:
+    view = True
+    def dumps(obj):
+        return obj.astype('f8').tobytes()
+    def loads(obj):
+        return np.frombuffer(obj, 'f8')
+
+class Numpy:
+    """
+    Arrays of any shape and (non-object) dtype. The dtype and shape are saved in a small header before the array data: the dtype string length (1 byte), the dtype string, the number of dimensions (1 byte), and 8 bytes per dimension.
+    """
+    view = True
+    def dumps(obj):
+        obj = np.ascontiguousarray(obj)
+        if obj.dtype.hasobject or (obj.dtype.names is not None):
+            raise TypeError('Only arrays of a simple dtype can be serialized with numpy. Use pickle instead.')
+        dtype = obj.dtype.str.encode()
+        header = bytes((len(dtype),)) + dtype + bytes((obj.ndim,)) + b''.join(int(n).to_bytes(8, 'little') for n in obj.shape)
+        return header + obj.tobytes()
+    def loads(obj):
+        pos = 1 + obj[0]
+        dtype = bytes(obj[1:pos]).decode()
+        ndim = obj[pos]
+        pos += 1
+        shape = tuple(int.from_bytes(obj[pos + i*8:pos + (i + 1)*8], 'little') for i in range(ndim))
+        return np.frombuffer(obj, dtype, offset=pos + ndim*8).reshape(shape)
+
 class NumpyInt2Zstd:
     def dumps(obj):
-        return zstd.compress(obj.astype('i2').tobytes(), 1)
+        return zstd_codec.compress(obj.astype('i2').tobytes())
     def loads(obj):
-        return np.frombuffer(zstd.decompress(obj), 'i2')
+        return np.frombuffer(zstd_codec.decompress(obj), 'i2')
 
 class NumpyInt4Zstd:
     def dumps(obj):
-        return zstd.compress(obj.astype('i4').tobytes(), 1)
+        return zstd_codec.compress(obj.astype('i4').tobytes())
     def loads(obj):
-        return np.frombuffer(zstd.decompress(obj), 'i4')
+        return np.frombuffer(zstd_codec.decompress(obj), 'i4')
 
 class NumpyInt8Zstd:
     def dumps(obj):
-        return zstd.compress(obj.astype('i8').tobytes(), 1)
+        return zstd_codec.compress(obj.astype('i8').tobytes())
     def loads(obj):
-        return np.frombuffer(zstd.decompress(obj), 'i8')
+        return np.frombuffer(zstd_codec.decompress(obj), 'i8')
 
 class Uint1:
+    width = 1
     def dumps(obj):
         return int(obj).to_bytes(1, 'little', signed=False)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=False)
+    def order(obj):
+        return unsigned_order(obj)
 
 class Int1:
+    width = 4
     def dumps(obj):
         return int(obj).to_bytes(4, 'little', signed=True)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=True)
+    def order(obj):
+        return signed_order(obj)
 
 class Uint2:
+    width = 2
     def dumps(obj):
         return int(obj).to_bytes(2, 'little', signed=False)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=False)
+    def order(obj):
+        return unsigned_order(obj)
 
 class Int2:
+    width = 2
     def dumps(obj):
         return int(obj).to_bytes(2, 'little', signed=True)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=True)
+    def order(obj):
+        return signed_order(obj)
 
 class Uint4:
+    width = 4
     def dumps(obj):
         return int(obj).to_bytes(4, 'little', signed=False)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=False)
+    def order(obj):
+        return unsigned_order(obj)
 
 class Int4:
+    width = 4
     def dumps(obj):
         return int(obj).to_bytes(4, 'little', signed=True)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=True)
+    def order(obj):
+        return signed_order(obj)
 
 class Uint5:
+    width = 5
     def dumps(obj):
         return int(obj).to_bytes(5, 'little', signed=False)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=False)
+    def order(obj):
+        return unsigned_order(obj)
 
 class Int5:
+    width = 5
     def dumps(obj):
         return int(obj).to_bytes(5, 'little', signed=True)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=True)
+    def order(obj):
+        return signed_order(obj)
 
 class Uint8:
+    width = 8
     def dumps(obj):
         return int(obj).to_bytes(8, 'little', signed=False)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=False)
+    def order(obj):
+        return unsigned_order(obj)
 
 class Int8:
+    width = 8
     def dumps(obj):
         return int(obj).to_bytes(8, 'little', signed=True)
     def loads(obj):
         return int.from_bytes(obj, 'little', signed=True)
+    def order(obj):
+        return signed_order(obj)
 
 class GpdZstd:
     def dumps(obj):
@@ -231,9 +386,9 @@ class PdZstd:
 
 class Zstd:
     def dumps(obj):
-        return zstd.compress(obj, 1)
+        return zstd_codec.compress(obj)
     def loads(obj):
-        return zstd.decompress(obj)
+        return zstd_codec.decompress(obj)
 
 class Wkb:
     def dumps(obj):
@@ -243,9 +398,9 @@ class Wkb:
 
 class WkbZstd:
     def dumps(obj):
-        return zstd.compress(shapely.wkb.dumps(obj), 1)
+        return zstd_codec.compress(shapely.wkb.dumps(obj))
     def loads(obj):
-        return shapely.wkb.loads(zstd.decompress(obj))
+        return shapely.wkb.loads(zstd_codec.decompress(obj))
 
 class Msgpack:
     def dumps(obj):
@@ -255,9 +410,9 @@ class Msgpack:
 
 class MsgpackZstd:
     def dumps(obj):
-        return zstd.compress(msgpack.dumps(obj), 1)
+        return zstd_codec.compress(msgpack.dumps(obj))
     def loads(obj):
-        return msgpack.loads(zstd.decompress(obj))
+        return msgpack.loads(zstd_codec.decompress(obj))
 
 # class FileObj:
 #     def dumps(obj):
@@ -272,7 +427,7 @@ class MsgpackZstd:
 ## Serializer dict
 ## New serializers must be appended to the end of the dict!!!!!
 
-serial_dict = {None: Bytes, 'str': Str, 'pickle': Pickle, 'json': Json, 'orjson': Orjson, 'uint1': Uint1, 'int1': Int1, 'uint2': Uint2, 'int2': Int2, 'uint4': Uint4, 'int4': Int4, 'uint5': Uint5, 'int5': Int5, 'uint8': Uint8, 'int8': Int8, 'pickle_zstd': PickleZstd, 'orjson_zstd': OrjsonZstd, 'numpy_int1': NumpyInt1, 'numpy_int2': NumpyInt2, 'numpy_int4': NumpyInt4, 'numpy_int8': NumpyInt8, 'numpy_int2_zstd': NumpyInt2Zstd, 'numpy_int4_zstd': NumpyInt4Zstd, 'numpy_int8_zstd': NumpyInt8Zstd, 'pd_zstd': PdZstd, 'gpd_zstd': GpdZstd, 'zstd': Zstd, 'wkb': Wkb, 'wkb_zstd': WkbZstd, 'msgpack': Msgpack, 'msgpack_zstd': MsgpackZstd, 'bytes': Bytes}
+serial_dict = {None: Bytes, 'str': Str, 'pickle': Pickle, 'json': Json, 'orjson': Orjson, 'uint1': Uint1, 'int1': Int1, 'uint2': Uint2, 'int2': Int2, 'uint4': Uint4, 'int4': Int4, 'uint5': Uint5, 'int5': Int5, 'uint8': Uint8, 'int8': Int8, 'pickle_zstd': PickleZstd, 'orjson_zstd': OrjsonZstd, 'numpy_int1': NumpyInt1, 'numpy_int2': NumpyInt2, 'numpy_int4': NumpyInt4, 'numpy_int8': NumpyInt8, 'numpy_int2_zstd': NumpyInt2Zstd, 'numpy_int4_zstd': NumpyInt4Zstd, 'numpy_int8_zstd': NumpyInt8Zstd, 'pd_zstd': PdZstd, 'gpd_zstd': GpdZstd, 'zstd': Zstd, 'wkb': Wkb, 'wkb_zstd': WkbZstd, 'msgpack': Msgpack, 'msgpack_zstd': MsgpackZstd, 'bytes': Bytes, 'numpy_float4': NumpyFloat4, 'numpy_float8': NumpyFloat8, 'numpy': Numpy}
 
 serial_name_dict = {n: i+1 for i, n in enumerate(serial_dict)}
 
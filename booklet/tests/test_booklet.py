@@ -10,12 +10,15 @@ import io
 import os
 import booklet
 from booklet import __version__, FixedLengthValue, VariableLengthValue, utils
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 import concurrent.futures
+import asyncio
 from hashlib import blake2s
 from copy import deepcopy
 # import mmap
 import time
+import subprocess
+import sys
 
 ##############################################
 ### Parameters
@@ -72,6 +75,17 @@ def test_update():
     assert value == data_dict[10]
 
 
+def test_update_workers():
+    big_dict = {key: str(key)*10 for key in range(2500)}
+    with booklet.open(file_path1, 'n', key_serializer='uint4', value_serializer='pickle_zstd') as f:
+        f.update(big_dict, workers=2)
+
+    with booklet.open(file_path1) as f:
+        items = dict(f.items())
+
+    assert items == big_dict
+
+
 def test_threading_writes():
     with booklet.open(file_path1, 'n', key_serializer='uint4', value_serializer='pickle') as f:
         with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
@@ -288,6 +302,15 @@ def test_set_items_get_items(file_path):
     #     assert value == data_dict[10]
 
 
+@pytest.mark.parametrize("file_path", [file_path1, file_path2])
+def test_get_many(file_path):
+    keys = [2, 10, 97, 1000]
+    with booklet.open(file_path) as f:
+        results = list(f.get_many(keys))
+
+    assert results == [(2, data_dict[2]), (10, data_dict[10]), (97, data_dict[97]), (1000, None)]
+
+
 ## Always make this last!!!
 @pytest.mark.parametrize("file_path", [file_path1, file_path2])
 def test_clear(file_path):
@@ -489,6 +512,14 @@ def test_set_items_get_items_fixed():
 #     assert (new_n_buckets > 20000) and (value == b1)
 
 
+def test_get_many_fixed():
+    keys = [2, 11, 1000]
+    with FixedLengthValue(file_path) as f:
+        results = list(f.get_many(keys))
+
+    assert results == [(2, data_dict2[2]), (11, data_dict2[11]), (1000, None)]
+
+
 ## Always make this last!!!
 def test_clear_fixed():
     with FixedLengthValue(file_path, 'w') as f:
@@ -497,18 +528,639 @@ def test_clear_fixed():
         assert (len(f) == 0) and (len(list(f.keys())) == 0)
 
 
+#######################
+### Sharded booklet
+
+td1 = TemporaryDirectory()
+dir_path1 = td1.name
+
+
+def test_set_items_sharded():
+    with booklet.ShardedBooklet(dir_path1, 'n', key_serializer='uint4', value_serializer='pickle', n_shards=4, n_buckets=1009) as f:
+        for key, value in data_dict.items():
+            f[key] = value
+
+    with booklet.ShardedBooklet(dir_path1) as f:
+        value = f[10]
+        new_len = len(f)
+        n_shards = f.n_shards
+        items = dict(f.items())
+
+    assert (value == data_dict[10]) and (new_len == len(data_dict)) and (n_shards == 4) and (items == data_dict)
+
+
+def test_get_many_sharded():
+    keys = [2, 10, 97, 1000]
+    with booklet.ShardedBooklet(dir_path1) as f:
+        results = dict(f.get_many(keys))
+
+    assert results == {2: data_dict[2], 10: data_dict[10], 97: data_dict[97], 1000: None}
+
+
+def write_shard_key(dir_path, key, value):
+    with booklet.ShardedBooklet(dir_path, 'w') as f:
+        f[key] = value
+
+    return key
+
+
+def test_separate_shard_writers():
+    with TemporaryDirectory() as dir_path:
+        with booklet.ShardedBooklet(dir_path, 'n', key_serializer='uint4', value_serializer='pickle', n_shards=4) as f1:
+            shard_keys = {}
+            for key in range(100, 140):
+                shard_keys.setdefault(f1.shard_index(key), []).append(key)
+            key1, key2 = (shard_keys[shard_index][0] for shard_index in sorted(shard_keys)[:2])
+
+            f1[key1] = 'f1'
+            f1.sync()
+
+            # Reads of the other shards shouldn't leave them locked
+            _ = len(f1)
+            _ = list(f1.items())
+
+            # Only the written shard is locked by f1, so another process can write to a different shard
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(write_shard_key, dir_path, key2, 'f2')
+                _ = future.result(timeout=60)
+
+        with booklet.ShardedBooklet(dir_path) as f:
+            value1 = f[key1]
+            value2 = f[key2]
+
+    assert (value1 == 'f1') and (value2 == 'f2')
+
+
+#######################
+### Lock modes
+
+tf3 = NamedTemporaryFile()
+file_path3 = tf3.name
+
+
+def write_operation_keys(file_path, keys):
+    with booklet.open(file_path, 'w', lock_mode='operation', buffer_size=100) as f:
+        for key in keys:
+            f[key] = key*2
+
+    return len(keys)
+
+
+def test_multiple_writers():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle', lock_mode='operation') as f:
+        f[1] = 'init'
+
+    reader = booklet.open(file_path3, lock_mode='operation')
+    init_len = len(reader)
 
+    keys1 = list(range(1000, 1200))
+    keys2 = list(range(2000, 2200))
 
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(write_operation_keys, file_path3, keys) for keys in (keys1, keys2)]
+        _ = [future.result(timeout=60) for future in futures]
 
+    # The reader picks up the header written by the other processes
+    new_len = len(reader)
+    value1 = reader[keys1[-1]]
+    value2 = reader.get(keys2[-1])
+    reader.close()
 
+    with booklet.open(file_path3) as f:
+        items = dict(f.items())
 
+    source_items = {1: 'init'}
+    for key in keys1 + keys2:
+        source_items[key] = key*2
 
+    assert (init_len == 1) and (new_len == len(source_items)) and (value1 == keys1[-1]*2) and (value2 == keys2[-1]*2) and (items == source_items)
 
 
+def test_reader_without_locks():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as writer:
+        writer[1] = 'init'
+        writer.sync()
 
+        # The writer holds the exclusive lock, but the reader doesn't need any lock
+        reader = booklet.open(file_path3, lock_mode='none')
+        init_value = reader[1]
 
+        writer.update(data_dict)
+        buffered_len = len(reader)
 
+        writer.sync()
+        new_len = len(reader)
+        items = dict(reader.items())
 
+        del writer[1]
+        deleted = 1 in reader
+        reader.close()
+
+    with pytest.raises(ValueError):
+        booklet.open(file_path3, 'w', lock_mode='none')
+
+    assert (init_value == 'init') and (buffered_len == 1) and (new_len == len(data_dict) + 1) and (items == {1: 'init', **data_dict}) and (not deleted)
+
+
+def test_refresh():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as writer:
+        reader = booklet.open(file_path3, lock_mode='none')
+        unchanged = reader.refresh()
+
+        writer[1] = 'new'
+        writer.sync()
+        changed = reader.refresh()
+        n_keys = reader._n_keys
+        unchanged2 = reader.refresh()
+        reader.close()
+
+    assert (not unchanged) and changed and (n_keys == 1) and (not unchanged2)
+
+
+def test_changes_since():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as f:
+        f.update(data_dict)
+        changes, token = f.changes_since()
+        init_changes = dict(changes)
+
+        f[2] = 'new'
+        f[1000] = 'new'
+        changes, token2 = f.changes_since(token)
+        new_changes = list(changes)
+
+        changes, token3 = f.changes_since(token2)
+        no_changes = list(changes)
+
+    assert (init_changes == data_dict) and (new_changes == [(2, 'new'), (1000, 'new')]) and (no_changes == []) and (token3 == token2 > token)
+
+
+def test_delete_many():
+    data_dict1 = {key: key*2 for key in range(2, 30)}
+    data_dict1[97] = 97*2
+
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as f:
+        f.update(data_dict1)
+        f.sync()
+        f[1] = 'buffered'
+        n_deleted = f.delete_many([11, 97, 5, 1, 1000])
+        new_len = len(f)
 
+        # The buckets must still be usable after removing their only data blocks
+        f[5] = 'new'
 
+    with booklet.open(file_path3) as f:
+        items = dict(f.items())
 
+    source_items = {key: value for key, value in data_dict1.items() if key not in (11, 97, 5)}
+    source_items[5] = 'new'
+
+    assert (n_deleted == 4) and (new_len == len(data_dict1) - 3) and (items == source_items)
+
+
+#######################################################
+### Async booklet
+
+
+async def run_async_booklet(file_path):
+    async with booklet.AsyncBooklet(booklet.open(file_path, 'n', key_serializer='uint4', value_serializer='pickle'), batch_size=5) as db:
+        await db.update(data_dict)
+        await db.set(1, 'one')
+        await db.sync()
+        value = await db.get(1)
+        many = await db.get_many([2, 1000])
+        items = {key: value async for key, value in db.items()}
+
+    return value, many, items
+
+
+def test_async_booklet():
+    value, many, items = asyncio.run(run_async_booklet(file_path3))
+
+    assert (value == 'one') and (many == [(2, data_dict[2]), (1000, None)]) and (items == {1: 'one', **data_dict})
+
+
+def test_ttl():
+    old_ts = booklet.make_timestamp_int() - 120*1000000
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle', ttl=60) as f:
+        f.set(1, 'old', timestamp=old_ts)
+        f[2] = 'new'
+        f.sync()
+        get_old = f.get(1)
+        contains_old = 1 in f
+        items = dict(f.items())
+
+    with booklet.open(file_path3, 'w') as f:
+        saved_ttl = f._ttl
+        removed_count = f.prune()
+        new_len = len(f)
+
+    with booklet.open(file_path3, 'w', ttl=0) as f:
+        f.set(3, 'old', timestamp=old_ts)
+        no_ttl_value = f[3]
+
+    assert (get_old is None) and (not contains_old) and (items == {2: 'new'}) and (saved_ttl == 60*1000000) and (removed_count == 1) and (new_len == 1) and (no_ttl_value == 'old')
+
+
+def test_max_keys():
+    start_ts = booklet.make_timestamp_int()
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle', max_keys=100) as f:
+        for key in range(150):
+            f.set(key, key, timestamp=start_ts + key)
+        f.sync()
+        n_keys = len(f)
+        keys = set(f.keys())
+
+    assert (n_keys == 90) and (keys == set(range(60, 150)))
+
+
+def test_max_bytes():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle', n_buckets=101, max_bytes=20000) as f:
+        for key in range(500):
+            f[key] = b'0'*100
+            if key % 50 == 0:
+                f.sync()
+
+    file_size = os.path.getsize(file_path3)
+
+    with booklet.open(file_path3) as f:
+        value = f[499]
+
+    assert (file_size <= 20000) and (value == b'0'*100)
+
+
+def test_ts_index():
+    start_ts = booklet.make_timestamp_int()
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle', ts_index=True) as f:
+        for key in range(40):
+            f.set(key, key, timestamp=start_ts + key)
+            f.sync() # More runs than index_max_runs
+        f.set(5, 'new', timestamp=start_ts + 100)
+        del f[30]
+        f.set_timestamp(10, start_ts + 50)
+        keys = list(f.keys_since(start_ts + 35))
+
+    with booklet.open(file_path3) as f:
+        items = list(f.items_since(start_ts + 35, include_timestamp=True))
+
+    ts_index_path = utils.get_index_path(file_path3, utils.ts_index_suffix)
+    ts_index_path.unlink()
+    with booklet.open(file_path3) as f:
+        scan_keys = set(f.keys_since(start_ts + 35))
+
+    assert (keys == [35, 36, 37, 38, 39, 10, 5]) and (items[-1] == (5, start_ts + 100, 'new')) and (scan_keys == set(keys))
+
+
+def test_key_index():
+    with booklet.open(file_path3, 'n', key_serializer='int4', value_serializer='pickle', key_index=True) as f:
+        for key in range(-20, 300):
+            f[key] = key
+            if key % 20 == 0:
+                f.sync()
+        del f[5]
+        f[6] = 'new'
+        range_items = list(f.range(-2, 8))
+        all_keys = list(f.range(include_value=False))
+
+    key_index_path = utils.get_index_path(file_path3, utils.key_index_suffix)
+    key_index_path.unlink()
+    with booklet.open(file_path3) as f:
+        scan_items = list(f.range(-2, 8))
+
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='pickle', key_index=True) as f:
+        for key in ['sensor/1', 'sensor/2', 'sensors', 'station/1', 'sensor/0']:
+            f[key] = key
+        prefix_keys = list(f.prefix('sensor/', include_value=False))
+
+    assert (range_items == [(-2, -2), (-1, -1), (0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (6, 'new'), (7, 7)]) and (all_keys == [key for key in range(-20, 300) if key != 5]) and (scan_items == range_items) and (prefix_keys == ['sensor/0', 'sensor/1', 'sensor/2'])
+
+
+def test_value_index():
+    indexes = {'station': lambda value: value.get('station')}
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson', indexes=indexes) as f:
+        for key in range(100):
+            f[key] = {'station': key % 3, 'value': key}
+        f.update({100: {'station': 1}, 101: {'value': 101}}, workers=2)
+        f[1] = {'station': 2}
+        del f[4]
+        station_1_keys = sorted(f.index('station').get(1))
+
+    with pytest.raises(ValueError):
+        booklet.open(file_path3, 'w')
+
+    with booklet.open(file_path3, 'w', indexes=indexes) as f:
+        f.prune()
+        station_2_items = dict(f.index('station').items(2))
+
+    with booklet.open(file_path3) as f:
+        reader_keys = sorted(f.index('station').get(1))
+        with pytest.raises(KeyError):
+            f.index('other')
+
+    utils.get_value_index_path(file_path3, 'station').unlink()
+
+    assert (station_1_keys == [key for key in range(101) if (key % 3 == 1) and (key not in (1, 4))]) and (station_2_items[1] == {'station': 2}) and (len(station_2_items) == 34) and (reader_keys == station_1_keys)
+
+
+def test_items_filters():
+    start_ts = booklet.make_timestamp_int()
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as f:
+        for key in range(100):
+            f.set(key, key*2, timestamp=start_ts + key)
+
+        key_items = dict(f.items(key_filter=lambda key_bytes: int.from_bytes(key_bytes, 'little') < 10))
+        value_keys = set(dict(f.items(raw_value_filter=lambda value_bytes: value_bytes == booklet.serializers.Pickle.dumps(20))))
+        since_keys = set(f.keys(since=start_ts + 95))
+        since_values = set(f.values(since=start_ts + 95))
+
+    assert (key_items == {key: key*2 for key in range(10)}) and (value_keys == {10}) and (since_keys == set(range(95, 100))) and (since_values == {key*2 for key in range(95, 100)})
+
+
+def test_lazy_items():
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='pickle') as f:
+        for key in range(10):
+            f[key] = [key]*100
+        f.sync()
+
+        lazy_items = dict(f.items(lazy=True))
+        unloaded = repr(lazy_items[3]).startswith('<LazyValue of')
+        value = lazy_items[3].value
+        ts_values = {key: lazy_value.value for key, ts_int, lazy_value in f.timestamps(True, lazy=True)}
+
+    assert isinstance(lazy_items[0], booklet.LazyValue) and unloaded and (value == [3]*100) and (ts_values[9] == [9]*100)
+
+
+def test_lazy_serializer_imports():
+    code = "import sys, booklet; print(any(name in sys.modules for name in ('numpy', 'pandas', 'geopandas', 'zstandard', 'msgpack')))"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.strip()
+
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='pickle_zstd') as f:
+        f['test'] = [1, 2, 3]
+        value = f['test']
+
+    assert (output == 'False') and (value == [1, 2, 3]) and (booklet.available_serializers == list(booklet.serializers.serial_dict))
+
+
+def test_zstd_dict():
+    docs = {key: {'station': 'station_{}'.format(key % 20), 'temperature': key % 30, 'quality': 'good', 'units': 'degrees celsius', 'source': 'automatic weather station'} for key in range(2000)}
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson') as f:
+        f.update(docs)
+        f.set_metadata({'test': 1})
+    uncompressed_size = os.path.getsize(file_path3)
+
+    with booklet.open(file_path3, 'w') as f:
+        dict_len = f.train_zstd_dict(dict_size=2**12)
+        n_keys = len(f)
+        f[5000] = docs[5]
+
+    compressed_size = os.path.getsize(file_path3)
+    with booklet.open(file_path3) as f:
+        values = dict(f.items())
+        metadata = f.get_metadata()
+
+    with booklet.open(file_path3, 'w') as f:
+        zstd_dict = f._zstd_dict
+        f.clear()
+        f[1] = docs[1]
+
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson', zstd_dict=zstd_dict) as f:
+        f[2] = docs[2]
+
+    with booklet.open(file_path3) as f:
+        value = f[2]
+
+    empty_size = utils.sub_index_init_pos + (12007 * utils.n_bytes_file)
+    assert ((compressed_size - empty_size) < (uncompressed_size - empty_size)/2) and (dict_len > 0) and (n_keys == 2000) and (values[5000] == docs[5]) and (len(values) == 2001) and (values[1999] == docs[1999]) and (metadata == {'test': 1}) and (value == docs[2])
+
+
+def test_compression():
+    docs = {key: {'station': 'station_{}'.format(key % 20), 'values': list(range(key % 50))} for key in range(500)}
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson', compression='zstd', compression_level=10) as f:
+        f.update(docs)
+        level = f._compression_level
+
+    with booklet.open(file_path3, 'w', compression_level=1) as f:
+        f[1000] = docs[5]
+        reopened_level = f._compression_level
+        with pytest.raises(ValueError):
+            f._init_compression('lz4', None, None, None)
+
+    with booklet.open(file_path3) as f:
+        values = dict(f.items())
+        saved_level = f._compression_level
+
+    ## Files of the previous version without the level and threads in the header
+    with open(file_path3, 'r+b') as file:
+        file.seek(16)
+        file.write(utils.int_to_bytes(utils.codec_version - 1, 2))
+        file.seek(utils.compression_level_pos)
+        file.write(b'00')
+
+    with booklet.open(file_path3, 'w') as f:
+        upgraded_level = f._compression_level
+        upgraded_value = f[1000]
+
+    with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson_zstd') as f:
+        f.update(docs)
+
+    with booklet.open(file_path3) as f:
+        zstd_values = dict(f.items())
+
+    assert (level == 10) and (reopened_level == 1) and (saved_level == 1) and (values[1000] == docs[5]) and (len(values) == 501) and (values[499] == docs[499]) and (upgraded_level == 3) and (upgraded_value == docs[5]) and (zstd_values == docs)
+
+    if 'lz4' in booklet.serializers.imports:
+        with booklet.open(file_path3, 'n', key_serializer='uint4', value_serializer='orjson', compression='lz4') as f:
+            f.update(docs)
+
+        with booklet.open(file_path3) as f:
+            assert dict(f.items()) == docs
+
+
+def test_numpy_views():
+    np = pytest.importorskip('numpy')
+    arrays = {'a': np.arange(100000, dtype='f8').reshape(1000, 100), 'b': np.array([[1, 2], [3, 4]], dtype='u2'), 'c': np.zeros((0, 3), dtype='i4')}
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='numpy') as f:
+        f.update(arrays)
+        written = f.get_view('b')
+
+    with booklet.open(file_path3) as f:
+        values = {key: f.get_view(key) for key in arrays}
+        copy = f['a']
+        missing = f.get_view('d')
+        file_map = f._file_map
+
+    assert all(np.array_equal(values[key], arrays[key]) and (values[key].dtype == arrays[key].dtype) for key in arrays) and np.array_equal(copy, arrays['a']) and (missing is None) and (not values['a'].flags.writeable) and (values['a'].base.base.obj is file_map) and np.array_equal(written, arrays['b'])
+
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='numpy_float4') as f:
+        f['a'] = arrays['a'][0]
+        value = f.get_view('a')
+
+    assert (value.dtype == np.float32) and np.array_equal(value, arrays['a'][0])
+
+
+def test_value_ranges():
+    value = bytes(range(256)) * 1000
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='bytes') as f:
+        f['a'] = value
+        buffered = f.get_range('a', 10, 5)
+
+    with booklet.open(file_path3) as f:
+        middle = f.get_range('a', 1000, 300)
+        end = f.get_range('a', len(value) - 10)
+        past_end = f.get_range('a', len(value) + 10, 5)
+        missing = f.get_range('b')
+
+        with f.open_value('a') as reader:
+            reader.seek(500)
+            first = reader.read(100)
+            reader.seek(-20, io.SEEK_END)
+            last = reader.read()
+            at_end = reader.read(10)
+
+        with pytest.raises(KeyError):
+            f.open_value('b')
+
+    assert (buffered == value[10:15]) and (middle == value[1000:1300]) and (end == value[-10:]) and (past_end == b'') and (missing is None) and (first == value[500:600]) and (last == value[-20:]) and (at_end == b'')
+
+
+def test_value_writer():
+    chunks = [bytes([i]) * 100000 for i in range(10)]
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='bytes', buffer_size=2**16, key_index=True) as f:
+        f['a'] = b'buffered'
+        with f.open_writer('big') as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        with f.open_writer('sized', size=6) as writer:
+            writer.write(b'abc')
+            writer.write(b'def')
+        with pytest.raises(ValueError):
+            with f.open_writer('short', size=6) as writer:
+                writer.write(b'abc')
+        with pytest.raises(RuntimeError):
+            with f.open_writer('failed') as writer:
+                writer.write(b'abc')
+                raise RuntimeError('test')
+        with f.open_writer('a') as writer:
+            writer.write(b'overwritten')
+        f['b'] = b'after'
+
+    with booklet.open(file_path3, 'w') as f:
+        values = dict(f.items())
+        keys = list(f.range(include_value=False))
+        n_keys = len(f)
+        f.prune()
+        pruned_big = f['big']
+
+    assert (values == {'a': b'overwritten', 'big': b''.join(chunks), 'sized': b'abcdef', 'b': b'after'}) and (keys == ['a', 'b', 'big', 'sized']) and (n_keys == 4) and (pruned_big == b''.join(chunks))
+
+
+def test_n_bytes():
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='bytes', n_bytes_key=1, n_bytes_value=8, key_index=True) as f:
+        f['a'] = b'1' * 1000
+        f['b' * 200] = b'2'
+        with f.open_writer('c') as writer:
+            writer.write(b'3' * 10)
+        with pytest.raises(OverflowError):
+            f['d' * 300] = b'4'
+        f.sync()
+        del f['a']
+        f['a'] = b'5'
+        f.prune()
+
+    with booklet.open(file_path3) as f:
+        values = dict(f.items())
+        keys = list(f.range(include_value=False))
+        view = f.get_range('c', 2, 3)
+        widths = (f._n_bytes_key, f._n_bytes_value)
+
+    with pytest.raises(ValueError):
+        booklet.open(file_path3, 'n', n_bytes_value=9)
+
+    assert (values == {'a': b'5', 'b' * 200: b'2', 'c': b'3' * 10}) and (keys == ['a', 'b' * 200, 'c']) and (view == b'333') and (widths == (1, 8))
+
+
+def test_compact_records():
+    items = {key: key * 3 for key in range(1000)}
+    sizes = []
+    for n_bytes_key, n_bytes_value in ((2, 4), (0, 1)):
+        with booklet.open(file_path3, 'n', key_serializer='uint8', value_serializer='uint8', n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_index=True) as f:
+            f.update(items)
+        sizes.append(os.path.getsize(file_path3))
+
+    with booklet.open(file_path3, 'w') as f:
+        f.set_metadata({'test': 1})
+        del f[5]
+        f[5] = 15
+        f.prune()
+        keys = list(f.range(10, 15, include_value=False))
+
+    with booklet.open(file_path3) as f:
+        values = dict(f.items())
+        metadata = f.get_metadata()
+        n_keys = len(f)
+
+    with pytest.raises(ValueError):
+        booklet.open(file_path3, 'n', key_serializer='str', n_bytes_key=0)
+
+    assert (values == items) and (metadata == {'test': 1}) and (n_keys == 1000) and (keys == [10, 11, 12, 13, 14]) and (sizes[0] - sizes[1] == 1000 * 5)
+
+
+def test_dedup():
+    value = list(range(10000))
+    with booklet.open(file_path3, 'n', key_serializer='str', value_serializer='pickle', dedup=True, indexes={'len': len}) as f:
+        for i in range(10):
+            f[str(i)] = value
+        f['other'] = [1]
+        f_size = os.path.getsize(file_path3)
+
+    blobs_path = str(file_path3) + '.blobs'
+    with booklet.open(file_path3, 'w', indexes={'len': len}) as f:
+        n_blobs = len(f._blobs)
+        values = dict(f.items(raw_value_filter=lambda value: len(value) < 100))
+        index_keys = [key for key, _ in f.index('len').items(1)]
+        value_range = f.get_range('0', 0, 2)
+        for i in range(10):
+            del f[str(i)]
+        f.prune()
+        pruned_n_blobs = len(f._blobs)
+
+    with booklet.open(file_path3) as f:
+        other = f['other']
+
+    with pytest.raises(ValueError):
+        with booklet.open(file_path3, 'w', indexes={'len': len}) as f:
+            f.open_writer('big')
+
+    assert (n_blobs == 2) and (pruned_n_blobs == 1) and (values == {'other': [1]}) and (index_keys == ['other']) and (value_range == b'\x80\x05') and (other == [1]) and os.path.exists(blobs_path) and (f_size < 100000)
+
+
+def test_namespaces():
+    with TemporaryDirectory() as dir_path:
+        file_path = os.path.join(dir_path, 'test.blt')
+        with booklet.open(file_path, 'n', key_serializer='str', value_serializer='pickle') as f:
+            f['a'] = 1
+            geoms = f.namespace('geoms', key_serializer='uint4', value_serializer='orjson')
+            geoms.update({i: [i] for i in range(10)})
+            geoms[10] = {'x': 1}
+            f.namespace('other')[b'a'] = b'b'
+
+        with booklet.open(file_path, 'w') as f:
+            items = dict(f.items())
+            geoms = f.namespace('geoms')
+            geom_items = dict(geoms.items())
+            other = dict(f.namespace('other'))
+            del geoms[0]
+            n_deleted = geoms.delete_many([1, 2, 100])
+            f.prune()
+            n_geoms = len(geoms)
+            n_keys = len(f)
+
+        with booklet.open(file_path) as f:
+            with pytest.raises(KeyError):
+                f.namespace('new')
+            geom = f.namespace('geoms')[10]
+
+        with booklet.open(file_path, 'n', key_index=True) as f:
+            with pytest.raises(ValueError):
+                f.namespace('geoms')
+
+        assert (items == {'a': 1}) and (geom_items[10] == {'x': 1}) and (len(geom_items) == 11) and (other == {b'a': b'b'}) and (n_deleted == 2) and (n_geoms == 8) and (n_keys == 10) and (geom == {'x': 1})
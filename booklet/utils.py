@@ -14,10 +14,10 @@ import inspect
 from threading import Lock
 import portalocker
 # from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
-# import mmap
+import mmap
 from datetime import datetime, timezone
 import time
-from itertools import count
+from itertools import count, islice
 from collections import Counter, defaultdict, deque
 import weakref
 import pathlib
@@ -39,6 +39,23 @@ file_timestamp_pos = 42
 timestamp_bytes_len = 7
 
 n_keys_crash = 4294967295
+n_buckets_pos = 21
+data_end_pos = 65
+generation_pos = 71
+n_bytes_generation = 4
+ttl_pos = 75
+compression_pos = 82
+compression_level_pos = 83
+compression_threads_pos = 84
+dedup_pos = 85
+
+lock_modes = ('session', 'operation', 'none')
+encode_chunk_size = 1000
+evict_fraction = 0.9 # The fraction of max_keys/max_bytes that the eviction reduces the file to
+commit_timeout = 10
+compressions = {None: 0, 'zstd_dict': 1, 'zstd': 2, 'lz4': 3}
+codecs = {compressions['zstd_dict']: serializers.ZstdCodec, compressions['zstd']: serializers.ZstdCodec, compressions['lz4']: serializers.Lz4Codec}
+zstd_dict_max_samples = 100000
 
 # n_bytes_index = 4
 n_bytes_file = 6
@@ -46,15 +63,46 @@ n_bytes_key = 2
 n_bytes_value = 4
 
 key_hash_len = 13
+value_hash_len = 32
+
+ts_index_suffix = '.tsidx'
+key_index_suffix = '.keyidx'
+value_index_suffix = '.validx'
+blobs_suffix = '.blobs'
+ts_index_entry_len = timestamp_bytes_len + n_bytes_file
+n_bytes_index_run = 4
+index_max_runs = 16 # The number of runs in an index file before they are merged into one
 
 uuid_variable_blt = b'O~\x8a?\xe7\\GP\xadC\nr\x8f\xe3\x1c\xfe'
 uuid_fixed_blt = b'\x04\xd3\xb2\x94\xf2\x10Ab\x95\x8d\x04\x00s\x8c\x9e\n'
 
+manifest_file_name = 'manifest.json'
+shard_file_name = 'shard_{:04d}.blt'
+shard_file_glob = 'shard_*.blt'
+shard_lock_file_name = '.lock'
+shard_manifest_version = 1
+
 # metadata_key_bytes0 = b'\xad\xb0\x1e\xbc\x1b\xa3C>\xb0CRw\xd1g\x86\xee'
 metadata_key_bytes = b'adb01ebc1ba3433eb043527'
 metadata_key_hash = b'B~\xf5\t\xe6\xef,\xbf\x16nn\x82\x01'
-
-current_version = 4
+zstd_dict_key_bytes = b'5e0c9d27a41f4b8e9c3d6f2'
+zstd_dict_key_hash = b'\x9c\xecb\x02\xbb\xe34p\x0c\xac\x89X4'
+namespaces_key_bytes = b'9b1f07c3e26d4a58b0f4e71'
+namespaces_key_hash = b"\xfdAY\x8d7'\xc7O@|\x1aa\x1a"
+
+# The keys of the data blocks that are used internally (not items)
+reserved_key_hashes = (metadata_key_hash, zstd_dict_key_hash, namespaces_key_hash)
+
+# The keys of the items of a namespace start with this prefix and the namespace name
+namespace_key_prefix = b'\xf3\x9a\x1c\x07^\xd2\x8bA'
+
+current_version = 10
+commit_version = 5 # The first version with the committed data end and generation in the header
+ttl_version = 6 # The first version with the ttl in the header
+compression_version = 7 # The first version with the value compression in the header
+codec_version = 8 # The first version with the compression level and threads in the header
+widths_version = 9 # The first version where the key and value lengths can have other widths than n_bytes_key and n_bytes_value
+dedup_version = 10 # The first version with the value deduplication flag in the header
 current_version_bytes = current_version.to_bytes(2, 'little', signed=False)
 
 init_n_buckets = 12007
@@ -161,6 +209,25 @@ def int_to_bytes(i, byte_len, signed=False):
     return i.to_bytes(byte_len, 'little', signed=signed)
 
 
+def read_key_len(key_len_bytes, key_width=0):
+    """
+    The key length of a data block. Files with a fixed key width don't save the key lengths (n_bytes_key is 0), so the key_len_bytes are empty and the key width is returned.
+    """
+    return bytes_to_int(key_len_bytes) or key_width
+
+
+def make_key_len_bytes(key_len, n_bytes_key=n_bytes_key, key_width=0):
+    """
+    The saved key length of a data block. See read_key_len.
+    """
+    if n_bytes_key:
+        return int_to_bytes(key_len, n_bytes_key)
+    elif key_len != key_width:
+        raise ValueError('The serialized keys must be {} bytes, but a key was {} bytes.'.format(key_width, key_len))
+    else:
+        return b''
+
+
 def hash_key(key):
     """
 
@@ -168,6 +235,13 @@ def hash_key(key):
     return blake2s(key, digest_size=key_hash_len).digest()
 
 
+def hash_value(value):
+    """
+    The hash of a value in a file with deduplicated values. The values are stored in the blobs file by this hash, so it must be long enough that different values never have the same hash.
+    """
+    return blake2b(value, digest_size=value_hash_len).digest()
+
+
 def write_init_bucket_indexes(file, n_buckets, index_pos, write_buffer_size):
     """
 
@@ -252,9 +326,9 @@ def contains_key(file, key_hash, n_buckets):
         return False
 
 
-def set_timestamp(file, key_hash, n_buckets, timestamp):
+def set_timestamp(file, key_hash, n_buckets, timestamp, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
     """
-
+    Returns the position of the data block or False if the key doesn't exist.
     """
     data_block_pos = get_last_data_block_pos(file, key_hash, n_buckets)
     if data_block_pos:
@@ -264,64 +338,101 @@ def set_timestamp(file, key_hash, n_buckets, timestamp):
         ts_bytes = int_to_bytes(timestamp, timestamp_bytes_len)
         file.write(ts_bytes)
 
-        return True
+        return data_block_pos
     else:
         return False
 
 
-def get_value(file, key_hash, n_buckets, ts_bytes_len=0):
+def get_value_pos(file, key_hash, n_buckets, ts_bytes_len=0, min_timestamp=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
     """
-    Combines everything necessary to return a value.
+    Returns the position and length of the value in the file (or False if the key doesn't exist). See get_value for the min_timestamp.
     """
     data_block_pos = get_last_data_block_pos(file, key_hash, n_buckets)
     if data_block_pos:
         key_len_pos = data_block_pos + key_hash_len + n_bytes_file
         file.seek(key_len_pos)
-        key_len_value_len = file.read(n_bytes_key + n_bytes_value)
-        key_len = bytes_to_int(key_len_value_len[:n_bytes_key])
-        value_len = bytes_to_int(key_len_value_len[n_bytes_key:])
+        key_len_value_len_ts = file.read(n_bytes_key + n_bytes_value + ts_bytes_len)
+        if (min_timestamp is not None) and (bytes_to_int(key_len_value_len_ts[n_bytes_key + n_bytes_value:]) < min_timestamp):
+            return False
 
-        file.seek(ts_bytes_len + key_len, 1)
-        value = file.read(value_len)
+        key_len = read_key_len(key_len_value_len_ts[:n_bytes_key], key_width)
+        value_len = bytes_to_int(key_len_value_len_ts[n_bytes_key:n_bytes_key + n_bytes_value])
+
+        return key_len_pos + n_bytes_key + n_bytes_value + ts_bytes_len + key_len, value_len
+    else:
+        return False
+
+
+def get_value(file, key_hash, n_buckets, ts_bytes_len=0, min_timestamp=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Combines everything necessary to return a value. If min_timestamp is passed, values with older timestamps are treated as missing. The timestamp is read together with the key and value lengths, so this doesn't need any extra reads.
+    """
+    value_pos = get_value_pos(file, key_hash, n_buckets, ts_bytes_len, min_timestamp, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)
+    if value_pos:
+        file.seek(value_pos[0])
+        value = file.read(value_pos[1])
     else:
         value = False
 
     return value
 
 
-def get_value_ts(file, key_hash, n_buckets, include_value=True, include_ts=False, ts_bytes_len=0):
+def map_file(file):
     """
-    Combines everything necessary to return a value.
+    Create a read-only memory map of the whole file.
+    """
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def unmap_file(file_map):
+    """
+    Close the memory map unless values still view into it. In that case it's closed once the last view has been garbage collected.
+    """
+    if file_map is not None:
+        try:
+            file_map.close()
+        except BufferError:
+            pass
+
+
+def get_value_ts(file, key_hash, n_buckets, include_value=True, include_ts=False, ts_bytes_len=0, min_timestamp=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Combines everything necessary to return a value and/or timestamp. See get_value for the min_timestamp.
     """
+    if not (include_value or include_ts):
+        raise ValueError('include_value and/or include_timestamp must be True.')
+
     data_block_pos = get_last_data_block_pos(file, key_hash, n_buckets)
     if data_block_pos:
         key_len_pos = data_block_pos + key_hash_len + n_bytes_file
         file.seek(key_len_pos)
-        key_len_value_len = file.read(n_bytes_key + n_bytes_value)
-        key_len = bytes_to_int(key_len_value_len[:n_bytes_key])
-        value_len = bytes_to_int(key_len_value_len[n_bytes_key:])
-
-        if include_value and include_ts:
-            ts_key_value = file.read(ts_bytes_len + key_len + value_len)
-            ts_int = bytes_to_int(ts_key_value[:ts_bytes_len])
-            value = ts_key_value[ts_bytes_len + key_len:]
+        key_len_value_len_ts = file.read(n_bytes_key + n_bytes_value + ts_bytes_len)
+        key_len = read_key_len(key_len_value_len_ts[:n_bytes_key], key_width)
+        value_len = bytes_to_int(key_len_value_len_ts[n_bytes_key:n_bytes_key + n_bytes_value])
+        ts_int = bytes_to_int(key_len_value_len_ts[n_bytes_key + n_bytes_value:])
+
+        if (min_timestamp is not None) and (ts_int < min_timestamp):
+            return False
+
+        if include_value:
+            file.seek(key_len, 1)
+            value = file.read(value_len)
+        else:
+            value = None
+
+        if include_ts:
             output = value, ts_int
-        elif include_value:
-            file.seek(ts_bytes_len + key_len, 1)
-            output = (file.read(value_len), None)
-        elif include_ts:
-            output = (None, bytes_to_int(file.read(ts_bytes_len)))
         else:
-            raise ValueError('include_value and/or include_timestamp must be True.')
+            output = value, None
     else:
         output = False
 
     return output
 
 
-def iter_keys_value_from_start_end_pos(file, start, end, include_key, include_value, include_ts, ts_bytes_len):
+def iter_keys_value_from_start_end_pos(file, start, end, include_key, include_value, include_ts, ts_bytes_len, min_timestamp=None, key_filter=None, value_filter=None, value_pos=False, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
     """
-
+    If min_timestamp is passed, data blocks with older timestamps are skipped. The key_filter and value_filter are functions that are called with the raw (serialized) key or value bytes and return False to skip the data block. If a key_filter is passed, the timestamp and key are read before the value, so the values of skipped data blocks are never read. If value_pos is True, the (position, length) of the value is returned instead of the value and the value is not read.
     """
     one_extra_index_bytes_len = key_hash_len + n_bytes_file
     init_data_block_len = one_extra_index_bytes_len + n_bytes_key + n_bytes_value
@@ -335,52 +446,81 @@ def iter_keys_value_from_start_end_pos(file, start, end, include_key, include_va
         init_data_block = file.read(init_data_block_len)
 
         next_data_block_pos = bytes_to_int(init_data_block[key_hash_len:one_extra_index_bytes_len])
-        key_len = bytes_to_int(init_data_block[one_extra_index_bytes_len:one_extra_index_bytes_len + n_bytes_key])
+        key_len = read_key_len(init_data_block[one_extra_index_bytes_len:one_extra_index_bytes_len + n_bytes_key], key_width)
         value_len = bytes_to_int(init_data_block[one_extra_index_bytes_len + n_bytes_key:])
         ts_key_value_len = ts_bytes_len + key_len + value_len
         if next_data_block_pos: # A value of 0 means it was deleted
-            ts_key_value = file.read(ts_key_value_len)
+            value_start = next_block_pos + init_data_block_len + ts_bytes_len + key_len
+            if (key_filter is None) and (not value_pos):
+                ts_key_value = file.read(ts_key_value_len)
+            else:
+                ts_key_value = file.read(ts_bytes_len + key_len)
 
             # lock.release()
             next_block_pos += init_data_block_len + ts_key_value_len
 
             key = ts_key_value[ts_bytes_len:ts_bytes_len + key_len]
-            if key != metadata_key_bytes:
-                if include_ts:
-                    ts_int = bytes_to_int(ts_key_value[:ts_bytes_len])
-                    if include_value:
-                        value = ts_key_value[ts_bytes_len + key_len:]
-                        yield key, ts_int, value
-                    else:
-                        yield key, ts_int
-
-                elif include_key and include_value:
-                    value = ts_key_value[ts_bytes_len + key_len:]
-                    yield key, value
-
-                elif include_key:
-                    yield key
-
-                elif include_value:
-                    value = ts_key_value[ts_bytes_len + key_len:]
-                    yield value
+            if (min_timestamp is not None) and (bytes_to_int(ts_key_value[:ts_bytes_len]) < min_timestamp):
+                continue
+
+            if init_data_block[:key_hash_len] in reserved_key_hashes:
+                continue
+
+            if (key_filter is not None) and (not key_filter(key)):
+                continue
+
+            if len(ts_key_value) < ts_key_value_len:
+                if (include_value and (not value_pos)) or (value_filter is not None):
+                    ts_key_value += file.read(value_len)
+
+            if (value_filter is not None) and (not value_filter(ts_key_value[ts_bytes_len + key_len:])):
+                continue
+
+            if value_pos:
+                value = (value_start, value_len)
+            else:
+                value = ts_key_value[ts_bytes_len + key_len:]
+
+            if include_ts:
+                ts_int = bytes_to_int(ts_key_value[:ts_bytes_len])
+                if include_value:
+                    yield key, ts_int, value
                 else:
-                    raise ValueError('I need to include something for iter_keys_values.')
+                    yield key, ts_int
+
+            elif include_key and include_value:
+                yield key, value
+
+            elif include_key:
+                yield key
+
+            elif include_value:
+                yield value
+            else:
+                raise ValueError('I need to include something for iter_keys_values.')
         else:
             # lock.release()
             next_block_pos += init_data_block_len + ts_key_value_len
 
             # file.seek(ts_bytes_len + key_len + value_len, 1)
 
+def read_bytes(file, pos, n_bytes):
+    """
+    Read n_bytes from the file at pos.
+    """
+    file.seek(pos)
 
-def iter_keys_values(file, n_buckets, include_key, include_value, include_ts, ts_bytes_len):
+    return file.read(n_bytes)
+
+
+def iter_keys_values(file, n_buckets, include_key, include_value, include_ts, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
     """
 
     """
     end = file.seek(0, 2)
     start = sub_index_init_pos + (n_buckets * n_bytes_file)
 
-    return iter_keys_value_from_start_end_pos(file, start, end, include_key, include_value, include_ts, ts_bytes_len)
+    return iter_keys_value_from_start_end_pos(file, start, end, include_key, include_value, include_ts, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)
 
 
 def assign_delete_flag(file, key_hash, n_buckets):
@@ -406,7 +546,7 @@ def assign_delete_flag(file, key_hash, n_buckets):
                     file.write(b'\x00\x00\x00\x00\x00\x00')
                     file.seek(previous_data_index_pos)
                     # file.write(b'\x01\x00\x00\x00\x00\x00')
-                    file.write(next_data_block_pos_bytes)
+                    file.write(get_unlinked_pos_bytes(previous_data_index_pos, bucket_index_pos, next_data_block_pos_bytes))
                     return True
 
                 elif next_data_block_pos == 1:
@@ -421,25 +561,79 @@ def assign_delete_flag(file, key_hash, n_buckets):
         return False
 
 
-def write_data_blocks(file, key, value, n_buckets, buffer_data, buffer_index, buffer_index_set, write_buffer_size, timestamp=None, ts_bytes_len=0):
+def get_unlinked_pos_bytes(previous_data_index_pos, bucket_index_pos, next_data_block_pos_bytes):
+    """
+    The position bytes to write to the previous data index when a data block is removed from its chain. The end of chain flag (1) is only valid in a data block, so a bucket whose only data block is removed becomes empty (0).
+    """
+    if (previous_data_index_pos == bucket_index_pos) and (next_data_block_pos_bytes == b'\x01\x00\x00\x00\x00\x00'):
+        return b'\x00\x00\x00\x00\x00\x00'
+    else:
+        return next_data_block_pos_bytes
+
+
+def assign_delete_flags(file, key_hashes, n_buckets):
+    """
+    Assigns the delete flags for many key hashes. The key hashes are grouped by bucket so that each bucket chain is only walked once. Returns the number of deleted keys.
     """
+    index_len = key_hash_len + n_bytes_file
+
+    bucket_key_hashes = defaultdict(set)
+    for key_hash in key_hashes:
+        bucket_key_hashes[get_index_bucket(key_hash, n_buckets)].add(key_hash)
+
+    n_deleted = 0
+    for index_bucket in sorted(bucket_key_hashes):
+        key_hashes_set = bucket_key_hashes[index_bucket]
+        bucket_index_pos = get_bucket_index_pos(index_bucket)
+        previous_data_index_pos = bucket_index_pos
+        data_block_pos = get_first_data_block_pos(file, bucket_index_pos)
+        while data_block_pos and key_hashes_set:
+            file.seek(data_block_pos)
+            data_index = file.read(index_len)
+            next_data_block_pos_bytes = data_index[key_hash_len:]
+            next_data_block_pos = bytes_to_int(next_data_block_pos_bytes)
+            if not next_data_block_pos:
+                break
+
+            key_hash = data_index[:key_hash_len]
+            if key_hash in key_hashes_set:
+                file.seek(-n_bytes_file, 1)
+                file.write(b'\x00\x00\x00\x00\x00\x00')
+                file.seek(previous_data_index_pos)
+                file.write(get_unlinked_pos_bytes(previous_data_index_pos, bucket_index_pos, next_data_block_pos_bytes))
+                key_hashes_set.remove(key_hash)
+                n_deleted += 1
+            else:
+                previous_data_index_pos = data_block_pos + key_hash_len
+
+            if next_data_block_pos == 1:
+                break
+
+            data_block_pos = next_data_block_pos
+
+    return n_deleted
 
+
+def write_data_blocks(file, key, value, n_buckets, buffer_data, buffer_index, buffer_index_set, write_buffer_size, timestamp=None, ts_bytes_len=0, key_hash=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    The key_hash can be passed if it has already been calculated.
     """
     n_keys = 0
 
     ## Prep data
     file_len = file.seek(0, 2)
 
-    key_hash = hash_key(key)
+    if key_hash is None:
+        key_hash = hash_key(key)
     key_bytes_len = len(key)
     value_bytes_len = len(value)
 
     if ts_bytes_len:
         ts_int = make_timestamp_int(timestamp)
         ts_bytes = int_to_bytes(ts_int, ts_bytes_len)
-        write_bytes = key_hash + b'\x01\x00\x00\x00\x00\x00' + int_to_bytes(key_bytes_len, n_bytes_key) + int_to_bytes(value_bytes_len, n_bytes_value) + ts_bytes + key + value
+        write_bytes = key_hash + b'\x01\x00\x00\x00\x00\x00' + make_key_len_bytes(key_bytes_len, n_bytes_key, key_width) + int_to_bytes(value_bytes_len, n_bytes_value) + ts_bytes + key + value
     else:
-        write_bytes = key_hash + b'\x01\x00\x00\x00\x00\x00' + int_to_bytes(key_bytes_len, n_bytes_key) + int_to_bytes(value_bytes_len, n_bytes_value) + key + value
+        write_bytes = key_hash + b'\x01\x00\x00\x00\x00\x00' + make_key_len_bytes(key_bytes_len, n_bytes_key, key_width) + int_to_bytes(value_bytes_len, n_bytes_value) + key + value
 
     ## flush write buffer if the size is getting too large
     bd_pos = len(buffer_data)
@@ -461,6 +655,222 @@ def write_data_blocks(file, key, value, n_buckets, buffer_data, buffer_index, bu
     return n_keys
 
 
+def write_data_block_head(file, key_hash, key, value_len, ts_int, ts_bytes_len=0, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Write the start of a data block (everything except the value) to the end of the file for a value that is streamed to the file afterwards. Returns the data block position. The data block is written as deleted, so that it's skipped until it has been finished with finish_data_block.
+    """
+    data_block_pos = file.seek(0, 2)
+    head = key_hash + b'\x00\x00\x00\x00\x00\x00' + make_key_len_bytes(len(key), n_bytes_key, key_width) + int_to_bytes(value_len, n_bytes_value)
+    if ts_bytes_len:
+        head += int_to_bytes(ts_int, ts_bytes_len)
+    file.write(head + key)
+
+    return data_block_pos
+
+
+def finish_data_block(file, data_block_pos, key_len, value_len, live, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Write the final value length of a data block from write_data_block_head. If live, the data block is also marked as the last in its chain so that it can be added to the index with update_index. Otherwise it stays deleted.
+    """
+    if live:
+        next_data_block_pos_bytes = b'\x01\x00\x00\x00\x00\x00'
+    else:
+        next_data_block_pos_bytes = b'\x00\x00\x00\x00\x00\x00'
+
+    file.seek(data_block_pos + key_hash_len)
+    file.write(next_data_block_pos_bytes + make_key_len_bytes(key_len, n_bytes_key, key_width) + int_to_bytes(value_len, n_bytes_value))
+
+
+def get_data_block_len(key_len, value_len, ts_bytes_len=0, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    The total number of bytes of a data block.
+    """
+    return key_hash_len + n_bytes_file + n_bytes_key + n_bytes_value + ts_bytes_len + key_len + value_len
+
+
+def rebase_buffer_index(buffer_data, buffer_index, write_pos, ts_bytes_len=0, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Reassign the data block positions in the buffer index as if the buffer data will be written at write_pos. The buffer index has one entry per data block in the same order as the buffer data.
+    """
+    one_extra_index_bytes_len = key_hash_len + n_bytes_file
+    key_len_pos = key_hash_len + n_bytes_file
+    value_len_pos = key_len_pos + n_bytes_key
+    init_data_block_len = value_len_pos + n_bytes_value
+
+    bd_pos = 0
+    for index_pos in range(key_hash_len, len(buffer_index), one_extra_index_bytes_len):
+        buffer_index[index_pos:index_pos + n_bytes_file] = int_to_bytes(write_pos + bd_pos, n_bytes_file)
+
+        key_len = read_key_len(buffer_data[bd_pos + key_len_pos:bd_pos + value_len_pos], key_width)
+        value_len = bytes_to_int(buffer_data[bd_pos + value_len_pos:bd_pos + init_data_block_len])
+        bd_pos += init_data_block_len + ts_bytes_len + key_len + value_len
+
+
+def read_header_state(file):
+    """
+    Read the n_buckets, n_keys, committed data end, and generation from the file header in a single read. The data end and generation are only valid for files of the commit_version or later.
+    """
+    file.seek(n_buckets_pos)
+    state_bytes = file.read(generation_pos + n_bytes_generation - n_buckets_pos)
+    n_buckets = bytes_to_int(state_bytes[:4])
+    n_keys = bytes_to_int(state_bytes[n_keys_pos - n_buckets_pos:n_keys_pos + 4 - n_buckets_pos])
+    data_end = bytes_to_int(state_bytes[data_end_pos - n_buckets_pos:generation_pos - n_buckets_pos])
+    generation = bytes_to_int(state_bytes[generation_pos - n_buckets_pos:])
+
+    return n_buckets, n_keys, data_end, generation
+
+
+def read_generation(file):
+    """
+    Read only the generation from the file header.
+    """
+    file.seek(generation_pos)
+
+    return bytes_to_int(file.read(n_bytes_generation))
+
+
+def get_commit_bytes(data_end, generation):
+    """
+    The header bytes of the committed data end and the generation.
+    """
+    return int_to_bytes(data_end, n_bytes_file) + int_to_bytes(generation % 2**32, n_bytes_generation)
+
+
+def begin_commit(file, generation):
+    """
+    Write an odd generation to the header before the file is modified. Readers that don't lock the file retry their reads while the generation is odd or has changed.
+    """
+    file.seek(generation_pos)
+    file.write(int_to_bytes(generation % 2**32, n_bytes_generation))
+
+
+def end_commit(file, generation):
+    """
+    Write the end of the data blocks and an even generation to the header after the file has been modified. Returns the data end.
+    """
+    data_end = file.seek(0, 2)
+    file.seek(data_end_pos)
+    file.write(get_commit_bytes(data_end, generation))
+
+    return data_end
+
+
+def make_ttl_int(ttl):
+    """
+    Convert a ttl in seconds (int or float) to an int of microseconds. None or 0 means that items don't expire.
+    """
+    if not ttl:
+        return 0
+    elif isinstance(ttl, (int, float)) and (ttl > 0):
+        return int(ttl * 1000000)
+    else:
+        raise ValueError('ttl must be None or a positive number of seconds.')
+
+
+def get_min_timestamp(ttl):
+    """
+    The oldest item timestamp that has not expired. None if the ttl is 0.
+    """
+    if ttl:
+        return make_timestamp_int() - ttl
+    else:
+        return None
+
+
+def upgrade_header_bytes(header_bytes, version, n_buckets):
+    """
+    Upgrade the header bytes of a version 4 or later file to the current version by initializing the header fields that have been added since. The data blocks are the same in these versions.
+    """
+    header_bytes = bytearray(header_bytes)
+    if version < commit_version:
+        header_bytes[data_end_pos:generation_pos + n_bytes_generation] = get_commit_bytes(sub_index_init_pos + (n_buckets * n_bytes_file), 0)
+    if version < ttl_version:
+        header_bytes[ttl_pos:ttl_pos + timestamp_bytes_len] = int_to_bytes(0, timestamp_bytes_len)
+    if version < compression_version:
+        header_bytes[compression_pos] = compressions[None]
+    if version < codec_version:
+        header_bytes[compression_pos:compression_threads_pos + 1] = make_compression_bytes(header_bytes[compression_pos], None, 0)
+    if version < dedup_version:
+        header_bytes[dedup_pos] = 0
+    header_bytes[16:18] = current_version_bytes
+
+    return header_bytes
+
+
+def get_compression_code(compression):
+    """
+    Returns the saved int code of a compression name.
+    """
+    if compression not in compressions or compression == 'zstd_dict':
+        raise ValueError('compression must be one of None, zstd, or lz4.')
+
+    return compressions[compression]
+
+
+def make_codec(compression, level, threads, zstd_dict):
+    """
+    Create the codec of the saved compression code. The codec reuses its compression contexts for all of the values. Returns None if the values are not compressed.
+    """
+    if compression:
+        if compression == compressions['lz4'] and 'lz4' not in serializers.imports:
+            raise ImportError('The file values are compressed with lz4, but lz4 is not installed.')
+        return codecs[compression](level, threads, zstd_dict)
+    else:
+        return None
+
+
+def make_compression_bytes(compression, level, threads):
+    """
+    The compression code, level, and number of threads of the header. A level of None is saved as the default level of the codec.
+    """
+    if level is None:
+        level = codecs[compression].default_level if compression else 0
+
+    return int_to_bytes(compression, 1) + int_to_bytes(level, 1, True) + int_to_bytes(threads, 1)
+
+
+def train_zstd_dict(samples, dict_size):
+    """
+    Train a zstd dictionary from the sample values and return the dictionary bytes.
+    """
+    return serializers.zstd.train_dictionary(dict_size, samples).as_bytes()
+
+
+def check_lock_mode(lock_mode, write):
+    """
+    Check that the lock_mode is valid for the flag.
+    """
+    if lock_mode not in lock_modes:
+        raise ValueError('lock_mode must be one of {}.'.format(', '.join(lock_modes)))
+    if write and (lock_mode == 'none'):
+        raise ValueError("lock_mode 'none' can only be used for reading.")
+
+
+def take(iterator, n):
+    """
+    Return a list of the next n items of the iterator.
+    """
+    return list(islice(iterator, n))
+
+
+def count_keys(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Count the keys by iterating through the data blocks. Only used when the file was closed incorrectly.
+    """
+    counter = count()
+    deque(zip(iter_keys_values(file, n_buckets, True, False, False, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width), counter), maxlen=0)
+
+    return next(counter)
+
+
+def release_session_lock(file, lock_mode):
+    """
+    Release the lock taken when the file was opened if the lock_mode doesn't hold it until the file is closed.
+    """
+    if lock_mode != 'session':
+        portalocker.lock(file, portalocker.LOCK_UN)
+
+
 def flush_data_buffer(file, buffer_data, write_pos):
     """
 
@@ -564,11 +974,411 @@ def clear(file, n_buckets, n_keys_pos, write_buffer_size):
     file.flush()
 
 
-def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n_bytes_value, write_buffer_size, ts_bytes_len, buffer_data, buffer_index, buffer_index_set):
+def iter_data_blocks_ts_pos(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Iterate over the timestamp, position, and length of all of the live data blocks (excluding the reserved data blocks).
+    """
+    one_extra_index_bytes_len = key_hash_len + n_bytes_file
+    init_data_block_len = one_extra_index_bytes_len + n_bytes_key + n_bytes_value
+
+    data_block_pos = sub_index_init_pos + (n_buckets * n_bytes_file)
+    end = file.seek(0, 2)
+
+    while data_block_pos < end:
+        file.seek(data_block_pos)
+        init_data_block_ts = file.read(init_data_block_len + ts_bytes_len)
+        next_data_block_pos = bytes_to_int(init_data_block_ts[key_hash_len:one_extra_index_bytes_len])
+        key_len = read_key_len(init_data_block_ts[one_extra_index_bytes_len:one_extra_index_bytes_len + n_bytes_key], key_width)
+        value_len = bytes_to_int(init_data_block_ts[one_extra_index_bytes_len + n_bytes_key:init_data_block_len])
+        data_block_len = init_data_block_len + ts_bytes_len + key_len + value_len
+        if next_data_block_pos and (init_data_block_ts[:key_hash_len] not in reserved_key_hashes):
+            yield bytes_to_int(init_data_block_ts[init_data_block_len:]), data_block_pos, data_block_len
+
+        data_block_pos += data_block_len
+
+
+def get_eviction_timestamp(file, n_buckets, ts_bytes_len, max_keys=None, max_bytes=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
     """
+    Determine the timestamp for a prune that removes the oldest items so that the number of items is within max_keys and the file size is within max_bytes (both reduced by the evict_fraction to leave room for new items). Returns None if nothing needs to be removed.
+    """
+    data_start = sub_index_init_pos + (n_buckets * n_bytes_file)
+    end = file.seek(0, 2)
+
+    ## Get the timestamps and lengths of all of the live data blocks
+    ts_lens = [(ts_int, block_len) for ts_int, _, block_len in iter_data_blocks_ts_pos(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)]
+
+    ## Keep the newest items that fit
+    if max_keys is None:
+        keys_limit = len(ts_lens)
+    else:
+        keys_limit = int(max_keys * evict_fraction)
+    if max_bytes is None:
+        bytes_limit = end
+    else:
+        bytes_limit = int(max_bytes * evict_fraction) - data_start
 
+    if (len(ts_lens) <= keys_limit) and (sum(block_len for _, block_len in ts_lens) <= bytes_limit):
+        return None
+
+    ts_lens.sort(reverse=True)
+    n_keys = 0
+    n_bytes = 0
+    for ts_int, block_len in ts_lens:
+        if (n_keys + 1 > keys_limit) or (n_bytes + block_len > bytes_limit):
+            # Remove everything older than the oldest item that was kept
+            return ts_int + 1
+        n_keys += 1
+        n_bytes += block_len
+
+    return None
+
+
+def get_index_path(file_path, suffix):
     """
-    metadata_key_added = False
+    The timestamp and key indexes are stored in separate files next to the booklet file.
+    """
+    return pathlib.Path(str(file_path) + suffix)
+
+
+def get_buffer_entries(buffer_data, buffer_index, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Get the (data block position, key, timestamp) of the data blocks in the buffer. The positions in the buffer index must already be the positions that the buffer data will be written to.
+    """
+    one_extra_index_bytes_len = key_hash_len + n_bytes_file
+    key_len_pos = key_hash_len + n_bytes_file
+    value_len_pos = key_len_pos + n_bytes_key
+    init_data_block_len = value_len_pos + n_bytes_value
+
+    entries = []
+    bd_pos = 0
+    for index_pos in range(key_hash_len, len(buffer_index), one_extra_index_bytes_len):
+        data_block_pos = bytes_to_int(buffer_index[index_pos:index_pos + n_bytes_file])
+        key_len = read_key_len(buffer_data[bd_pos + key_len_pos:bd_pos + value_len_pos], key_width)
+        value_len = bytes_to_int(buffer_data[bd_pos + value_len_pos:bd_pos + init_data_block_len])
+        ts_int = bytes_to_int(buffer_data[bd_pos + init_data_block_len:bd_pos + init_data_block_len + ts_bytes_len])
+        key_pos = bd_pos + init_data_block_len + ts_bytes_len
+        entries.append((data_block_pos, bytes(buffer_data[key_pos:key_pos + key_len]), ts_int))
+
+        bd_pos = key_pos + key_len + value_len
+
+    return entries
+
+
+def read_live_data_block(file, data_block_pos, include_value, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Read the key, timestamp, and value (None if include_value is False) of the data block at data_block_pos. Returns None if the data block has been deleted (or overwritten) or if it's a reserved data block (e.g. the metadata).
+    """
+    one_extra_index_bytes_len = key_hash_len + n_bytes_file
+    init_data_block_len = one_extra_index_bytes_len + n_bytes_key + n_bytes_value
+
+    file.seek(data_block_pos)
+    init_data_block_ts = file.read(init_data_block_len + ts_bytes_len)
+    next_data_block_pos = bytes_to_int(init_data_block_ts[key_hash_len:one_extra_index_bytes_len])
+    if (not next_data_block_pos) or (init_data_block_ts[:key_hash_len] in reserved_key_hashes):
+        return None
+
+    key_len = read_key_len(init_data_block_ts[one_extra_index_bytes_len:one_extra_index_bytes_len + n_bytes_key], key_width)
+    ts_int = bytes_to_int(init_data_block_ts[init_data_block_len:])
+    if include_value:
+        value_len = bytes_to_int(init_data_block_ts[one_extra_index_bytes_len + n_bytes_key:init_data_block_len])
+        key_value = file.read(key_len + value_len)
+        return key_value[:key_len], ts_int, key_value[key_len:]
+    else:
+        return file.read(key_len), ts_int, None
+
+
+def write_index_file(index_path, run):
+    """
+    Replace an index file with a single run. The index is written to a temp file first and then moved into place so that readers never read a partial index.
+    """
+    temp_path = index_path.with_name(index_path.name + '.tmp')
+    with io.open(temp_path, 'wb') as f:
+        f.write(run)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, index_path)
+
+
+def append_index_run(index_path, run, read_runs):
+    """
+    Append a run to an index file. The runs are merged (and the stale entries removed) by the caller once there are more than index_max_runs. Returns the number of runs.
+    """
+    with io.open(index_path, 'a+b') as f:
+        f.write(run)
+        f.flush()
+
+        return len(read_runs(f))
+
+
+### Timestamp index
+# Runs of (timestamp, data block position) entries sorted by timestamp
+
+
+def make_ts_index_run(entries):
+    """
+    A run is the number of entries followed by the entries sorted by timestamp.
+    """
+    entries = sorted(entries)
+    run = bytearray(int_to_bytes(len(entries), n_bytes_index_run))
+    for ts_int, data_block_pos in entries:
+        run.extend(int_to_bytes(ts_int, timestamp_bytes_len) + int_to_bytes(data_block_pos, n_bytes_file))
+
+    return run
+
+
+def read_ts_index_runs(ts_file):
+    """
+    Get the (start position, number of entries) of the runs in the timestamp index.
+    """
+    runs = []
+    run_pos = 0
+    end = ts_file.seek(0, 2)
+    while run_pos < end:
+        ts_file.seek(run_pos)
+        n_entries = bytes_to_int(ts_file.read(n_bytes_index_run))
+        runs.append((run_pos + n_bytes_index_run, n_entries))
+        run_pos += n_bytes_index_run + (n_entries * ts_index_entry_len)
+
+    return runs
+
+
+def search_ts_index(ts_file, min_timestamp):
+    """
+    Get the (timestamp, data block position) entries with timestamps >= min_timestamp sorted by timestamp. Each run is binary searched for the first entry, so only the matching entries are read.
+    """
+    entries = []
+    for run_start, n_entries in read_ts_index_runs(ts_file):
+        low = 0
+        high = n_entries
+        while low < high:
+            mid = (low + high) // 2
+            ts_file.seek(run_start + (mid * ts_index_entry_len))
+            if bytes_to_int(ts_file.read(timestamp_bytes_len)) < min_timestamp:
+                low = mid + 1
+            else:
+                high = mid
+
+        ts_file.seek(run_start + (low * ts_index_entry_len))
+        entries_bytes = ts_file.read((n_entries - low) * ts_index_entry_len)
+        for entry_pos in range(0, len(entries_bytes), ts_index_entry_len):
+            entries.append((bytes_to_int(entries_bytes[entry_pos:entry_pos + timestamp_bytes_len]), bytes_to_int(entries_bytes[entry_pos + timestamp_bytes_len:entry_pos + ts_index_entry_len])))
+
+    entries.sort()
+
+    return entries
+
+
+def build_ts_index(ts_index_path, file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Create the timestamp index from all of the live data blocks.
+    """
+    entries = [(ts_int, data_block_pos) for ts_int, data_block_pos, _ in iter_data_blocks_ts_pos(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)]
+    write_index_file(ts_index_path, make_ts_index_run(entries))
+
+
+def compact_ts_index(ts_index_path, file, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Merge the runs of the timestamp index into one and remove the stale entries. Entries are stale if the data block has been deleted or if its timestamp was changed by set_timestamp.
+    """
+    with io.open(ts_index_path, 'rb') as f:
+        entries = search_ts_index(f, 0)
+
+    live_entries = []
+    for ts_int, data_block_pos in entries:
+        data_block = read_live_data_block(file, data_block_pos, False, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)
+        if (data_block is not None) and (data_block[1] == ts_int):
+            live_entries.append((ts_int, data_block_pos))
+
+    write_index_file(ts_index_path, make_ts_index_run(live_entries))
+
+
+### Key index
+# Runs of (ordered key, data block position) entries sorted by the ordered key. The ordered key is the serialized key converted by the order function of the key serializer (if it has one). The entries have variable lengths, so each run has a table of the entry offsets for the binary search.
+
+
+def make_key_index_run(entries):
+    """
+    A run is the number of entries and the length of the entries, then the entry offsets, then the entries sorted by the ordered key. Each entry is the ordered key length, the ordered key, and the data block position.
+    """
+    entries = sorted(entries)
+    offsets = bytearray()
+    entries_bytes = bytearray()
+    for order_key, data_block_pos in entries:
+        offsets.extend(int_to_bytes(len(entries_bytes), n_bytes_file))
+        entries_bytes.extend(int_to_bytes(len(order_key), n_bytes_key) + order_key + int_to_bytes(data_block_pos, n_bytes_file))
+
+    return int_to_bytes(len(entries), n_bytes_index_run) + int_to_bytes(len(entries_bytes), n_bytes_file) + offsets + entries_bytes
+
+
+def read_key_index_runs(key_file):
+    """
+    Get the (offsets start position, entries start position, number of entries) of the runs in the key index.
+    """
+    runs = []
+    run_pos = 0
+    end = key_file.seek(0, 2)
+    while run_pos < end:
+        key_file.seek(run_pos)
+        run_header = key_file.read(n_bytes_index_run + n_bytes_file)
+        n_entries = bytes_to_int(run_header[:n_bytes_index_run])
+        entries_len = bytes_to_int(run_header[n_bytes_index_run:])
+        offsets_start = run_pos + n_bytes_index_run + n_bytes_file
+        entries_start = offsets_start + (n_entries * n_bytes_file)
+        runs.append((offsets_start, entries_start, n_entries))
+        run_pos = entries_start + entries_len
+
+    return runs
+
+
+def read_key_index_entry(key_file):
+    """
+    Read the key index entry at the current position of the key_file.
+    """
+    order_key = key_file.read(bytes_to_int(key_file.read(n_bytes_key)))
+    data_block_pos = bytes_to_int(key_file.read(n_bytes_file))
+
+    return order_key, data_block_pos
+
+
+def search_key_index(key_file, lower=None, upper=None, prefix=None):
+    """
+    Get the (ordered key, data block position) entries with lower <= ordered key < upper that start with the prefix, sorted by the ordered key. None means no bound. Each run is binary searched for the first entry, so only the matching entries are read. The key_file should be buffered.
+    """
+    if (prefix is not None) and ((lower is None) or (prefix > lower)):
+        lower = prefix
+
+    entries = []
+    for offsets_start, entries_start, n_entries in read_key_index_runs(key_file):
+        low = 0
+        high = n_entries
+        while low < high:
+            mid = (low + high) // 2
+            key_file.seek(offsets_start + (mid * n_bytes_file))
+            key_file.seek(entries_start + bytes_to_int(key_file.read(n_bytes_file)))
+            if (lower is not None) and (read_key_index_entry(key_file)[0] < lower):
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < n_entries:
+            key_file.seek(offsets_start + (low * n_bytes_file))
+            key_file.seek(entries_start + bytes_to_int(key_file.read(n_bytes_file)))
+            for _ in range(low, n_entries):
+                order_key, data_block_pos = read_key_index_entry(key_file)
+                if ((upper is not None) and (order_key >= upper)) or ((prefix is not None) and (not order_key.startswith(prefix))):
+                    break
+                entries.append((order_key, data_block_pos))
+
+    entries.sort()
+
+    return entries
+
+
+def build_key_index(key_index_path, file, n_buckets, ts_bytes_len, order_key, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Create the key index from all of the live data blocks. order_key is the function that converts a serialized key to an ordered key.
+    """
+    entries = []
+    for _, data_block_pos, _ in iter_data_blocks_ts_pos(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width):
+        key = read_live_data_block(file, data_block_pos, False, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)[0]
+        entries.append((order_key(key), data_block_pos))
+
+    write_index_file(key_index_path, make_key_index_run(entries))
+
+
+### Value indexes
+# The same runs as the key index, but the entries are the encoded index values (extracted from the values) and the data block positions
+
+
+def get_value_index_path(file_path, name):
+    """
+    The value index files are named after the booklet file and the index name.
+    """
+    return get_index_path(file_path, '.' + name + value_index_suffix)
+
+
+def read_namespaces(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Read the dict of namespace name to the [key, value] serializer codes from the file. It's empty if the file has no namespaces.
+    """
+    namespaces = get_value(file, namespaces_key_hash, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)
+    if namespaces:
+        return orjson.loads(namespaces)
+    else:
+        return {}
+
+
+def get_namespace_prefix(name):
+    """
+    The prefix of the serialized keys of the items of a namespace. The names are identifiers, so they can't contain the null byte that ends them.
+    """
+    return namespace_key_prefix + name.encode() + b'\x00'
+
+
+def make_prefix_filter(key_prefix, key_filter=None):
+    """
+    Make a key_filter for the data blocks of the keys that start with the key_prefix. The key_filter is called with the key without the prefix.
+    """
+    prefix_len = len(key_prefix)
+    if key_filter is None:
+        return lambda key: key.startswith(key_prefix)
+    else:
+        return lambda key: key.startswith(key_prefix) and key_filter(key[prefix_len:])
+
+
+def iter_value_index_names(file_path):
+    """
+    Iterate over the names of the value indexes that exist for the booklet file.
+    """
+    fp = pathlib.Path(file_path)
+    start = fp.name + '.'
+    for file_name in os.listdir(fp.parent):
+        if file_name.startswith(start) and file_name.endswith(value_index_suffix):
+            yield file_name[len(start):-len(value_index_suffix)]
+
+
+def encode_index_value(index_value):
+    """
+    Index values are encoded with orjson so that they can be compared as bytes. None is not indexed.
+    """
+    if index_value is None:
+        return None
+
+    return orjson.dumps(index_value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def build_value_index(value_index_path, file, n_buckets, ts_bytes_len, extract, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Create a value index from all of the live data blocks. extract is the function that returns the index value from the serialized value.
+    """
+    entries = []
+    for _, data_block_pos, _ in iter_data_blocks_ts_pos(file, n_buckets, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width):
+        value = read_live_data_block(file, data_block_pos, True, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width)[2]
+        index_value = encode_index_value(extract(value))
+        if index_value is not None:
+            entries.append((index_value, data_block_pos))
+
+    write_index_file(value_index_path, make_key_index_run(entries))
+
+
+def compact_key_index(key_index_path, file, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=0):
+    """
+    Merge the runs of the key index (or a value index) into one and remove the entries of deleted data blocks.
+    """
+    with io.open(key_index_path, 'rb') as f:
+        entries = search_key_index(f)
+
+    live_entries = [(order_key, data_block_pos) for order_key, data_block_pos in entries if read_live_data_block(file, data_block_pos, False, ts_bytes_len, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, key_width=key_width) is not None]
+
+    write_index_file(key_index_path, make_key_index_run(live_entries))
+
+
+def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n_bytes_value, write_buffer_size, ts_bytes_len, buffer_data, buffer_index, buffer_index_set, key_width=0):
+    """
+
+    """
+    n_reserved_keys = 0
 
     one_extra_index_bytes_len = key_hash_len + n_bytes_file
     init_data_block_len = one_extra_index_bytes_len + n_bytes_key + n_bytes_value
@@ -615,7 +1425,7 @@ def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n
         next_data_block_pos = bytes_to_int(init_data_block[key_hash_len:one_extra_index_bytes_len])
 
         key_len_bytes = init_data_block[one_extra_index_bytes_len:one_extra_index_bytes_len + n_bytes_key]
-        key_len = bytes_to_int(key_len_bytes)
+        key_len = read_key_len(key_len_bytes, key_width)
 
         value_len_bytes = init_data_block[one_extra_index_bytes_len + n_bytes_key:]
         value_len = bytes_to_int(value_len_bytes)
@@ -626,11 +1436,11 @@ def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n
 
             key_hash = init_data_block[:key_hash_len]
 
-            # Check if it's the metadata key - remove from n_keys at the end
-            if key_hash == metadata_key_hash:
-                metadata_key_added = True
+            # Check if it's a reserved key (e.g. the metadata) - remove from n_keys at the end
+            if key_hash in reserved_key_hashes:
+                n_reserved_keys += 1
 
-            # timestamp filter - don't remove metadata even if older
+            # timestamp filter - don't remove the reserved keys even if older
             elif timestamp and ts_bytes_len:
                 ts_int = bytes_to_int(ts_key_value_bytes[:ts_bytes_len])
                 if ts_int < timestamp:
@@ -670,8 +1480,7 @@ def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n
     os.ftruncate(file.fileno(), data_block_write_start_pos)
     os.fsync(file.fileno())
 
-    if metadata_key_added:
-        n_keys -= 1
+    n_keys -= n_reserved_keys
 
     return n_keys, removed_count, n_buckets
 
@@ -699,7 +1508,7 @@ def prune_file(file, timestamp, reindex, n_buckets, n_bytes_file, n_bytes_key, n
 
 
 
-def init_files_variable(self, file_path, flag, key_serializer, value_serializer, n_buckets, write_buffer_size, init_timestamps, init_bytes):
+def init_files_variable(self, file_path, flag, key_serializer, value_serializer, n_buckets, write_buffer_size, init_timestamps, init_bytes, lock_mode='session', ttl=None, max_keys=None, max_bytes=None, ts_index=False, key_index=False, indexes=None, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, dedup=False):
     """
 
     """
@@ -721,6 +1530,9 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
     else:
         raise ValueError("Invalid flag")
 
+    check_lock_mode(lock_mode, write)
+    self._lock_mode = lock_mode
+
     self.writable = write
     self._write_buffer_size = write_buffer_size
 
@@ -744,7 +1556,8 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
             self._file = io.open(fp, 'rb', buffering=0)
 
             ## Lock
-            portalocker.lock(self._file, portalocker.LOCK_SH)
+            if lock_mode != 'none':
+                portalocker.lock(self._file, portalocker.LOCK_SH)
             # if self._platform.startswith('linux'):
             #     flock(self._fd, LOCK_SH)
 
@@ -759,6 +1572,9 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
 
         ## Read the rest of the base parameters
         read_base_params_variable(self, base_param_bytes, key_serializer, value_serializer)
+        if self._version > current_version:
+            portalocker.lock(self._file, portalocker.LOCK_UN)
+            raise ValueError('File was created by a newer version of booklet. Please upgrade booklet.')
         if self._version < 4:
             if self._version == 3:
                self._init_timestamps = 0
@@ -766,14 +1582,27 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
             else:
                 raise ValueError('File is an older version.')
 
+        ## Upgrade the header of older versions with the same data blocks
+        if write and (4 <= self._version < current_version):
+            base_param_bytes = upgrade_header_bytes(base_param_bytes, self._version, self._n_buckets)
+            self._file.seek(0)
+            self._file.write(base_param_bytes)
+            read_base_params_variable(self, base_param_bytes, key_serializer, value_serializer)
+
+        ## Publish a committed state for readers that don't lock the file
+        if write:
+            if self._generation is not None:
+                # An odd generation means that a previous writer didn't finish
+                self._generation += self._generation % 2
+                self._data_end = end_commit(self._file, self._generation)
+        elif (lock_mode == 'none') and (self._generation is None):
+            raise ValueError("The file is an older version. It must be opened for writing once before it can be read with lock_mode 'none'.")
+
         ## Check the n_keys
         if self._n_keys == n_keys_crash:
-            if write:
+            if write or (lock_mode == 'none'):
                 # print('File must have been closed incorrectly...rebuilding the n_keys...')
-                counter = count()
-                deque(zip(self.keys(), counter), maxlen=0)
-
-                self._n_keys = next(counter)
+                self._n_keys = count_keys(self._file, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
             else:
                 raise ValueError('File must have been closed incorrectly. Please open with write access to fix it.')
 
@@ -790,26 +1619,47 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
         if isinstance(init_bytes, (bytes, bytearray)):
             init_bytes = bytearray(init_bytes)
             read_base_params_variable(self, init_bytes, key_serializer, value_serializer)
+            if 4 <= self._version < current_version:
+                init_bytes = upgrade_header_bytes(init_bytes, self._version, self._n_buckets)
+                read_base_params_variable(self, init_bytes, key_serializer, value_serializer)
             # 0 out the n_keys
             init_bytes[n_keys_pos:n_keys_pos+4] = int_to_bytes(0, 4)
+            if self._version >= commit_version:
+                self._generation = 0
+                self._data_end = sub_index_init_pos + (self._n_buckets * n_bytes_file)
+                init_bytes[data_end_pos:generation_pos + n_bytes_generation] = get_commit_bytes(self._data_end, self._generation)
+            # The zstd dictionary is a data block, so it isn't copied
+            if self._version >= compression_version and self._compression == compressions['zstd_dict']:
+                self._compression = compressions['zstd']
+                init_bytes[compression_pos] = self._compression
         else:
             file_timestamp = make_timestamp_int()
 
             uuid8 = uuid.uuid8()
 
-            init_bytes = init_base_params_variable(self, key_serializer, value_serializer, n_buckets, init_timestamps, file_timestamp, uuid8)
+            check_n_bytes(n_bytes_key, n_bytes_value)
+            init_bytes = init_base_params_variable(self, key_serializer, value_serializer, n_buckets, init_timestamps, file_timestamp, uuid8, n_bytes_key, n_bytes_value, dedup)
+            self._key_width = get_key_width(n_bytes_key, self._key_serializer)
 
             self.uuid = uuid8
+            self._version = current_version
+            self._generation = 0
+            self._ttl = 0
+            self._compression = compressions[None]
+            self._compression_level = 0
+            self._compression_threads = 0
+            self._data_end = sub_index_init_pos + (n_buckets * n_bytes_file)
             self._n_buckets = n_buckets
             self._init_timestamps = init_timestamps
             if self._init_timestamps:
                 self._ts_bytes_len = timestamp_bytes_len
             else:
                 self._ts_bytes_len = 0
+            self._n_bytes_key = n_bytes_key
+            self._n_bytes_value = n_bytes_value
+            self._dedup = dedup
 
         self._n_bytes_file = n_bytes_file
-        self._n_bytes_key = n_bytes_key
-        self._n_bytes_value = n_bytes_value
 
         self._n_keys = 0
         self._n_keys_pos = n_keys_pos
@@ -827,8 +1677,105 @@ def init_files_variable(self, file_path, flag, key_serializer, value_serializer,
 
             write_init_bucket_indexes(self._file, self._n_buckets, sub_index_init_pos, write_buffer_size)
 
+    ## The zstd dictionary of the values
+    self._zstd_dict = None
+    if self._compression == compressions['zstd_dict']:
+        self._zstd_dict = get_value(self._file, zstd_dict_key_hash, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+    self._codec = make_codec(self._compression, self._compression_level, self._compression_threads, self._zstd_dict)
+    self._file_map = None
+
+    ## The serializer codes of the namespaces
+    self._namespaces = read_namespaces(self._file, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+    if self._namespaces and (ts_index or key_index or indexes):
+        self._file.close()
+        raise ValueError('The timestamp, key, and value indexes can not be used in a file with namespaces.')
+
+    ## The deduplicated values are stored once in the blobs file
+    self._blobs = None
+    if self._dedup:
+        if not fp_exists:
+            blobs_flag = 'n'
+        elif write:
+            blobs_flag = 'w'
+        else:
+            blobs_flag = 'r'
+        try:
+            self._blobs = self._open_blobs(blobs_flag)
+        except Exception:
+            self._file.close()
+            raise
+
+    ## Time to live of the items
+    if ttl is not None:
+        self._ttl = make_ttl_int(ttl)
+        if self._ttl and not self._init_timestamps:
+            self._file.close()
+            raise ValueError('A ttl can only be used if timestamps were initialized with the file.')
+        if write and (self._version >= ttl_version):
+            self._file.seek(ttl_pos)
+            self._file.write(int_to_bytes(self._ttl, timestamp_bytes_len))
+
+    ## Size limits
+    self._max_keys = max_keys
+    self._max_bytes = max_bytes
+    if (max_keys or max_bytes) and not self._init_timestamps:
+        self._file.close()
+        raise ValueError('max_keys and max_bytes can only be used if timestamps were initialized with the file.')
+
+    ## Timestamp and key indexes
+    # Writers maintain the indexes if they already exist so that they never miss items
+    self._ts_index_path = get_index_path(fp, ts_index_suffix)
+    self._key_index_path = get_index_path(fp, key_index_suffix)
+    self._ts_index_entries = []
+    self._key_index_entries = []
+    self._order_key = getattr(self._key_serializer, 'order', bytes)
+    if write:
+        self._ts_index = ts_index or self._ts_index_path.exists()
+        self._key_index = key_index or self._key_index_path.exists()
+        if self._ts_index:
+            if not self._init_timestamps:
+                self._file.close()
+                raise ValueError('A timestamp index can only be used if timestamps were initialized with the file.')
+            if (not fp_exists) or (not self._ts_index_path.exists()):
+                build_ts_index(self._ts_index_path, self._file, self._n_buckets, self._ts_bytes_len, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+        if self._key_index and ((not fp_exists) or (not self._key_index_path.exists())):
+            build_key_index(self._key_index_path, self._file, self._n_buckets, self._ts_bytes_len, self._order_key, n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+    else:
+        self._ts_index = False
+        self._key_index = False
+
+    ## Value indexes
+    # The extractor functions can't be saved in the file, so every writer must have them
+    self._value_indexes = {}
+    self._value_index_entries = {}
+    self._buffer_index_values = []
+    if write:
+        if indexes:
+            for name in indexes:
+                if not name.isidentifier():
+                    self._file.close()
+                    raise ValueError('The index names must be valid identifiers.')
+            self._value_indexes = dict(indexes)
+
+        for name in iter_value_index_names(fp):
+            if name not in self._value_indexes:
+                if fp_exists:
+                    self._file.close()
+                    raise ValueError('The file has a value index named {} that must be passed in the indexes when the file is opened for writing. Remove the index file if it is no longer needed.'.format(name))
+                else:
+                    get_value_index_path(fp, name).unlink()
+
+        for name, extract in self._value_indexes.items():
+            self._value_index_entries[name] = []
+            value_index_path = get_value_index_path(fp, name)
+            if (not fp_exists) or (not value_index_path.exists()):
+                build_value_index(value_index_path, self._file, self._n_buckets, self._ts_bytes_len, lambda value: extract(self._post_value(value)), n_bytes_key=self._n_bytes_key, n_bytes_value=self._n_bytes_value, key_width=self._key_width)
+
+    ## Only hold the locks during operations if the lock_mode is not session
+    release_session_lock(self._file, lock_mode)
+
     ## Create finalizer
-    self._finalizer = weakref.finalize(self, close_files, self._file, n_keys_crash, self._n_keys_pos, self.writable)
+    self._finalizer = weakref.finalize(self, close_files, self._file, n_keys_crash, self._n_keys_pos, self.writable and (lock_mode == 'session'))
 
 
 def copy_file_range(fsrc, fdst, count, offset_src, offset_dst, write_buffer_size):
@@ -863,6 +1810,38 @@ def copy_file_range(fsrc, fdst, count, offset_src, offset_dst, write_buffer_size
     fdst.flush()
 
 
+def get_serializer_code(serializer, name):
+    """
+    Returns the saved int code of an in-built serializer or 0 for a custom serializer class.
+    """
+    if serializer in serializers.serial_name_dict:
+        return serializers.serial_name_dict[serializer]
+    elif inspect.isclass(serializer):
+        class_methods = dir(serializer)
+        if ('dumps' in class_methods) and ('loads' in class_methods):
+            return 0
+        else:
+            raise ValueError('If a class is passed for a serializer, then it must have dumps and loads methods.')
+    else:
+        raise ValueError('{} serializer must be one of None, {}, or a serializer class with dumps and loads methods.'.format(name, ', '.join(str(k) for k in serializers.serial_name_dict.keys())))
+
+
+def get_saved_serializer(saved_code, serializer, name):
+    """
+    Returns the in-built serializer of the saved int code. If the code is 0, then a custom serializer class must be passed.
+    """
+    if saved_code > 0:
+        return serializers.serial_int_dict[saved_code]
+    elif inspect.isclass(serializer):
+        class_methods = dir(serializer)
+        if ('dumps' in class_methods) and ('loads' in class_methods):
+            return serializer
+        else:
+            raise ValueError('If a custom class is passed for a serializer, then it must have dumps and loads methods.')
+    else:
+        raise ValueError('The file was created with a custom {0} serializer. It must be passed as {0}_serializer.'.format(name))
+
+
 def read_base_params_variable(self, base_param_bytes, key_serializer, value_serializer):
     """
 
@@ -888,68 +1867,79 @@ def read_base_params_variable(self, base_param_bytes, key_serializer, value_seri
 
     self.uuid = uuid.UUID(bytes=bytes(base_param_bytes[49:65]))
 
+    if self._version >= commit_version:
+        self._data_end = bytes_to_int(base_param_bytes[data_end_pos:generation_pos])
+        self._generation = bytes_to_int(base_param_bytes[generation_pos:generation_pos + n_bytes_generation])
+    else:
+        self._data_end = None
+        self._generation = None
+
+    if self._version >= ttl_version:
+        self._ttl = bytes_to_int(base_param_bytes[ttl_pos:ttl_pos + timestamp_bytes_len])
+    else:
+        self._ttl = 0
+
+    if self._version >= compression_version:
+        self._compression = base_param_bytes[compression_pos]
+    else:
+        self._compression = compressions[None]
+
+    if self._version >= codec_version:
+        self._compression_level = bytes_to_int(base_param_bytes[compression_level_pos:compression_threads_pos], True)
+        self._compression_threads = base_param_bytes[compression_threads_pos]
+    else:
+        self._compression_level = None
+        self._compression_threads = 0
+
+    if self._version >= dedup_version:
+        self._dedup = bool(base_param_bytes[dedup_pos])
+    else:
+        self._dedup = False
+
     ## Assign attributes
     self._n_keys_pos = n_keys_pos
 
     ## Pull out the serializers
-    if saved_value_serializer > 0:
-        self._value_serializer = serializers.serial_int_dict[saved_value_serializer]
-    # elif value_serializer is None:
-    #     raise ValueError('value serializer must be a serializer class with dumps and loads methods.')
-    elif inspect.isclass(value_serializer):
-        class_methods = dir(value_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._value_serializer = value_serializer
-        else:
-            raise ValueError('If a custom class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('How did you mess up value_serializer so bad?!', self)
-
-    if saved_key_serializer > 0:
-        self._key_serializer = serializers.serial_int_dict[saved_key_serializer]
-    # elif key_serializer is None:
-    #     raise ValueError('key serializer must be a serializer class with dumps and loads methods.')
-    elif inspect.isclass(key_serializer):
-        class_methods = dir(key_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._key_serializer = key_serializer
-        else:
-            raise ValueError('If a custom class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('How did you mess up key_serializer so bad?!', self)
+    self._value_serializer = get_saved_serializer(saved_value_serializer, value_serializer, 'value')
+    self._key_serializer = get_saved_serializer(saved_key_serializer, key_serializer, 'key')
+    self._key_width = get_key_width(self._n_bytes_key, self._key_serializer)
 
 
-def init_base_params_variable(self, key_serializer, value_serializer, n_buckets, init_timestamps, file_timestamp, uuid7):
+def get_key_width(n_bytes_key, key_serializer):
+    """
+    The fixed width of the serialized keys if the key lengths are not saved (n_bytes_key is 0), otherwise 0. Only key serializers with a width attribute can be used without the key lengths.
+    """
+    if n_bytes_key:
+        return 0
+
+    width = getattr(key_serializer, 'width', None)
+    if not width:
+        raise ValueError('n_bytes_key can only be 0 with a fixed width key serializer (e.g. uint8).')
+
+    return width
+
+
+def check_n_bytes(n_bytes_key, n_bytes_value):
+    """
+    Check the widths of the key and value lengths of a new file.
+    """
+    if not (isinstance(n_bytes_key, int) and 0 <= n_bytes_key <= 4):
+        raise ValueError('n_bytes_key must be an int from 0 to 4.')
+    if not (isinstance(n_bytes_value, int) and 1 <= n_bytes_value <= 8):
+        raise ValueError('n_bytes_value must be an int from 1 to 8.')
+
+
+def init_base_params_variable(self, key_serializer, value_serializer, n_buckets, init_timestamps, file_timestamp, uuid7, n_bytes_key=n_bytes_key, n_bytes_value=n_bytes_value, dedup=False):
     """
 
     """
     ## Value serializer
-    if value_serializer in serializers.serial_name_dict:
-        value_serializer_code = serializers.serial_name_dict[value_serializer]
-        self._value_serializer = serializers.serial_int_dict[value_serializer_code]
-    elif inspect.isclass(value_serializer):
-        class_methods = dir(value_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._value_serializer = value_serializer
-            value_serializer_code = 0
-        else:
-            raise ValueError('If a class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('value serializer must be one of None, {}, or a serializer class with dumps and loads methods.'.format(', '.join(serializers.serial_name_dict.keys())), self)
+    value_serializer_code = get_serializer_code(value_serializer, 'value')
+    self._value_serializer = get_saved_serializer(value_serializer_code, value_serializer, 'value')
 
     ## Key Serializer
-    if key_serializer in serializers.serial_name_dict:
-        key_serializer_code = serializers.serial_name_dict[key_serializer]
-        self._key_serializer = serializers.serial_int_dict[key_serializer_code]
-    elif inspect.isclass(key_serializer):
-        class_methods = dir(key_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._key_serializer = key_serializer
-            key_serializer_code = 0
-        else:
-            raise ValueError('If a class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('key serializer must be one of None, {}, or a serializer class with dumps and loads methods.'.format(', '.join(serializers.serial_name_dict.keys())), self)
+    key_serializer_code = get_serializer_code(key_serializer, 'key')
+    self._key_serializer = get_saved_serializer(key_serializer_code, key_serializer, 'key')
 
     ## Write uuid, version, and other parameters and save encodings to new file
     n_bytes_file_bytes = int_to_bytes(n_bytes_file, 1)
@@ -970,7 +1960,15 @@ def init_base_params_variable(self, key_serializer, value_serializer, n_buckets,
 
     uuid7_bytes = uuid7.bytes
 
-    init_write_bytes = uuid_variable_blt + current_version_bytes + n_bytes_file_bytes + n_bytes_key_bytes + n_bytes_value_bytes + n_buckets_bytes + n_bytes_index_bytes +  saved_value_serializer_bytes + saved_key_serializer_bytes + n_keys_bytes + value_len_bytes + init_timestamps_bytes + file_ts_bytes + uuid7_bytes
+    commit_bytes = get_commit_bytes(sub_index_init_pos + (n_buckets * n_bytes_file), 0)
+    ttl_bytes = int_to_bytes(0, timestamp_bytes_len)
+    compression_bytes = make_compression_bytes(compressions[None], 0, 0)
+    if dedup:
+        dedup_bytes = b'\x01'
+    else:
+        dedup_bytes = b'\x00'
+
+    init_write_bytes = uuid_variable_blt + current_version_bytes + n_bytes_file_bytes + n_bytes_key_bytes + n_bytes_value_bytes + n_buckets_bytes + n_bytes_index_bytes +  saved_value_serializer_bytes + saved_key_serializer_bytes + n_keys_bytes + value_len_bytes + init_timestamps_bytes + file_ts_bytes + uuid7_bytes + commit_bytes + ttl_bytes + compression_bytes + dedup_bytes
 
     extra_bytes = b'0' * (sub_index_init_pos - len(init_write_bytes))
 
@@ -1006,6 +2004,30 @@ def init_files_fixed(self, file_path, flag, key_serializer, value_len, n_buckets
     self.writable = write
     self._write_buffer_size = write_buffer_size
     self._file_path = fp
+    self._lock_mode = 'session'
+    self._generation = None
+    self._data_end = None
+    self._ttl = 0
+    self._max_keys = None
+    self._max_bytes = None
+    self._ts_index = False
+    self._ts_index_path = None
+    self._ts_index_entries = []
+    self._key_index = False
+    self._key_index_path = None
+    self._key_index_entries = []
+    self._value_indexes = {}
+    self._value_index_entries = {}
+    self._buffer_index_values = []
+    self._compression = compressions[None]
+    self._compression_level = 0
+    self._compression_threads = 0
+    self._zstd_dict = None
+    self._codec = None
+    self._key_width = 0
+    self._file_map = None
+    self._blobs = None
+    self._namespaces = {}
     # self._platform = sys.platform
 
     self._buffer_data = bytearray()
@@ -1104,6 +2126,8 @@ def init_files_fixed(self, file_path, flag, key_serializer, value_len, n_buckets
 
             write_init_bucket_indexes(self._file, self._n_buckets, sub_index_init_pos, write_buffer_size)
 
+    self._order_key = getattr(self._key_serializer, 'order', bytes)
+
     ## Create finalizer
     self._finalizer = weakref.finalize(self, close_files, self._file, n_keys_crash, self._n_keys_pos, self.writable)
 
@@ -1134,18 +2158,7 @@ def read_base_params_fixed(self, base_param_bytes, key_serializer):
     ## Pull out the serializers
     self._value_serializer = serializers.Bytes
 
-    if saved_key_serializer > 0:
-        self._key_serializer = serializers.serial_int_dict[saved_key_serializer]
-    # elif key_serializer is None:
-    #     raise ValueError('key serializer must be a serializer class with dumps and loads methods.')
-    elif inspect.isclass(key_serializer):
-        class_methods = dir(key_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._key_serializer = key_serializer
-        else:
-            raise ValueError('If a custom class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('How did you mess up key_serializer so bad?!', self)
+    self._key_serializer = get_saved_serializer(saved_key_serializer, key_serializer, 'key')
 
 
 def init_base_params_fixed(self, key_serializer, value_len, n_buckets, file_timestamp, uuid7):
@@ -1156,18 +2169,8 @@ def init_base_params_fixed(self, key_serializer, value_len, n_buckets, file_time
     self._value_serializer = serializers.Bytes
 
     ## Key Serializer
-    if key_serializer in serializers.serial_name_dict:
-        key_serializer_code = serializers.serial_name_dict[key_serializer]
-        self._key_serializer = serializers.serial_int_dict[key_serializer_code]
-    elif inspect.isclass(key_serializer):
-        class_methods = dir(key_serializer)
-        if ('dumps' in class_methods) and ('loads' in class_methods):
-            self._key_serializer = key_serializer
-            key_serializer_code = 0
-        else:
-            raise ValueError('If a class is passed for a serializer, then it must have dumps and loads methods.', self)
-    else:
-        raise ValueError('key serializer must be one of None, {}, or a serializer class with dumps and loads methods.'.format(', '.join(serializers.serial_name_dict.keys())), self)
+    key_serializer_code = get_serializer_code(key_serializer, 'key')
+    self._key_serializer = get_saved_serializer(key_serializer_code, key_serializer, 'key')
 
     ## Write uuid, version, and other parameters and save encodings to new file
     n_bytes_file_bytes = int_to_bytes(n_bytes_file, 1)
@@ -1426,7 +2429,151 @@ def prune_file_fixed(file, reindex, n_buckets, n_bytes_file, n_bytes_key, value_
     return n_keys, removed_count, n_buckets
 
 
+#######################################
+### Sharded booklet functions
+
+
+def get_shard_index(key_hash, n_shards):
+    """
+    Uses the last bytes of the key hash so that the shard assignment is independent of the bucket assignment within each shard (which uses the whole hash).
+    """
+    return bytes_to_int(key_hash[-4:]) % n_shards
+
+
+def get_shard_path(dir_path, shard_index):
+    """
+
+    """
+    return dir_path.joinpath(shard_file_name.format(shard_index))
+
+
+def write_manifest(manifest_path, manifest):
+    """
+    The manifest is written to a temp file first and then moved into place so that other processes never read a partial manifest.
+    """
+    temp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with io.open(temp_path, 'wb') as f:
+        f.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp_path, manifest_path)
+
+
+def read_manifest(manifest_path):
+    """
+
+    """
+    with io.open(manifest_path, 'rb') as f:
+        manifest = orjson.loads(f.read())
+
+    return manifest
+
+
+def remove_shard_files(dir_path):
+    """
+    Remove old shard files. Each file is exclusively locked before it's removed so that shards that are still open in other processes are not removed out from under them.
+    """
+    for old_path in dir_path.glob(shard_file_glob):
+        with io.open(old_path, 'rb') as f:
+            portalocker.lock(f, portalocker.LOCK_EX)
+            old_path.unlink()
+            portalocker.lock(f, portalocker.LOCK_UN)
+
+
+def init_shards(self, dir_path, flag, key_serializer, value_serializer, n_shards, n_buckets, write_buffer_size, init_timestamps, lock_mode='session', ttl=None):
+    """
+
+    """
+    dp = pathlib.Path(dir_path)
+    manifest_path = dp.joinpath(manifest_file_name)
+
+    if flag == "r":  # Open existing database for reading only (default)
+        write = False
+        create = False
+    elif flag == "w":  # Open existing database for reading and writing
+        write = True
+        create = False
+    elif flag == "c":  # Open database for reading and writing, creating it if it doesn't exist
+        write = True
+        create = not manifest_path.exists()
+    elif flag == "n":  # Always create a new, empty database, open for reading and writing
+        write = True
+        create = True
+    else:
+        raise ValueError("Invalid flag")
+
+    check_lock_mode(lock_mode, write)
+
+    self._dir_path = dp
+    self._lock_mode = lock_mode
+    self._ttl = ttl
+    self.writable = write
+    self._write_buffer_size = write_buffer_size
+    self._shards = {}
+    self._shards_lock = Lock()
+
+    if create:
+        if (not isinstance(n_shards, int)) or (n_shards < 1):
+            raise ValueError('n_shards must be an int > 0.')
+
+        key_serializer_code = get_serializer_code(key_serializer, 'key')
+        value_serializer_code = get_serializer_code(value_serializer, 'value')
+
+        dp.mkdir(parents=True, exist_ok=True)
+
+        ## The directory lock stops other processes from creating the shards at the same time
+        with io.open(dp.joinpath(shard_lock_file_name), 'a+b') as lock_file:
+            portalocker.lock(lock_file, portalocker.LOCK_EX)
+            try:
+                # Another process might have created the shards while this one waited for the lock
+                if (flag == 'n') or (not manifest_path.exists()):
+                    if manifest_path.exists():
+                        manifest_path.unlink()
+                    remove_shard_files(dp)
+
+                    self._n_shards = n_shards
+                    self._n_buckets = n_buckets
+                    self._init_timestamps = bool(init_timestamps)
+                    self._key_serializer_input = key_serializer
+                    self._value_serializer_input = value_serializer
+
+                    ## Create all of the shard files so that other processes can open any of them
+                    for shard_index in range(n_shards):
+                        shard = self._open_shard_file(shard_index, 'n')
+                        shard.close()
+
+                    manifest = {
+                        'version': shard_manifest_version,
+                        'n_shards': n_shards,
+                        'n_buckets': n_buckets,
+                        'key_serializer': key_serializer_code,
+                        'value_serializer': value_serializer_code,
+                        'init_timestamps': self._init_timestamps,
+                        }
+                    write_manifest(manifest_path, manifest)
+            finally:
+                portalocker.lock(lock_file, portalocker.LOCK_UN)
+
+    if not manifest_path.exists():
+        if not write:
+            raise FileNotFoundError('Sharded booklet was requested to be opened as read-only, but no manifest exists.')
+        else:
+            raise FileNotFoundError('No sharded booklet manifest exists in {}.'.format(dp))
+
+    manifest = read_manifest(manifest_path)
+    if manifest['version'] > shard_manifest_version:
+        raise ValueError('The sharded booklet manifest is a newer version.')
+
+    self._n_shards = manifest['n_shards']
+    self._n_buckets = manifest['n_buckets']
+    self._init_timestamps = manifest['init_timestamps']
 
+    ## The saved serializers are used for both the key routing and the shards. Custom serializers must be passed.
+    self._key_serializer = get_saved_serializer(manifest['key_serializer'], key_serializer, 'key')
+    self._value_serializer = get_saved_serializer(manifest['value_serializer'], value_serializer, 'value')
+    self._key_serializer_input = self._key_serializer if manifest['key_serializer'] == 0 else None
+    self._value_serializer_input = self._value_serializer if manifest['value_serializer'] == 0 else None
 
 
 